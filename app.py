@@ -1,9 +1,49 @@
-from flask import Flask, render_template, request, redirect, session, url_for
+from flask import Flask, render_template, request, redirect, session, url_for, abort, send_file, make_response, Response, stream_with_context
 import sqlite3
 import os
-from werkzeug.utils import secure_filename
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import heapq
+import itertools
+import math
+import mimetypes
+import queue
+import random
+import re
+import tempfile
+import warnings
+import shutil
+import subprocess
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+import click
+import numpy as np
+from markupsafe import Markup
+from werkzeug.utils import secure_filename, safe_join
 from twilio.rest import Client
 
+try:
+    import fitz  # PyMuPDF, used to render bill previews
+except ImportError:
+    fitz = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import weasyprint  # HTML -> PDF for invoices
+except ImportError:
+    weasyprint = None
+
 app = Flask(__name__)
 app.secret_key = "sarna_broker_secret_key"
 
@@ -11,14 +51,24 @@ app.secret_key = "sarna_broker_secret_key"
 UPLOAD_FOLDER = "static/uploads/crops"
 BILL_FOLDER = "static/uploads/bills"
 PROFILE_FOLDER = "static/uploads/miller_docs" 
+BILL_PREVIEW_FOLDER = "static/uploads/bills/previews"
+BILL_OPTIMIZED_FOLDER = "static/uploads/bills/optimized"
+BILL_PREVIEW_DPI = 72
+INVOICE_FOLDER = "invoices"
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(BILL_FOLDER, exist_ok=True)
 os.makedirs(PROFILE_FOLDER, exist_ok=True)
+os.makedirs(BILL_PREVIEW_FOLDER, exist_ok=True)
+os.makedirs(BILL_OPTIMIZED_FOLDER, exist_ok=True)
+os.makedirs(INVOICE_FOLDER, exist_ok=True)
 
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["BILL_FOLDER"] = BILL_FOLDER
 app.config["PROFILE_FOLDER"] = PROFILE_FOLDER 
+app.config["BILL_PREVIEW_FOLDER"] = BILL_PREVIEW_FOLDER
+app.config["BILL_OPTIMIZED_FOLDER"] = BILL_OPTIMIZED_FOLDER
+app.config["INVOICE_FOLDER"] = INVOICE_FOLDER
 
 # ---------------- DATABASE ----------------
 def get_db():
@@ -342,10 +392,16 @@ def upgrade_miller_booking_order_id():
 
 upgrade_miller_booking_order_id()
 
-def generate_next_order_id():
-    """Generate next order ID in format S10001, S10002, etc."""
-    con = get_db()
-    cur = con.cursor()
+def generate_next_order_id(cur=None):
+    """Generate next order ID in format S10001, S10002, etc.
+
+    Pass the cursor of an open transaction that creates several bookings,
+    so each call sees the IDs handed out earlier in it.
+    """
+    con = None
+    if cur is None:
+        con = get_db()
+        cur = con.cursor()
     
     # Get the highest order number
     cur.execute("""
@@ -356,7 +412,8 @@ def generate_next_order_id():
     """)
     result = cur.fetchone()
     
-    con.close()
+    if con is not None:
+        con.close()
     
     if result and result[0]:
         # Extract number from existing order_id (e.g., "S10001" -> 10001)
@@ -412,254 +469,4562 @@ def upgrade_miller_profile_table():
     con.commit()
     con.close()
 
-# ---------------- AUTH ----------------
-@app.route("/", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
+# ---------------- CHANGE COUNTERS ----------------
+# Every write to these tables bumps a counter (via triggers), so read routes
+# can build an ETag from a single indexed lookup before running their queries.
+VERSIONED_TABLES = [
+    "users",
+    "crops",
+    "miller_stock",
+    "miller_stock_history",
+    "miller_bookings",
+    "miller_profiles",
+    "buyer_profiles",
+]
+
+def upgrade_change_counters():
+    con = get_db()
+    cur = con.cursor()
 
-        email = request.form.get("email")
-        password = request.form.get("password")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
 
-        if not email or not password:
-            return render_template(
-                "login.html",
-                error="Please enter email and password"
-            )
+    # bill_files is bumped by the preview worker, not by a trigger
+    cur.execute("INSERT OR IGNORE INTO table_versions (name) VALUES ('bill_files')")
 
-        con = get_db()
-        cur = con.cursor()
-        cur.execute(
-            "SELECT id, name, email, password, role, status, is_staff, parent_miller_id FROM users WHERE email=? AND password=?",
-            (email, password)
-        )
-        user = cur.fetchone()
-        con.close()
+    for name in VERSIONED_TABLES:
+        add_version_triggers(cur, name)
 
-        if not user:
-            return render_template(
-                "login.html",
-                error="Invalid credentials"
-            )
+    con.commit()
+    con.close()
 
-        if user[5] != "approved":
-            return render_template(
-                "login.html",
-                error="⛔ Your account is not approved by admin yet"
-            )
+def add_version_triggers(cur, name):
+    """Start counting writes to table `name` in table_versions."""
+    cur.execute("INSERT OR IGNORE INTO table_versions (name) VALUES (?)", (name,))
+
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name}_version_{event.lower()}
+            AFTER {event} ON {name}
+            BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE name = '{name}';
+            END
+        """)
 
-        session["user_id"] = user[0] 
-        session["role"] = user[4]
-        session["is_staff"] = user[6] if user[6] else 0
-        session["parent_miller_id"] = user[7] if user[7] else None
+upgrade_change_counters()
 
-        if user[4] == "farmer":
-            return redirect("/my_commodity")
-        elif user[4] == "buyer":
-            return redirect("/market")
-        elif user[4] == "miller":
-            return redirect("/miller")
-        else:
-            return redirect("/admin")
+def bump_table_version(name):
+    con = get_db()
+    con.execute("UPDATE table_versions SET version = version + 1 WHERE name=?", (name,))
+    con.commit()
+    con.close()
 
-    return render_template("login.html")
+# Templates can change between deploys without any data changing
+APP_BUILD = str(os.path.getmtime(__file__))
+
+def conditional_get(*tables):
+    """Answer GETs with 304 Not Modified while none of `tables` has changed.
+
+    The ETag covers the table counters, the session identity and the
+    request URL, so the route's own queries only run when the page could
+    actually differ from the one the client already has.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+
+            con = get_db()
+            cur = con.cursor()
+            cur.execute(f"""
+                SELECT name, version FROM table_versions
+                WHERE name IN ({",".join("?" * len(tables))})
+                ORDER BY name
+            """, tables)
+            versions = cur.fetchall()
+            con.close()
+
+            identity = (
+                session.get("user_id"),
+                session.get("role"),
+                session.get("is_staff"),
+                session.get("parent_miller_id"),
+            )
+            etag = hashlib.sha1(
+                repr((APP_BUILD, request.full_path, identity, versions)).encode()
+            ).hexdigest()[:20]
+
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+# ---------------- SEARCH INDEX ----------------
+# One FTS5 table covers every searchable entity. The rowid packs the source
+# row id and kind (id * 8 + code) so triggers can replace an entry by rowid
+# instead of scanning the index.
+SEARCH_SOURCES = [
+    {
+        "kind": "crop", "code": 1, "table": "crops",
+        "title": "COALESCE({r}.crop, '') || ' ' || COALESCE({r}.variety, '')",
+        "body": "COALESCE({r}.location, '')",
+        "text_cols": ["crop", "variety", "location"],
+        "cond": "COALESCE({r}.sold, 0) = 0", "cond_cols": ["sold"],
+    },
+    {
+        "kind": "stock", "code": 2, "table": "miller_stock",
+        "title": "COALESCE({r}.crop, '')",
+        "body": "COALESCE({r}.condition, '') || ' ' || COALESCE({r}.bag_type, '')",
+        "text_cols": ["crop", "condition", "bag_type"],
+        "cond": "{r}.quantity > 0", "cond_cols": ["quantity"],
+    },
+    {
+        "kind": "user", "code": 3, "table": "users",
+        "title": "COALESCE({r}.name, '')",
+        "body": "COALESCE({r}.email, '')",
+        "text_cols": ["name", "email"],
+        "cond": "{r}.role != 'admin'", "cond_cols": ["role"],
+    },
+    {
+        "kind": "mill", "code": 4, "table": "miller_profiles",
+        "title": "COALESCE({r}.mill_name, '')",
+        "body": "COALESCE({r}.address, '')",
+        "text_cols": ["mill_name", "address"],
+        "cond": "1", "cond_cols": [],
+    },
+    {
+        "kind": "shop", "code": 5, "table": "buyer_profiles",
+        "title": "COALESCE({r}.shop_name, '')",
+        "body": "COALESCE({r}.address, '')",
+        "text_cols": ["shop_name", "address"],
+        "cond": "1", "cond_cols": [],
+    },
+]
+
+SEARCH_KINDS_BY_ROLE = {
+    "admin": ["crop", "stock", "user", "mill", "shop"],
+    "miller": ["crop", "stock", "mill"],
+    "buyer": ["stock", "mill"],
+    "farmer": ["crop", "mill"],
+}
+
+SEARCH_STOPWORDS = {"near", "in", "at", "the", "of", "and", "or", "not", "for", "from"}
+
+def search_row_sql(source, r):
+    return {
+        "rowid": f"{r}.id * 8 + {source['code']}",
+        "kind": f"'{source['kind']}'",
+        "title": source["title"].format(r=r),
+        "body": source["body"].format(r=r),
+        "cond": source["cond"].format(r=r),
+    }
 
-@app.route("/register", methods=["GET","POST"])
-def register():
-    if request.method == "POST":
-        con = get_db()
-        cur = con.cursor()
-        cur.execute("""
-        INSERT INTO users (name,email,password,role)
-        VALUES (?,?,?,?)
-        """, (
-            request.form["name"],
-            request.form["email"],
-            request.form["password"],
-            request.form["role"]
-        ))
-        con.commit()
-        con.close()
-        return redirect("/")
-    return render_template("register.html")
+def upgrade_search_index():
+    con = get_db()
+    cur = con.cursor()
 
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect("/")
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            kind UNINDEXED,
+            ref_id UNINDEXED,
+            title,
+            body,
+            prefix='2 3',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
 
-# ---------------- FARMER ----------------
-@app.route("/post_crop", methods=["GET","POST"])
-def post_crop():
-    if session.get("role") != "farmer":
-        return redirect("/")
+    for source in SEARCH_SOURCES:
+        table = source["table"]
+        new = search_row_sql(source, "new")
+        old = search_row_sql(source, "old")
+        insert_new = f"""
+            INSERT INTO search_index (rowid, kind, ref_id, title, body)
+            SELECT {new['rowid']}, {new['kind']}, new.id, {new['title']}, {new['body']}
+            WHERE {new['cond']};
+        """
+        changed = [f"old.{c} IS NOT new.{c}" for c in source["text_cols"]]
+        if source["cond_cols"]:
+            changed.append(f"({old['cond']}) IS NOT ({new['cond']})")
+
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_insert
+            AFTER INSERT ON {table}
+            BEGIN
+                {insert_new}
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_update
+            AFTER UPDATE OF {", ".join(source["text_cols"] + source["cond_cols"])} ON {table}
+            WHEN {" OR ".join(changed)}
+            BEGIN
+                DELETE FROM search_index WHERE rowid = {old['rowid']};
+                {insert_new}
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_delete
+            AFTER DELETE ON {table}
+            BEGIN
+                DELETE FROM search_index WHERE rowid = {old['rowid']};
+            END
+        """)
 
-    if request.method == "POST":
-        image = request.files.get("image")
-        filename = None
-        if image and image.filename:
-            filename = secure_filename(image.filename)
-            image.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+    cur.execute("SELECT 1 FROM search_index LIMIT 1")
+    if not cur.fetchone():
+        fill_search_index(cur)
 
-        con = get_db()
-        cur = con.cursor()
-        cur.execute("""
-        INSERT INTO crops (farmer_id,crop,variety,price,quantity,location,image)
-        VALUES (?,?,?,?,?,?,?)
-        """, (
-           get_effective_user_id(),
-            request.form["crop"],
-            request.form["variety"],
-            request.form["price"],
-            request.form["quantity"],
-            request.form["location"],
-            filename
-        ))
-        con.commit()
-        con.close()
-        return redirect("/my_commodity")
+    con.commit()
+    con.close()
 
-    return render_template("post_crop.html")
+def fill_search_index(cur):
+    for source in SEARCH_SOURCES:
+        row = search_row_sql(source, "t")
+        cur.execute(f"""
+            INSERT INTO search_index (rowid, kind, ref_id, title, body)
+            SELECT {row['rowid']}, {row['kind']}, t.id, {row['title']}, {row['body']}
+            FROM {source['table']} t
+            WHERE {row['cond']}
+        """)
 
-@app.route("/my_commodity")
-def my_commodity():
-    if session.get("role") != "farmer":
-        return redirect("/")
+upgrade_search_index()
+
+@app.cli.command("rebuild-search")
+def rebuild_search():
+    """Rebuild the search index from the source tables."""
     con = get_db()
     cur = con.cursor()
-    cur.execute("SELECT * FROM crops WHERE farmer_id=?", (get_effective_user_id(),))
-    crops = cur.fetchall()
+    cur.execute("DELETE FROM search_index")
+    fill_search_index(cur)
+    cur.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+    con.commit()
     con.close()
-    return render_template("my_commodity.html", crops=crops)
 
-# ---------------- MILLER ----------------
-@app.route("/miller", methods=["GET", "POST"])
-def miller_dashboard():    
+def fts_query(text):
+    """Turn free text into an FTS5 prefix query: every word must match."""
+    terms = [t for t in re.findall(r"\w+", text.lower()) if t not in SEARCH_STOPWORDS]
+    return " ".join(f'"{t}"*' for t in terms)
+
+# ---------------- AUTOCOMPLETE ----------------
+AUTOCOMPLETE_LIMIT = 10
+
+# field -> queries returning (value, count) used to seed the tries
+AUTOCOMPLETE_SOURCES = {
+    "crop": [
+        "SELECT crop, COUNT(*) FROM crops GROUP BY crop",
+        "SELECT crop, COUNT(*) FROM miller_stock GROUP BY crop",
+    ],
+    "variety": [
+        "SELECT variety, COUNT(*) FROM crops GROUP BY variety",
+    ],
+    "party": [
+        "SELECT name, COUNT(*) FROM users WHERE role != 'admin' GROUP BY name",
+        "SELECT mill_name, COUNT(*) FROM miller_profiles GROUP BY mill_name",
+        "SELECT shop_name, COUNT(*) FROM buyer_profiles GROUP BY shop_name",
+    ],
+}
+
+def upgrade_crop_aliases():
+    con = get_db()
+    cur = con.cursor()
 
-    if session.get("role") != "miller":
-        return redirect("/")
+    # alias is stored normalized (see normalize_name)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS crop_aliases (
+            alias TEXT PRIMARY KEY,
+            canonical TEXT NOT NULL
+        )
+    """)
 
-    miller_id = get_effective_user_id()
+    con.commit()
+    con.close()
 
+upgrade_crop_aliases()
+
+def normalize_name(value):
+    return " ".join((value or "").lower().split())
+
+class PrefixTrie:
+    """Trie over normalized names; each node keeps its top completions.
+
+    Lookups walk len(prefix) nodes and return the precomputed list, so a
+    keystroke costs the same however many names are stored.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.root = ({}, [])
+        self.forms = {}   # normalized -> {display form: count}
+        self.lock = threading.Lock()
+
+    def add(self, value, count=1):
+        key = normalize_name(value)
+        if not key:
+            return
+
+        with self.lock:
+            forms = self.forms.setdefault(key, {})
+            display = " ".join(value.split())
+            forms[display] = forms.get(display, 0) + count
+            total = sum(forms.values())
+
+            node = self.root
+            for ch in key:
+                node = node[0].setdefault(ch, ({}, []))
+                top = [entry for entry in node[1] if entry[1] != key]
+                top.append((-total, key))
+                top.sort()
+                node[1][:] = top[:self.limit]
+
+    def complete(self, prefix):
+        node = self.root
+        for ch in normalize_name(prefix):
+            node = node[0].get(ch)
+            if node is None:
+                return []
+        return [(key, -neg_total) for neg_total, key in node[1]]
+
+    def display(self, key):
+        """Most used spelling of a normalized name."""
+        forms = self.forms.get(key)
+        if not forms:
+            return None
+        return max(forms.items(), key=lambda item: item[1])[0]
+
+class Autocomplete:
+    def __init__(self):
+        self.tries = None
+        self.aliases = {}
+        self.lock = threading.Lock()
+
+    def ensure_loaded(self):
+        if self.tries is not None:
+            return
+        with self.lock:
+            if self.tries is not None:
+                return
+
+            con = get_db()
+            cur = con.cursor()
+            tries = {}
+            for field, queries in AUTOCOMPLETE_SOURCES.items():
+                tries[field] = PrefixTrie(AUTOCOMPLETE_LIMIT)
+                for query in queries:
+                    cur.execute(query)
+                    for value, count in cur.fetchall():
+                        if value:
+                            tries[field].add(value, count)
+
+            cur.execute("SELECT alias, canonical FROM crop_aliases")
+            self.aliases = dict(cur.fetchall())
+            con.close()
+
+            for alias in self.aliases:
+                tries["crop"].add(alias, 0)
+            self.tries = tries
+
+    def add(self, field, value):
+        if self.tries is not None and value:
+            self.tries[field].add(value)
+
+    def add_alias(self, alias, canonical):
+        self.ensure_loaded()
+        self.aliases[normalize_name(alias)] = canonical
+        self.tries["crop"].add(alias, 0)
+
+    def canonical(self, field, value):
+        """Spelling to store for a free-typed value ("paddy " -> "Paddy")."""
+        self.ensure_loaded()
+        key = normalize_name(value)
+        if field == "crop" and key in self.aliases:
+            return self.aliases[key]
+        return self.tries[field].display(key) or " ".join((value or "").split())
+
+    def complete(self, field, prefix):
+        self.ensure_loaded()
+        results = {}
+        for key, count in self.tries[field].complete(prefix):
+            if field == "crop" and key in self.aliases:
+                value = self.aliases[key]
+                count = sum(self.tries["crop"].forms.get(normalize_name(value), {}).values())
+            else:
+                value = self.tries[field].display(key)
+            results[value] = max(results.get(value, 0), count)
+        return [
+            {"value": value, "count": count}
+            for value, count in sorted(results.items(), key=lambda item: -item[1])
+        ]
+
+autocomplete = Autocomplete()
+
+# ---------------- LOCATIONS ----------------
+# Free-text locations/addresses are matched against a bundled district
+# gazetteer; matched rows get district_code/lat/lon and an R*Tree entry so
+# radius searches are index lookups. Unmatched rows keep district_code ''.
+GAZETTEER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.csv")
+NEAR_DEFAULT_KM = 50
+NEAR_MAX_KM = 500
+
+def upgrade_location_index():
     con = get_db()
     cur = con.cursor()
 
-    # ❌ STAFF CANNOT POST STOCK
-    if request.method == "POST":
-        if session.get("is_staff"):
-            return redirect("/miller")   # 🔒 block staff
+    for table in ("crops", "miller_profiles"):
+        cur.execute(f"PRAGMA table_info({table})")
+        cols = [c[1] for c in cur.fetchall()]
 
-        cur.execute("""
-            INSERT INTO miller_stock
-            (miller_id, crop, quantity, price, condition, bag_type, deduction)
-            VALUES (?,?,?,?,?,?,?)
-        """, (
-            miller_id,
-            request.form["crop"],
-            request.form["quantity"],
-            request.form["price"],
-            request.form["condition"],
-            request.form["bag_type"],
-            request.form["deduction"]
-        ))
-        con.commit()
+        if "district_code" not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN district_code TEXT")
 
+        if "lat" not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN lat REAL")
 
-# ✅ LIVE STOCKS
-    cur.execute("""
-    SELECT *
-    FROM miller_stock
-    WHERE miller_id=?
-    ORDER BY created_at DESC
-""", (miller_id,))
-    stocks = cur.fetchall()
+        if "lon" not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN lon REAL")
 
-# ✅ BUYER BOOKINGS
-    cur.execute("""
-    SELECT
-        mb.id,
-        u.name,
-        ms.crop,
-        mb.quantity,
-        mb.status,
-        mb.reason,
-        mb.decision_at,
-        mb.loaded_qty,
-        mb.loading_status,
-        mb.bill_document,
-        mb.order_id
-    FROM miller_bookings mb
-    JOIN users u ON mb.buyer_id = u.id
-    JOIN miller_stock ms ON mb.stock_id = ms.id
-    WHERE ms.miller_id=?
-    ORDER BY mb.created_at DESC
-""", (miller_id,))
-    bookings = cur.fetchall()
+    # crops_geo is keyed by crops.id, mills_geo by the miller's user id
+    for geo, table, key in (("crops_geo", "crops", "id"), ("mills_geo", "miller_profiles", "miller_id")):
+        cur.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {geo}
+            USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {geo}_insert
+            AFTER INSERT ON {table}
+            WHEN new.lat IS NOT NULL AND new.lon IS NOT NULL
+            BEGIN
+                INSERT OR REPLACE INTO {geo} VALUES (new.{key}, new.lat, new.lat, new.lon, new.lon);
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {geo}_update
+            AFTER UPDATE OF lat, lon ON {table}
+            BEGIN
+                DELETE FROM {geo} WHERE id = old.{key};
+                INSERT INTO {geo}
+                SELECT new.{key}, new.lat, new.lat, new.lon, new.lon
+                WHERE new.lat IS NOT NULL AND new.lon IS NOT NULL;
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {geo}_delete
+            AFTER DELETE ON {table}
+            BEGIN
+                DELETE FROM {geo} WHERE id = old.{key};
+            END
+        """)
 
+    con.commit()
     con.close()
 
-    return render_template(
-        "miller.html",
-        stocks=stocks,
-        bookings=bookings
+upgrade_location_index()
+
+gazetteer = None
+
+def load_gazetteer():
+    """name/alias (lowercase, possibly multi-word) -> list of district dicts"""
+    global gazetteer
+    if gazetteer is not None:
+        return gazetteer
+
+    names = {}
+    with open(GAZETTEER_FILE, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            district = {
+                "code": row["code"],
+                "district": row["district"],
+                "state": row["state"],
+                "lat": float(row["lat"]),
+                "lon": float(row["lon"]),
+            }
+            aliases = [row["district"]] + [a for a in row["aliases"].split(";") if a]
+            for alias in aliases:
+                key = " ".join(re.findall(r"\w+", alias.lower()))
+                names.setdefault(key, []).append(district)
+
+    gazetteer = names
+    return gazetteer
+
+def resolve_location(text):
+    """Best gazetteer district for a free-text location, or None.
+
+    Longer phrases win ("lakhimpur kheri" over "kheri"), and a state named
+    in the text breaks ties between districts sharing a name.
+    """
+    names = load_gazetteer()
+    words = re.findall(r"\w+", (text or "").lower())
+    joined = " " + " ".join(words) + " "
+
+    matches = []
+    for n in (3, 2, 1):
+        for i in range(len(words) - n + 1):
+            phrase = " ".join(words[i:i + n])
+            for district in names.get(phrase, []):
+                matches.append((n, i, district))
+    if not matches:
+        return None
+
+    in_state = [m for m in matches if f" {m[2]['state'].lower()} " in joined]
+    best = max(in_state or matches, key=lambda m: (m[0], -m[1]))
+    return best[2]
+
+def location_columns(text):
+    """(district_code, lat, lon) to store for a free-text location."""
+    district = resolve_location(text)
+    if not district:
+        return "", None, None
+    return district["code"], district["lat"], district["lon"]
+
+def backfill_locations():
+    con = get_db()
+    cur = con.cursor()
+
+    for table, column in (("crops", "location"), ("miller_profiles", "address")):
+        cur.execute(f"SELECT id, {column} FROM {table} WHERE district_code IS NULL")
+        for row_id, text in cur.fetchall():
+            cur.execute(f"""
+                UPDATE {table} SET district_code=?, lat=?, lon=? WHERE id=?
+            """, (*location_columns(text), row_id))
+
+    con.commit()
+    con.close()
+
+backfill_locations()
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
     )
-@app.route("/miller/update_loading/<int:id>", methods=["POST"])
-def update_loading(id):
-    if session.get("role") != "miller":
-        return redirect("/")
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
 
-    load_qty = int(request.form["load_qty"])
+def bounding_box(lat, lon, km):
+    dlat = km / 111.0
+    dlon = km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+# ---------------- PROCUREMENT ----------------
+PROCUREMENT_PAGE_SIZE = 50
 
+def upgrade_procurement():
     con = get_db()
     cur = con.cursor()
 
-    # Fetch booking
+    # feed order is (price, id) within the unsold crops, optionally per crop
     cur.execute("""
-        SELECT quantity, loaded_qty
-        FROM miller_bookings
-        WHERE id=?
-    """, (id,))
-    total_qty, loaded_qty = cur.fetchone()
+        CREATE INDEX IF NOT EXISTS idx_crops_sold_crop_price
+        ON crops (sold, crop, price, id)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_crops_sold_price
+        ON crops (sold, price, id)
+    """)
 
-    new_loaded = loaded_qty + load_qty
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS crop_purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            crop_id INTEGER UNIQUE,
+            farmer_id INTEGER,
+            miller_id INTEGER,
+            crop TEXT,
+            variety TEXT,
+            price INTEGER,
+            quantity INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
 
-    if new_loaded >= total_qty:
-        new_loaded = total_qty
-        status = "completed"
-    else:
-        status = "partial"
+    con.commit()
+    con.close()
+
+upgrade_procurement()
+
+# ---------------- RESERVATIONS ----------------
+# Pending bookings hold stock only until expires_at; the sweeper thread
+# hands expired ones back to stock in small batches. Bookings made before
+# expiry existed have expires_at NULL and are left alone.
+app.config["RESERVATION_TTL_HOURS"] = int(os.environ.get("RESERVATION_TTL_HOURS", 24))
+RESERVATION_SWEEP_INTERVAL = 60
+RESERVATION_SWEEP_BATCH = 200
+
+reservation_metrics = {
+    "swept_total": 0,
+    "sweeps": 0,
+    "batches": 0,
+    "last_sweep_at": None,
+    "last_sweep_ms": None,
+    "last_swept": 0,
+    "lag_seconds": None,
+}
+
+def upgrade_reservations():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("PRAGMA table_info(miller_bookings)")
+    cols = [c[1] for c in cur.fetchall()]
+
+    if "expires_at" not in cols:
+        cur.execute("ALTER TABLE miller_bookings ADD COLUMN expires_at DATETIME")
 
     cur.execute("""
-        UPDATE miller_bookings
-        SET loaded_qty=?, loading_status=?
-        WHERE id=?
-    """, (new_loaded, status, id))
+        CREATE INDEX IF NOT EXISTS idx_miller_bookings_status_expires
+        ON miller_bookings (status, expires_at)
+    """)
 
     con.commit()
     con.close()
-    return redirect("/miller")
-    
-@app.route("/miller/upload_bill/<int:booking_id>", methods=["POST"])
-def upload_booking_bill(booking_id):
-    if session.get("role") != "miller":
-        return redirect("/")
 
-    # Verify the booking belongs to this miller
-    miller_id = get_effective_user_id()
+upgrade_reservations()
+
+def reservation_ttl():
+    """SQLite datetime() modifier for a new reservation's expiry."""
+    return f"+{app.config['RESERVATION_TTL_HOURS']} hours"
+
+def sweep_expired_reservations():
+    """Expire overdue pending bookings and return their stock, batch by batch."""
+    started = time.perf_counter()
+    swept = 0
+
     con = get_db()
     cur = con.cursor()
 
+    # lag: how long the oldest overdue reservation has been waiting for us
     cur.execute("""
-        SELECT mb.id
-        FROM miller_bookings mb
-        JOIN miller_stock ms ON mb.stock_id = ms.id
-        WHERE mb.id=? AND ms.miller_id=? AND mb.loading_status='completed'
-    """, (booking_id, miller_id))
-    
-    booking = cur.fetchone()
-    if not booking:
-        con.close()
-        return redirect("/miller")
-
+        SELECT (julianday('now') - julianday(MIN(expires_at))) * 86400
+        FROM miller_bookings
+        WHERE status='pending' AND expires_at <= datetime('now')
+    """)
+    lag = cur.fetchone()[0]
+
+    while True:
+        cur.execute("""
+            SELECT id
+            FROM miller_bookings
+            WHERE status='pending' AND expires_at <= datetime('now')
+              AND COALESCE(loaded_qty, 0) = 0
+            ORDER BY expires_at
+            LIMIT ?
+        """, (RESERVATION_SWEEP_BATCH,))
+        batch = [row[0] for row in cur.fetchall()]
+        if not batch:
+            break
+
+        results = transition_bookings(
+            con, batch, "expire", "system", reason="Reservation expired"
+        )
+        swept += sum(1 for status in results.values() if status == "expired")
+        reservation_metrics["batches"] += 1
+        if len(batch) < RESERVATION_SWEEP_BATCH:
+            break
+
+    con.close()
+
+    reservation_metrics["swept_total"] += swept
+    reservation_metrics["sweeps"] += 1
+    reservation_metrics["last_swept"] = swept
+    reservation_metrics["last_sweep_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    reservation_metrics["last_sweep_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    reservation_metrics["lag_seconds"] = round(lag, 1) if lag is not None else 0
+    return swept
+
+def reservation_sweeper():
+    while True:
+        try:
+            sweep_expired_reservations()
+        except Exception:
+            app.logger.exception("Reservation sweep failed")
+        time.sleep(RESERVATION_SWEEP_INTERVAL)
+
+# ---------------- WAITLIST ----------------
+# Demand that couldn't be booked is queued per lot (stock_id set) or per
+# crop (stock_id NULL), with the highest price the buyer accepts. Whenever
+# a lot gains quantity, waiting entries priced at or above it are served
+# oldest first inside the same transaction; only WAITLIST_BATCH
+# entries are handled inline and the rest continue on the worker thread.
+WAITLIST_BATCH = 20
+
+def upgrade_waitlist():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS booking_waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            buyer_id INTEGER,
+            stock_id INTEGER,
+            crop TEXT,
+            quantity INTEGER,
+            remaining INTEGER,
+            max_price INTEGER,
+            status TEXT DEFAULT 'waiting',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cur.execute("PRAGMA table_info(booking_waitlist)")
+    cols = [c[1] for c in cur.fetchall()]
+
+    if "max_price" not in cols:
+        cur.execute("ALTER TABLE booking_waitlist ADD COLUMN max_price INTEGER")
+        # entries queued for one lot were asking for that lot's price
+        cur.execute("""
+            UPDATE booking_waitlist
+            SET max_price=(SELECT price FROM miller_stock WHERE id=booking_waitlist.stock_id)
+            WHERE stock_id IS NOT NULL
+        """)
+
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_booking_waitlist_status_crop
+        ON booking_waitlist (status, crop, id)
+    """)
+
+    con.commit()
+    con.close()
+
+upgrade_waitlist()
+
+def allocate_waitlist(cur, stock_id, limit=WAITLIST_BATCH):
+    """Book free quantity of a lot to waiting buyers, FIFO.
+
+    Runs in the caller's transaction. Returns True when entries were left
+    waiting while the lot still has quantity (call again to continue).
+    """
+    cur.execute("SELECT quantity, crop, price FROM miller_stock WHERE id=?", (stock_id,))
+    row = cur.fetchone()
+    if not row or row[0] <= 0:
+        return False
+    available, crop, price = row
+
+    cur.execute("""
+        SELECT id, buyer_id, remaining
+        FROM booking_waitlist
+        WHERE status='waiting' AND crop=? AND (stock_id=? OR stock_id IS NULL)
+          AND max_price >= ?
+        ORDER BY id
+        LIMIT ?
+    """, (crop, stock_id, price, limit + 1))
+    entries = cur.fetchall()
+
+    for entry_id, buyer_id, remaining in entries[:limit]:
+        take = min(available, remaining)
+        cur.execute("""
+            UPDATE miller_stock SET quantity=quantity-?
+            WHERE id=? AND quantity>=?
+        """, (take, stock_id, take))
+        cur.execute("""
+            INSERT INTO miller_bookings (stock_id, buyer_id, quantity, status, order_id, expires_at)
+            VALUES (?,?,?, 'pending', ?, datetime('now', ?))
+        """, (stock_id, buyer_id, take, generate_next_order_id(cur), reservation_ttl()))
+        cur.execute("""
+            UPDATE booking_waitlist
+            SET remaining=remaining-?,
+                status=CASE WHEN remaining-?=0 THEN 'filled' ELSE status END
+            WHERE id=?
+        """, (take, take, entry_id))
+
+        available -= take
+        if not available:
+            return False
+
+    return len(entries) > limit
+
+def release_stock(cur, stock_id, qty):
+    """Return quantity to a lot and hand it to the waitlist first."""
+    cur.execute("UPDATE miller_stock SET quantity=quantity+? WHERE id=?", (qty, stock_id))
+    if allocate_waitlist(cur, stock_id):
+        run_in_background(process_waitlist, stock_id)
+
+def process_waitlist(stock_id):
+    """Keep allocating a lot to its waitlist, one short transaction per batch."""
+    more = True
+    while more:
+        con = get_db()
+        cur = con.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            more = allocate_waitlist(cur, stock_id)
+            con.commit()
+        except Exception:
+            con.rollback()
+            app.logger.exception("waitlist allocation for stock %s failed", stock_id)
+            return
+        finally:
+            con.close()
+
+# ---------------- BOOKING STATE MACHINE ----------------
+# Every booking status change goes through transition_bookings(): one
+# BEGIN IMMEDIATE transaction, an UPDATE ... WHERE status=<seen status>
+# compare-and-set per booking, and the stock adjustment the transition
+# implies. Repeating a transition (double click) finds the status already
+# moved and changes nothing.
+BOOKING_TRANSITIONS = {
+    # action: (allowed from, new status, quantity goes back to the lot)
+    "approve": (("pending",), "approved", False),
+    "decline": (("pending", "approved"), "declined", True),
+    "cancel": (("pending",), "cancelled", True),
+    "expire": (("pending",), "expired", True),
+}
+
+BOOKING_ACTORS = {
+    "approve": ("miller", "admin"),
+    "decline": ("miller", "admin"),
+    "cancel": ("buyer",),
+    "expire": ("system",),
+}
+
+SQL_BATCH = 500
+
+def upgrade_agreed_price():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("PRAGMA table_info(miller_bookings)")
+    cols = [c[1] for c in cur.fetchall()]
+
+    if "agreed_price" not in cols:
+        cur.execute("ALTER TABLE miller_bookings ADD COLUMN agreed_price INTEGER")
+        # bookings approved before the column existed keep today's lot price
+        cur.execute("""
+            UPDATE miller_bookings
+            SET agreed_price=(SELECT price FROM miller_stock WHERE id=miller_bookings.stock_id)
+            WHERE status='approved' OR truck_status='loaded'
+        """)
+
+    con.commit()
+    con.close()
+
+upgrade_agreed_price()
+
+def transition_bookings(con, booking_ids, action, role, actor_id=None, reason=None):
+    """Apply `action` to bookings in one write transaction.
+
+    Millers may only touch bookings on their own stock and buyers only
+    their own bookings. Approval fixes the lot's current price on the
+    booking as agreed_price, so later repricing doesn't change it, and
+    posts the booking's value to the ledger as a commitment. Returns
+    {booking_id: new status} with "not_found", "forbidden",
+    "invalid_state" or "loading_started" for bookings that were left
+    unchanged.
+    """
+    sources, target, releases = BOOKING_TRANSITIONS[action]
+    booking_ids = list(dict.fromkeys(booking_ids))
+    if role not in BOOKING_ACTORS[action]:
+        return {booking_id: "forbidden" for booking_id in booking_ids}
+
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        rows = {}
+        for i in range(0, len(booking_ids), SQL_BATCH):
+            chunk = booking_ids[i:i + SQL_BATCH]
+            cur.execute(f"""
+                SELECT mb.id, mb.status, mb.stock_id, mb.quantity,
+                       COALESCE(mb.loaded_qty, 0), mb.buyer_id, ms.miller_id, ms.crop
+                FROM miller_bookings mb
+                JOIN miller_stock ms ON mb.stock_id = ms.id
+                WHERE mb.id IN ({",".join("?" * len(chunk))})
+            """, chunk)
+            rows.update({row[0]: row for row in cur.fetchall()})
+
+        results = {}
+        changes = []
+        for booking_id in booking_ids:
+            row = rows.get(booking_id)
+            if row is None:
+                results[booking_id] = "not_found"
+            elif (role == "miller" and row[6] != actor_id) or (role == "buyer" and row[5] != actor_id):
+                results[booking_id] = "forbidden"
+            elif row[1] not in sources:
+                results[booking_id] = "invalid_state"
+            elif releases and row[4]:
+                # loaded goods have left the lot and can't go back to stock
+                results[booking_id] = "loading_started"
+            else:
+                results[booking_id] = target
+                changes.append(row)
+
+        if changes:
+            cur.executemany("""
+                UPDATE miller_bookings
+                SET status=?, reason=COALESCE(?, reason), decision_at=CURRENT_TIMESTAMP,
+                    agreed_price=CASE WHEN ?='approved'
+                        THEN COALESCE(agreed_price, (SELECT price FROM miller_stock WHERE id=miller_bookings.stock_id))
+                        ELSE agreed_price END
+                WHERE id=? AND status=?
+            """, [(target, reason, target, row[0], row[1]) for row in changes])
+            if cur.rowcount != len(changes):
+                raise RuntimeError("booking status changed during transition")
+
+        # commitments follow the booking: posted on approval, reversed when
+        # an approved booking is declined
+        for row in changes:
+            try:
+                if target == "approved":
+                    post_approval_journal(cur, row[0])
+                elif row[1] == "approved":
+                    post_decline_journal(cur, row[0])
+            except ValueError as e:
+                app.logger.warning("no %s journal for booking %s: %s", action, row[0], e)
+
+        # only the approved queue is scheduled onto gates
+        for miller_id in {row[6] for row in changes if "approved" in (row[1], target)}:
+            schedule_miller(cur, miller_id)
+
+        if releases:
+            returned = {}
+            for row in changes:
+                returned[row[2]] = returned.get(row[2], 0) + row[3]
+            for stock_id, qty in returned.items():
+                release_stock(cur, stock_id, qty)
+
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+    # released quantity may now meet resting exchange bids
+    if releases:
+        for crop in {row[7] for row in changes}:
+            exchange.match_crop(crop)
+    return results
+
+USER_TRANSITIONS = {
+    "approve": "approved",
+    "block": "blocked",
+    "reject": "rejected",
+}
+
+def transition_users(con, user_ids, action):
+    """Set the account status of many users in one write transaction.
+
+    Admin accounts are never changed. Returns {user_id: new status} with
+    "not_found" or "forbidden" for users that were left alone.
+    """
+    target = USER_TRANSITIONS[action]
+    user_ids = list(dict.fromkeys(user_ids))
+
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        roles = {}
+        for i in range(0, len(user_ids), SQL_BATCH):
+            chunk = user_ids[i:i + SQL_BATCH]
+            cur.execute(f"""
+                SELECT id, role FROM users
+                WHERE id IN ({",".join("?" * len(chunk))})
+            """, chunk)
+            roles.update(cur.fetchall())
+
+        results = {}
+        for user_id in user_ids:
+            if user_id not in roles:
+                results[user_id] = "not_found"
+            elif roles[user_id] == "admin":
+                results[user_id] = "forbidden"
+            else:
+                results[user_id] = target
+
+        cur.executemany(
+            "UPDATE users SET status=? WHERE id=?",
+            [(target, user_id) for user_id, status in results.items() if status == target]
+        )
+        con.commit()
+        return results
+    except Exception:
+        con.rollback()
+        raise
+
+def transition_booking(booking_id, action, role, actor_id=None, reason=None):
+    con = get_db()
+    result = transition_bookings(con, [booking_id], action, role, actor_id, reason)
+    con.close()
+    return result[booking_id]
+
+# ---------------- LOADING EVENTS ----------------
+# Each truck loaded against a booking is one appended loading_events row.
+# An AFTER INSERT trigger folds it into miller_bookings (loaded_qty,
+# loading_status, truck_status, loaded_at) inside the same statement, so
+# concurrent updates from several gates never overwrite each other.
+def upgrade_loading_events():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='loading_events'")
+    first_run = cur.fetchone() is None
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS loading_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL,
+            truck_number TEXT,
+            quantity INTEGER NOT NULL,
+            staff_id INTEGER,
+            loaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_loading_events_booking
+        ON loading_events (booking_id, id)
+    """)
+
+    if first_run:
+        # carry counters from before the event log over as one event each,
+        # before the trigger exists so they aren't added twice
+        cur.execute("""
+            INSERT INTO loading_events (booking_id, quantity, loaded_at)
+            SELECT id, loaded_qty, COALESCE(loaded_at, decision_at, created_at)
+            FROM miller_bookings
+            WHERE COALESCE(loaded_qty, 0) > 0
+        """)
+        cur.execute("""
+            UPDATE miller_bookings
+            SET truck_status='loaded', loaded_at=COALESCE(loaded_at, decision_at, created_at)
+            WHERE loading_status='completed'
+        """)
+
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS loading_events_apply
+        AFTER INSERT ON loading_events
+        BEGIN
+            UPDATE miller_bookings
+            SET loaded_qty = MIN(quantity, COALESCE(loaded_qty, 0) + NEW.quantity),
+                loading_status = CASE
+                    WHEN COALESCE(loaded_qty, 0) + NEW.quantity >= quantity THEN 'completed'
+                    ELSE 'partial'
+                END,
+                truck_status = CASE
+                    WHEN COALESCE(loaded_qty, 0) + NEW.quantity >= quantity THEN 'loaded'
+                    ELSE truck_status
+                END,
+                loaded_at = NEW.loaded_at
+            WHERE id = NEW.booking_id;
+        END
+    """)
+
+    add_version_triggers(cur, "loading_events")
+
+    con.commit()
+    con.close()
+
+upgrade_loading_events()
+
+def record_loading(cur, booking_id, miller_id, quantity, truck_number=None, staff_id=None):
+    """Append a loading event for an approved booking.
+
+    Returns the quantity recorded, or 0 when the booking isn't this
+    miller's, isn't approved, or has less than `quantity` left to load.
+    """
+    cur.execute("""
+        INSERT INTO loading_events (booking_id, truck_number, quantity, staff_id)
+        SELECT mb.id, ?, ?, ?
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.id=? AND ms.miller_id=?
+          AND mb.status = 'approved'
+          AND mb.quantity - COALESCE(mb.loaded_qty, 0) >= ?
+    """, (truck_number, quantity, staff_id, booking_id, miller_id, quantity))
+    if not cur.rowcount:
+        return 0
+
+    post_loading_journal(cur, booking_id, cur.lastrowid, quantity)
+    return quantity
+
+# ---------------- LOADING SLOTS ----------------
+# Each miller's gate loads a fixed quantity per hour between opening and
+# closing time. Approved bookings still to load are ordered by a static
+# priority key, so a heap gives the loading order directly:
+#   created (hours) - TIER_BONUS_HOURS * buyer tier + remaining / capacity
+# i.e. older bookings first, a head start for regular buyers, and short
+# loads ahead of long ones that arrived at about the same time.
+# Slots are recomputed for one miller whenever that miller's queue changes.
+app.config["GATE_UTC_OFFSET_MINUTES"] = int(os.environ.get("GATE_UTC_OFFSET_MINUTES", 330))
+
+DEFAULT_GATE_CAPACITY = (100, 8, 20)  # quintals per hour, opens, closes
+TIER_BONUS_HOURS = 6
+BUYER_TIERS = ((1000, 2), (200, 1))   # quintals loaded in 90 days -> tier
+
+def upgrade_loading_slots():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS gate_capacity (
+            miller_id INTEGER PRIMARY KEY,
+            qty_per_hour INTEGER NOT NULL,
+            open_hour INTEGER NOT NULL DEFAULT 8,
+            close_hour INTEGER NOT NULL DEFAULT 20
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS loading_slots (
+            booking_id INTEGER PRIMARY KEY,
+            miller_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            slot_start DATETIME NOT NULL,
+            slot_end DATETIME NOT NULL,
+            planned_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_loading_slots_miller
+        ON loading_slots (miller_id, position)
+    """)
+
+    add_version_triggers(cur, "gate_capacity")
+    add_version_triggers(cur, "loading_slots")
+
+    con.commit()
+    con.close()
+
+upgrade_loading_slots()
+
+def gate_open_at(t, open_hour, close_hour):
+    """Earliest time >= t (hours since a midnight) the gate is open."""
+    day, hour = divmod(t, 24)
+    if hour < open_hour:
+        return day * 24 + open_hour
+    if hour >= close_hour:
+        return (day + 1) * 24 + open_hour
+    return t
+
+def gate_work(t, hours, open_hour, close_hour):
+    """Start and finish of `hours` of loading begun no earlier than t."""
+    start = t = gate_open_at(t, open_hour, close_hour)
+    while True:
+        closes = (t // 24) * 24 + close_hour
+        if t + hours <= closes:
+            return start, t + hours
+        hours -= closes - t
+        t = gate_open_at(closes, open_hour, close_hour)
+
+def loading_priority(created, remaining, tier, qty_per_hour):
+    return created - TIER_BONUS_HOURS * tier + remaining / qty_per_hour
+
+def buyer_tiers(cur, buyer_ids):
+    buyer_ids = list(buyer_ids)
+    if not buyer_ids:
+        return {}
+
+    cur.execute(f"""
+        SELECT buyer_id, SUM(loaded_qty)
+        FROM miller_bookings
+        WHERE buyer_id IN ({",".join("?" * len(buyer_ids))})
+          AND loaded_at >= datetime('now', '-90 days')
+        GROUP BY buyer_id
+    """, buyer_ids)
+    loaded = dict(cur.fetchall())
+
+    tiers = {}
+    for buyer_id in buyer_ids:
+        qty = loaded.get(buyer_id) or 0
+        tiers[buyer_id] = next((tier for floor, tier in BUYER_TIERS if qty >= floor), 0)
+    return tiers
+
+def schedule_miller(cur, miller_id, now=None):
+    """Replace `miller_id`'s loading_slots with a fresh plan."""
+    cur.execute("""
+        SELECT qty_per_hour, open_hour, close_hour
+        FROM gate_capacity WHERE miller_id=?
+    """, (miller_id,))
+    qty_per_hour, open_hour, close_hour = cur.fetchone() or DEFAULT_GATE_CAPACITY
+
+    cur.execute("""
+        SELECT mb.id, mb.buyer_id, mb.quantity - COALESCE(mb.loaded_qty, 0), mb.created_at
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE ms.miller_id=?
+          AND mb.status='approved'
+          AND mb.loading_status IN ('pending', 'partial')
+          AND mb.quantity > COALESCE(mb.loaded_qty, 0)
+    """, (miller_id,))
+    bookings = cur.fetchall()
+
+    # work in gate-local hours since today's midnight
+    offset = timedelta(minutes=app.config["GATE_UTC_OFFSET_MINUTES"])
+    now = (now or datetime.now(timezone.utc).replace(tzinfo=None)) + offset
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def hours(ts):
+        return (datetime.fromisoformat(ts) + offset - midnight).total_seconds() / 3600
+
+    def stamp(h):
+        return (midnight + timedelta(hours=h) - offset).strftime("%Y-%m-%d %H:%M:%S")
+
+    tiers = buyer_tiers(cur, {b[1] for b in bookings})
+    heap = [
+        (loading_priority(hours(created), remaining, tiers[buyer_id], qty_per_hour), booking_id, remaining)
+        for booking_id, buyer_id, remaining, created in bookings
+    ]
+    heapq.heapify(heap)
+
+    slots = []
+    t = (now - midnight).total_seconds() / 3600
+    while heap:
+        _, booking_id, remaining = heapq.heappop(heap)
+        start, t = gate_work(t, remaining / qty_per_hour, open_hour, close_hour)
+        slots.append((booking_id, miller_id, len(slots), remaining, stamp(start), stamp(t)))
+
+    cur.execute("DELETE FROM loading_slots WHERE miller_id=?", (miller_id,))
+    cur.executemany("""
+        INSERT INTO loading_slots
+        (booking_id, miller_id, position, quantity, slot_start, slot_end)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, slots)
+    return slots
+
+@app.cli.command("bench-loading-slots")
+@click.option("--days", default=14, help="Days of arrivals to simulate.")
+@click.option("--rate", default=0.35, help="Approved bookings per hour at one mill.")
+@click.option("--capacity", default=100, help="Gate capacity in quintals per hour.")
+@click.option("--seed", default=7)
+def bench_loading_slots(days, rate, capacity, seed):
+    """Simulate one mill gate and compare FIFO with the priority schedule."""
+    open_hour, close_hour = DEFAULT_GATE_CAPACITY[1:]
+    rng = random.Random(seed)
+
+    arrivals = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t > days * 24:
+            break
+        qty = min(int(rng.lognormvariate(4.5, 0.7)), 1000)
+        tier = rng.choices((0, 1, 2), weights=(70, 20, 10))[0]
+        arrivals.append((t, qty, tier))
+
+    offered = sum(a[1] for a in arrivals) / capacity
+    open_hours = days * (close_hour - open_hour)
+    click.echo(f"{len(arrivals)} bookings over {days} days, gate utilisation {offered / open_hours:.0%}")
+
+    policies = {
+        "fifo": lambda created, qty, tier: created,
+        "priority": lambda created, qty, tier: loading_priority(created, qty, tier, capacity),
+    }
+    for name, key in policies.items():
+        waits = []
+        by_tier = {0: [], 1: [], 2: []}
+        heap = []
+        pending = iter(arrivals)
+        upcoming = next(pending, None)
+        clock = 0.0
+        while heap or upcoming:
+            if not heap:
+                clock = max(clock, upcoming[0])
+            while upcoming and upcoming[0] <= clock:
+                created, qty, tier = upcoming
+                heapq.heappush(heap, (key(created, qty, tier), created, qty, tier))
+                upcoming = next(pending, None)
+            _, created, qty, tier = heapq.heappop(heap)
+            start, clock = gate_work(clock, qty / capacity, open_hour, close_hour)
+            waits.append(start - created)
+            by_tier[tier].append(start - created)
+
+        waits.sort()
+        tier_avgs = ", ".join(
+            f"tier {tier} {sum(w) / len(w):.1f}h" for tier, w in by_tier.items() if w
+        )
+        click.echo(
+            f"{name:>8}: avg wait {sum(waits) / len(waits):.1f}h, "
+            f"p90 {waits[int(len(waits) * 0.9)]:.1f}h, max {waits[-1]:.1f}h ({tier_avgs})"
+        )
+
+# ---------------- EXCHANGE ----------------
+# Buyers post bids (crop, quantity, max price); miller_stock lots with
+# quantity left are the asks. Each crop has an in-memory book of two heaps
+# matched with price-time priority, and every fill becomes a pending
+# miller_bookings row at the lot's posted price.
+def upgrade_exchange():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS buyer_bids (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            buyer_id INTEGER,
+            crop TEXT,
+            quantity INTEGER,
+            remaining INTEGER,
+            max_price INTEGER,
+            status TEXT DEFAULT 'open',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_buyer_bids_status_crop
+        ON buyer_bids (status, crop)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_miller_stock_crop
+        ON miller_stock (crop, quantity)
+    """)
+
+    cur.execute("PRAGMA table_info(miller_bookings)")
+    cols = [c[1] for c in cur.fetchall()]
+
+    if "bid_id" not in cols:
+        cur.execute("ALTER TABLE miller_bookings ADD COLUMN bid_id INTEGER")
+
+    add_version_triggers(cur, "buyer_bids")
+
+    # per-crop change counters, so a write to one crop's lots or bids
+    # doesn't invalidate every other crop's cached book
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS exchange_crop_versions (
+            crop TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    bump = """
+        INSERT INTO exchange_crop_versions (crop, version) VALUES ({crop}, 1)
+        ON CONFLICT(crop) DO UPDATE SET version = version + 1;
+    """
+    for table in ("miller_stock", "buyer_bids"):
+        for event, crops in (
+            ("INSERT", ("NEW.crop",)),
+            ("UPDATE", ("OLD.crop", "NEW.crop")),
+            ("DELETE", ("OLD.crop",)),
+        ):
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_crop_version_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    {"".join(bump.format(crop=crop) for crop in crops)}
+                END
+            """)
+
+    con.commit()
+    con.close()
+
+upgrade_exchange()
+
+class OrderBook:
+    """Bids and asks for one crop.
+
+    Heaps hold (price key, arrival seq, id); remaining quantities live in
+    dicts, so cancelled or exhausted orders are simply skipped when they
+    reach the top of a heap.
+    """
+
+    def __init__(self, crop):
+        self.crop = crop
+        self.bids = []
+        self.asks = []
+        self.bid_qty = {}
+        self.ask_qty = {}
+        self.seq = itertools.count()
+        self.version = None
+
+    def add_bid(self, bid_id, max_price, qty):
+        heapq.heappush(self.bids, (-max_price, next(self.seq), bid_id))
+        self.bid_qty[bid_id] = qty
+
+    def add_ask(self, stock_id, price, qty):
+        heapq.heappush(self.asks, (price, next(self.seq), stock_id))
+        self.ask_qty[stock_id] = qty
+
+    def cancel_bid(self, bid_id):
+        self.bid_qty.pop(bid_id, None)
+
+    def _top(self, heap, live):
+        while heap and heap[0][2] not in live:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def match(self):
+        """Cross the book; returns [(bid_id, stock_id, qty, price)]."""
+        fills = []
+        while True:
+            bid = self._top(self.bids, self.bid_qty)
+            ask = self._top(self.asks, self.ask_qty)
+            if bid is None or ask is None or -bid[0] < ask[0]:
+                return fills
+
+            bid_id, stock_id, price = bid[2], ask[2], ask[0]
+            qty = min(self.bid_qty[bid_id], self.ask_qty[stock_id])
+            fills.append((bid_id, stock_id, qty, price))
+
+            self.bid_qty[bid_id] -= qty
+            if not self.bid_qty[bid_id]:
+                del self.bid_qty[bid_id]
+            self.ask_qty[stock_id] -= qty
+            if not self.ask_qty[stock_id]:
+                del self.ask_qty[stock_id]
+
+    def depth(self, levels=10):
+        bids, asks = {}, {}
+        for neg_price, _, bid_id in self.bids:
+            if bid_id in self.bid_qty:
+                bids[-neg_price] = bids.get(-neg_price, 0) + self.bid_qty[bid_id]
+        for price, _, stock_id in self.asks:
+            if stock_id in self.ask_qty:
+                asks[price] = asks.get(price, 0) + self.ask_qty[stock_id]
+        return {
+            "bids": sorted(bids.items(), reverse=True)[:levels],
+            "asks": sorted(asks.items())[:levels],
+        }
+
+class MatchingEngine:
+    """Keeps one OrderBook per crop in sync with the database.
+
+    All matching happens under BEGIN IMMEDIATE. A book is reloaded whenever
+    its crop's change counter moved since it was last synced (a direct
+    booking, a stock edit, another worker), so it never matches against
+    stale quantities; writes to other crops leave it cached.
+    """
+
+    def __init__(self):
+        self.books = {}
+        self.lock = threading.Lock()
+
+    def _version(self, cur, crop):
+        cur.execute("SELECT version FROM exchange_crop_versions WHERE crop=?", (crop,))
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+    def _book(self, cur, crop):
+        book = self.books.get(crop)
+        if book is not None and book.version == self._version(cur, crop):
+            return book
+
+        book = OrderBook(crop)
+        cur.execute("""
+            SELECT id, max_price, remaining FROM buyer_bids
+            WHERE status='open' AND crop=?
+            ORDER BY created_at, id
+        """, (crop,))
+        for bid_id, max_price, remaining in cur.fetchall():
+            book.add_bid(bid_id, max_price, remaining)
+
+        cur.execute("""
+            SELECT id, price, quantity FROM miller_stock
+            WHERE crop=? AND quantity > 0
+            ORDER BY created_at, id
+        """, (crop,))
+        for stock_id, price, qty in cur.fetchall():
+            book.add_ask(stock_id, price, qty)
+
+        self.books[crop] = book
+        return book
+
+    def _apply_fills(self, cur, fills):
+        for bid_id, stock_id, qty, price in fills:
+            cur.execute("""
+                UPDATE miller_stock SET quantity=quantity-?
+                WHERE id=? AND quantity>=?
+            """, (qty, stock_id, qty))
+            if cur.rowcount != 1:
+                raise RuntimeError(f"stock {stock_id} changed under the order book")
+
+            cur.execute("""
+                UPDATE buyer_bids
+                SET remaining=remaining-?,
+                    status=CASE WHEN remaining-?=0 THEN 'filled' ELSE status END
+                WHERE id=?
+            """, (qty, qty, bid_id))
+            # the fill price is what approval bills, whatever the lot costs by then
+            cur.execute("""
+                INSERT INTO miller_bookings
+                (stock_id, buyer_id, quantity, status, order_id, bid_id, expires_at, agreed_price)
+                SELECT ?, buyer_id, ?, 'pending', ?, id, datetime('now', ?), ?
+                FROM buyer_bids WHERE id=?
+            """, (stock_id, qty, generate_next_order_id(cur), reservation_ttl(), price, bid_id))
+
+    def _run(self, crop, action):
+        """Run action(cur, book) and the matching it triggers in one transaction."""
+        with self.lock:
+            con = get_db()
+            cur = con.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                book = self._book(cur, crop)
+                result = action(cur, book)
+                fills = book.match()
+                self._apply_fills(cur, fills)
+                book.version = self._version(cur, crop)
+                con.commit()
+            except Exception:
+                con.rollback()
+                self.books.pop(crop, None)
+                raise
+            finally:
+                con.close()
+            return result, fills
+
+    def submit_bid(self, buyer_id, crop, qty, max_price):
+        def add(cur, book):
+            cur.execute("""
+                INSERT INTO buyer_bids (buyer_id, crop, quantity, remaining, max_price)
+                VALUES (?,?,?,?,?)
+            """, (buyer_id, crop, qty, qty, max_price))
+            book.add_bid(cur.lastrowid, max_price, qty)
+            return cur.lastrowid
+
+        return self._run(crop, add)
+
+    def cancel_bid(self, buyer_id, bid_id):
+        con = get_db()
+        cur = con.cursor()
+        cur.execute("SELECT crop FROM buyer_bids WHERE id=? AND buyer_id=?", (bid_id, buyer_id))
+        row = cur.fetchone()
+        con.close()
+        if not row:
+            return False
+
+        def cancel(cur, book):
+            cur.execute("""
+                UPDATE buyer_bids SET status='cancelled'
+                WHERE id=? AND status='open'
+            """, (bid_id,))
+            book.cancel_bid(bid_id)
+            return cur.rowcount == 1
+
+        return self._run(row[0], cancel)[0]
+
+    def match_crop(self, crop):
+        """Match resting bids after stock for `crop` was posted or repriced."""
+        con = get_db()
+        cur = con.cursor()
+        cur.execute("SELECT 1 FROM buyer_bids WHERE status='open' AND crop=? LIMIT 1", (crop,))
+        has_bids = cur.fetchone()
+        con.close()
+        if not has_bids:
+            return []
+        return self._run(crop, lambda cur, book: None)[1]
+
+    def depth(self, crop):
+        with self.lock:
+            con = get_db()
+            book = self._book(con.cursor(), crop)
+            con.close()
+            return book.depth()
+
+exchange = MatchingEngine()
+
+@app.cli.command("bench-orderbook")
+@click.option("--orders", default=200000, help="Number of bids and asks to submit.")
+@click.option("--crops", default=5, help="Number of independent books.")
+def bench_orderbook(orders, crops):
+    """Measure in-memory matching throughput (orders/sec)."""
+    rng = random.Random(42)
+    books = [OrderBook(f"crop{i}") for i in range(crops)]
+    fills = 0
+
+    start = time.perf_counter()
+    for order_id in range(orders):
+        book = books[order_id % crops]
+        price = rng.randint(1900, 2100)
+        qty = rng.randint(10, 500)
+        if rng.random() < 0.5:
+            book.add_bid(order_id, price, qty)
+        else:
+            book.add_ask(order_id, price, qty)
+        fills += len(book.match())
+    elapsed = time.perf_counter() - start
+
+    click.echo(f"{orders} orders, {fills} fills in {elapsed:.2f}s "
+               f"-> {orders / elapsed:,.0f} orders/s")
+
+# ---------------- FILL ORDERS ----------------
+FILL_FETCH_SIZE = 100
+
+def upgrade_fill_orders():
+    con = get_db()
+    cur = con.cursor()
+
+    # cheapest effective price first among the lots that still have stock
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_miller_stock_effective_price
+        ON miller_stock (crop, (price - COALESCE(deduction, 0)), id)
+        WHERE quantity > 0
+    """)
+
+    # generate_next_order_id() reads the highest S-number on every booking
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_miller_bookings_order_number
+        ON miller_bookings (CAST(SUBSTR(order_id, 2) AS INTEGER))
+        WHERE order_id LIKE 'S%'
+    """)
+
+    con.commit()
+    con.close()
+
+upgrade_fill_orders()
+
+def fill_order(con, buyer_id, crop, qty, max_price=None, allow_partial=False):
+    """Book `qty` of `crop` across the cheapest lots in one write transaction.
+
+    Lots are taken by effective price (price - deduction). Every booking
+    shares one order ID. Returns (order_id, [(stock_id, qty, effective)]);
+    order_id is None when the quantity can't be met and allow_partial is
+    off, in which case nothing is booked.
+    """
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("""
+            SELECT id, quantity, price - COALESCE(deduction, 0), price
+            FROM miller_stock INDEXED BY idx_miller_stock_effective_price
+            WHERE crop=? AND quantity > 0
+            ORDER BY price - COALESCE(deduction, 0), id
+        """, (crop,))
+
+        picks = []
+        prices = {}
+        need = qty
+        too_dear = False
+        while need and not too_dear:
+            rows = cur.fetchmany(FILL_FETCH_SIZE)
+            if not rows:
+                break
+            for stock_id, available, effective, price in rows:
+                if max_price is not None and effective > max_price:
+                    too_dear = True   # rows are sorted, the rest cost more
+                    break
+                take = min(available, need)
+                picks.append((stock_id, take, effective))
+                prices[stock_id] = price
+                need -= take
+                if not need:
+                    break
+
+        if not picks or (need and not allow_partial):
+            con.rollback()
+            return None, picks
+
+        # nobody else can write while we hold the lock, but keep the guard
+        cur.executemany("""
+            UPDATE miller_stock SET quantity=quantity-?
+            WHERE id=? AND quantity>=?
+        """, [(take, stock_id, take) for stock_id, take, _ in picks])
+        if cur.rowcount != len(picks):
+            raise RuntimeError("lot quantities changed during fill")
+
+        # bill at the lot price the fill was priced on, even if it's repriced
+        order_id = generate_next_order_id(cur)
+        cur.executemany("""
+            INSERT INTO miller_bookings (stock_id, buyer_id, quantity, status, order_id, expires_at, agreed_price)
+            VALUES (?,?,?, 'pending', ?, datetime('now', ?), ?)
+        """, [
+            (stock_id, buyer_id, take, order_id, reservation_ttl(), prices[stock_id])
+            for stock_id, take, _ in picks
+        ])
+
+        con.commit()
+        return order_id, picks
+    except Exception:
+        con.rollback()
+        raise
+
+@app.cli.command("bench-fill-order")
+@click.option("--lots", default=10000, help="Competing lots of one crop.")
+@click.option("--orders", default=2000, help="Fill orders to place.")
+@click.option("--threads", default=4, help="Concurrent buyers.")
+def bench_fill_order(lots, orders, threads):
+    """Fill orders against competing lots on a scratch copy of the schema."""
+    con = get_db()
+    schema = [
+        row[0] for row in con.execute("""
+            SELECT sql FROM sqlite_master
+            WHERE tbl_name IN ('miller_stock', 'miller_bookings')
+              AND type IN ('table', 'index') AND sql IS NOT NULL
+        """)
+    ]
+    con.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        con = sqlite3.connect(path)
+        con.execute("PRAGMA journal_mode=WAL")
+        for sql in schema:
+            con.execute(sql)
+        rng = random.Random(7)
+        con.executemany("""
+            INSERT INTO miller_stock (miller_id, crop, quantity, price, deduction)
+            VALUES (?, 'paddy', ?, ?, ?)
+        """, [(i % 500, rng.randint(50, 500), rng.randint(1900, 2300), rng.randint(0, 30))
+              for i in range(lots)])
+        con.commit()
+        cur = con.execute("SELECT SUM(quantity) FROM miller_stock")
+        stock_before = cur.fetchone()[0]
+        con.close()
+
+        booked = []
+        def buyer(n):
+            con = sqlite3.connect(path, timeout=30)
+            for i in range(n):
+                order_id, picks = fill_order(con, i, "paddy", rng.randint(100, 800))
+                if order_id:
+                    booked.append(sum(p[1] for p in picks))
+            con.close()
+
+        start = time.perf_counter()
+        workers = [
+            threading.Thread(target=buyer, args=(orders // threads,))
+            for _ in range(threads)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+
+        con = sqlite3.connect(path)
+        stock_after = con.execute("SELECT SUM(quantity) FROM miller_stock").fetchone()[0]
+        con.close()
+
+    click.echo(f"{len(booked)} orders filled in {elapsed:.2f}s -> {len(booked) / elapsed:,.0f} orders/s")
+    click.echo(f"stock booked {stock_before - stock_after}, bookings total {sum(booked)}")
+
+# ---------------- BACKGROUND JOBS ----------------
+background_jobs = queue.Queue()
+
+def background_worker():
+    while True:
+        func, args = background_jobs.get()
+        try:
+            func(*args)
+        except Exception:
+            app.logger.exception("Background job %s failed", func.__name__)
+        finally:
+            background_jobs.task_done()
+
+def run_in_background(func, *args):
+    """Queue func(*args) to run outside the request on the worker thread."""
+    background_jobs.put((func, args))
+
+threading.Thread(target=background_worker, daemon=True).start()
+
+# ---------------- BILL PREVIEWS ----------------
+def bill_preview_name(filename):
+    return os.path.splitext(filename)[0] + ".png"
+
+def _is_fresh(path, src_mtime):
+    return os.path.exists(path) and os.path.getmtime(path) >= src_mtime
+
+def process_bill(filename):
+    """Render the first-page PNG preview and an optimized copy of a bill PDF.
+
+    Outputs are cached next to the bills and only rebuilt when the uploaded
+    file is newer. PyMuPDF does the rendering; qpdf/pdftoppm are used when
+    they are installed instead.
+    """
+    src = os.path.join(app.config["BILL_FOLDER"], filename)
+    if not filename.lower().endswith(".pdf") or not os.path.isfile(src):
+        return
+
+    src_mtime = os.path.getmtime(src)
+    preview = os.path.join(app.config["BILL_PREVIEW_FOLDER"], bill_preview_name(filename))
+    optimized = os.path.join(app.config["BILL_OPTIMIZED_FOLDER"], filename)
+
+    if _is_fresh(preview, src_mtime) and _is_fresh(optimized, src_mtime):
+        return
+
+    if not _is_fresh(preview, src_mtime):
+        tmp = preview + ".tmp.png"
+        if fitz is not None:
+            with fitz.open(src) as doc:
+                if not doc.page_count:
+                    return
+                doc[0].get_pixmap(dpi=BILL_PREVIEW_DPI).save(tmp)
+        elif shutil.which("pdftoppm"):
+            subprocess.run([
+                "pdftoppm", "-png", "-singlefile", "-f", "1", "-l", "1",
+                "-r", str(BILL_PREVIEW_DPI), src, tmp[:-4]
+            ], check=True, capture_output=True)
+        else:
+            app.logger.warning("No PDF renderer installed, skipping preview for %s", filename)
+            tmp = None
+        if tmp:
+            os.replace(tmp, preview)
+
+    if not _is_fresh(optimized, src_mtime):
+        tmp = optimized + ".tmp"
+        if shutil.which("qpdf"):
+            # linearized ("fast web view") so browsers can show page 1 early
+            subprocess.run([
+                "qpdf", "--linearize", "--object-streams=generate",
+                "--compress-streams=y", src, tmp
+            ], check=False, capture_output=True)
+        elif fitz is not None:
+            with fitz.open(src) as doc:
+                doc.save(tmp, garbage=4, deflate=True, clean=True)
+
+        # keep the original bytes when optimizing doesn't make it smaller
+        if not os.path.exists(tmp) or os.path.getsize(tmp) >= os.path.getsize(src):
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, optimized)
+
+    # pages that link bills must stop answering 304 now that the files changed
+    bump_table_version("bill_files")
+
+def backfill_bill_previews():
+    for filename in os.listdir(app.config["BILL_FOLDER"]):
+        if not os.path.isfile(os.path.join(app.config["BILL_FOLDER"], filename)):
+            continue
+        # one unreadable bill shouldn't stop the rest from getting previews
+        try:
+            process_bill(filename)
+        except Exception:
+            app.logger.exception("Bill preview failed for %s", filename)
+
+def bill_files(filename):
+    """URLs for a bill: cached preview (or None) and the best PDF to download."""
+    preview_name = bill_preview_name(filename)
+    preview = None
+    if os.path.exists(os.path.join(app.config["BILL_PREVIEW_FOLDER"], preview_name)):
+        preview = url_for("static", filename="uploads/bills/previews/" + preview_name)
+
+    if os.path.exists(os.path.join(app.config["BILL_OPTIMIZED_FOLDER"], filename)):
+        pdf = url_for("static", filename="uploads/bills/optimized/" + filename)
+    else:
+        pdf = url_for("static", filename="uploads/bills/" + filename)
+
+    return {"preview": preview, "pdf": pdf}
+
+def bill_previews_for(rows, bill_index):
+    """Map bill filename -> bill_files() for the bookings being rendered."""
+    return {
+        row[bill_index]: bill_files(row[bill_index])
+        for row in rows
+        if row[bill_index]
+    }
+
+run_in_background(backfill_bill_previews)
+
+# ---------------- INVOICES ----------------
+# An invoice is numbered once, when first issued (INV-YYYYMM-NNNNN by
+# loading month), and rendered to PDF once per version of its data. The
+# version is a hash of the invoice row, so a PDF is only re-rendered when
+# something printed on it changes. PDFs live outside static/ because they
+# are private to the buyer.
+INVOICE_SQL = """
+    SELECT
+        mb.id,                 -- invoice id
+        buyer.name,            -- buyer
+        miller.name,           -- miller
+        ms.crop,               -- crop
+        mb.quantity,           -- quantity
+        COALESCE(mb.agreed_price, ms.price), -- price
+        mb.loaded_at,          -- date
+        mb.order_id            -- order
+    FROM miller_bookings mb
+    JOIN miller_stock ms ON mb.stock_id = ms.id
+    JOIN users buyer ON mb.buyer_id = buyer.id
+    JOIN users miller ON ms.miller_id = miller.id
+    WHERE mb.truck_status='loaded'
+"""
+
+def upgrade_invoices():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS invoices (
+            booking_id INTEGER PRIMARY KEY,
+            invoice_no TEXT UNIQUE NOT NULL,
+            issued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            data_version TEXT,
+            filename TEXT,
+            rendered_at DATETIME
+        )
+    """)
+
+    con.commit()
+    con.close()
+
+upgrade_invoices()
+
+def invoice_version(row):
+    return hashlib.sha1(repr(tuple(row)).encode()).hexdigest()[:16]
+
+def assign_invoice_numbers(cur, rows):
+    """Number the invoices in `rows` that don't have one yet.
+
+    Runs inside the caller's write transaction; returns {booking_id: number}.
+    """
+    ids = [row[0] for row in rows]
+    numbers = {}
+    for i in range(0, len(ids), SQL_BATCH):
+        chunk = ids[i:i + SQL_BATCH]
+        cur.execute(f"""
+            SELECT booking_id, invoice_no FROM invoices
+            WHERE booking_id IN ({",".join("?" * len(chunk))})
+        """, chunk)
+        numbers.update(cur.fetchall())
+
+    next_seq = {}
+    for row in sorted(rows, key=lambda r: (r[6] or "", r[0])):
+        if row[0] in numbers:
+            continue
+        prefix = "INV-" + (row[6] or "")[:7].replace("-", "")
+        if prefix not in next_seq:
+            cur.execute("""
+                SELECT COUNT(*) FROM invoices WHERE invoice_no LIKE ?
+            """, (prefix + "-%",))
+            next_seq[prefix] = cur.fetchone()[0] + 1
+        number = f"{prefix}-{next_seq[prefix]:05d}"
+        next_seq[prefix] += 1
+        cur.execute(
+            "INSERT INTO invoices (booking_id, invoice_no) VALUES (?, ?)",
+            (row[0], number)
+        )
+        numbers[row[0]] = number
+    return numbers
+
+def render_invoice_pdf(invoice_no, row):
+    """PDF bytes for one invoice row. WeasyPrint renders invoice.html;
+    PyMuPDF lays out a plain text invoice when WeasyPrint isn't installed."""
+    if weasyprint is not None:
+        with app.app_context():
+            html = render_template("invoice.html", invoice=row, invoice_no=invoice_no, pdf=True)
+        return weasyprint.HTML(string=html, base_url=app.root_path).write_pdf()
+
+    if fitz is None:
+        raise RuntimeError("No PDF renderer installed (weasyprint or PyMuPDF)")
+
+    booking_id, buyer, miller, crop, qty, price, loaded_at, order_id = row
+    lines = [
+        f"Invoice {invoice_no}",
+        f"Date: {loaded_at}",
+        f"Order: {order_id or booking_id}",
+        "",
+        f"Seller: {miller}",
+        f"Buyer: {buyer}",
+        "",
+        f"{crop}: {qty} qtl x Rs {price} = Rs {qty * price}",
+    ]
+    with fitz.open() as doc:
+        page = doc.new_page()
+        page.insert_text((72, 72), "\n".join(lines), fontsize=12)
+        return doc.tobytes(garbage=4, deflate=True)
+
+def write_invoice_pdf(job):
+    """Render one invoice to its cache file; runs in the process pool."""
+    invoice_no, row, path = job
+    # a temp file of its own, so two renders of one invoice can't mix
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(render_invoice_pdf(invoice_no, row))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return row[0]
+
+def prepare_invoices(con, where, params):
+    """Number the matching loaded bookings and list the PDFs to (re)render.
+
+    Returns [(booking_id, invoice_no, path)] for every matching invoice and
+    the render jobs for the ones whose cached PDF is missing or stale.
+    """
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute(INVOICE_SQL + where + " ORDER BY mb.loaded_at, mb.id", params)
+        rows = cur.fetchall()
+        numbers = assign_invoice_numbers(cur, rows)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+    cached = {}
+    ids = [row[0] for row in rows]
+    for i in range(0, len(ids), SQL_BATCH):
+        chunk = ids[i:i + SQL_BATCH]
+        cur.execute(f"""
+            SELECT booking_id, data_version FROM invoices
+            WHERE booking_id IN ({",".join("?" * len(chunk))})
+        """, chunk)
+        cached.update(cur.fetchall())
+
+    invoices = []
+    jobs = []
+    for row in rows:
+        number = numbers[row[0]]
+        version = invoice_version(row)
+        path = os.path.join(app.config["INVOICE_FOLDER"], f"{number}-{version}.pdf")
+        invoices.append((row[0], number, path))
+        if cached.get(row[0]) != version or not os.path.exists(path):
+            jobs.append((number, row, path))
+    return invoices, jobs
+
+def mark_invoices_rendered(con, jobs):
+    cur = con.cursor()
+    for _, row, path in jobs:
+        # drop the PDF of the previous data version
+        cur.execute("SELECT filename FROM invoices WHERE booking_id=?", (row[0],))
+        old = cur.fetchone()[0]
+        if old and old != os.path.basename(path):
+            try:
+                os.remove(os.path.join(app.config["INVOICE_FOLDER"], old))
+            except FileNotFoundError:
+                pass
+
+    cur.executemany("""
+        UPDATE invoices
+        SET data_version=?, filename=?, rendered_at=CURRENT_TIMESTAMP
+        WHERE booking_id=?
+    """, [(invoice_version(row), os.path.basename(path), row[0]) for _, row, path in jobs])
+    con.commit()
+
+def invoice_pdf_path(booking_id, buyer_id=None):
+    """Cached PDF for one loaded booking, rendering it if needed."""
+    where, params = " AND mb.id=?", [booking_id]
+    if buyer_id is not None:
+        where += " AND mb.buyer_id=?"
+        params.append(buyer_id)
+
+    con = get_db()
+    invoices, jobs = prepare_invoices(con, where, params)
+    for job in jobs:
+        write_invoice_pdf(job)
+    mark_invoices_rendered(con, jobs)
+    con.close()
+
+    return invoices[0] if invoices else None
+
+def build_invoices(month, buyer_id=None, workers=None):
+    """Render every invoice for loads in `month` (YYYY-MM) across a process pool."""
+    where, params = " AND strftime('%Y-%m', mb.loaded_at)=?", [month]
+    if buyer_id is not None:
+        where += " AND mb.buyer_id=?"
+        params.append(buyer_id)
+
+    con = get_db()
+    invoices, jobs = prepare_invoices(con, where, params)
+    if len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(write_invoice_pdf, jobs, chunksize=8))
+    else:
+        for job in jobs:
+            write_invoice_pdf(job)
+    mark_invoices_rendered(con, jobs)
+    con.close()
+
+    return invoices, len(jobs)
+
+class _ZipStream:
+    """Write-only file object collecting what ZipFile writes, so each
+    member can be sent as soon as it's added."""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_invoice_zip(invoices, jobs=()):
+    """ZIP the invoices, rendering the stale ones one at a time as they
+    are reached, so the first bytes go out before the month is rendered."""
+    pending = {job[1][0]: job for job in jobs}
+    rendered = []
+    out = _ZipStream()
+    try:
+        # PDFs are already deflated, so store them as they are
+        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zf:
+            for booking_id, number, path in invoices:
+                if booking_id in pending:
+                    write_invoice_pdf(pending[booking_id])
+                    rendered.append(pending[booking_id])
+                with open(path, "rb") as src, zf.open(f"{number}.pdf", "w", force_zip64=True) as dst:
+                    shutil.copyfileobj(src, dst, 64 * 1024)
+                yield out.drain()
+        yield out.drain()
+    finally:
+        if rendered:
+            con = get_db()
+            mark_invoices_rendered(con, rendered)
+            con.close()
+
+@app.cli.command("build-invoices")
+@click.argument("month")
+@click.option("--workers", default=None, type=int, help="Render processes (default: CPU count).")
+def build_invoices_command(month, workers):
+    """Render all invoices for MONTH (YYYY-MM) into the invoice cache."""
+    start = time.perf_counter()
+    invoices, rendered = build_invoices(month, workers=workers)
+    elapsed = time.perf_counter() - start
+    click.echo(f"{len(invoices)} invoices for {month}, {rendered} rendered in {elapsed:.2f}s")
+
+# ---------------- STATEMENTS ----------------
+# Loaded bookings are billed in the month they were loaded, at
+# quantity * lot price, the same amount the invoice shows. Brokerage on
+# each booking's value is tiered like income tax: every COMMISSION_SLABS
+# band is charged its own rate, so commission never drops as a booking
+# crosses a slab. It is split between buyer and miller. party_statements
+# holds one row per party and month; triggers record which months a write
+# touched and only those are recomputed.
+COMMISSION_SLABS = np.array([0, 100000, 500000, 2000000])    # booking value (Rs) from
+COMMISSION_RATES = np.array([0.010, 0.0075, 0.005, 0.0035])  # share of value in the band
+# commission on the value below each slab
+COMMISSION_BASE = np.concatenate(([0.0], np.cumsum(np.diff(COMMISSION_SLABS) * COMMISSION_RATES[:-1])))
+BUYER_COMMISSION_SHARE = 0.5
+# bump when the commission formula changes; stored lines are then recomputed
+COMMISSION_SCHEME = "tiered"
+
+def commission_scheme_changed(cur, consumer):
+    """True, once, when `consumer` was computed under another COMMISSION_SCHEME."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS commission_schemes (
+            consumer TEXT PRIMARY KEY,
+            scheme TEXT NOT NULL
+        )
+    """)
+    cur.execute("SELECT scheme FROM commission_schemes WHERE consumer=?", (consumer,))
+    row = cur.fetchone()
+    if row and row[0] == COMMISSION_SCHEME:
+        return False
+    cur.execute(
+        "INSERT OR REPLACE INTO commission_schemes (consumer, scheme) VALUES (?, ?)",
+        (consumer, COMMISSION_SCHEME)
+    )
+    return True
+
+def upgrade_statements():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS party_statements (
+            role TEXT NOT NULL,
+            party_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            bookings INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            gross INTEGER NOT NULL,
+            commission REAL NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (role, party_id, period)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS statement_dirty_periods (
+            period TEXT PRIMARY KEY
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_miller_bookings_loaded_month
+        ON miller_bookings (strftime('%Y-%m', loaded_at))
+        WHERE truck_status='loaded'
+    """)
+
+    cur.execute("SELECT COUNT(*) FROM party_statements")
+    empty = not cur.fetchone()[0]
+    if commission_scheme_changed(cur, "party_statements") or empty:
+        cur.execute("""
+            INSERT OR IGNORE INTO statement_dirty_periods (period)
+            SELECT DISTINCT strftime('%Y-%m', loaded_at)
+            FROM miller_bookings
+            WHERE truck_status='loaded' AND loaded_at IS NOT NULL
+        """)
+
+    mark = """
+        INSERT OR IGNORE INTO statement_dirty_periods (period)
+        SELECT strftime('%Y-%m', {row}.loaded_at) WHERE {row}.loaded_at IS NOT NULL;
+    """
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS statements_booking_insert
+        AFTER INSERT ON miller_bookings
+        BEGIN {mark.format(row="NEW")} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS statements_booking_update
+        AFTER UPDATE OF quantity, stock_id, buyer_id, truck_status, loaded_at ON miller_bookings
+        BEGIN {mark.format(row="OLD")} {mark.format(row="NEW")} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS statements_booking_delete
+        AFTER DELETE ON miller_bookings
+        BEGIN {mark.format(row="OLD")} END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS statements_price_update
+        AFTER UPDATE OF price, miller_id ON miller_stock
+        BEGIN
+            INSERT OR IGNORE INTO statement_dirty_periods (period)
+            SELECT DISTINCT strftime('%Y-%m', loaded_at)
+            FROM miller_bookings
+            WHERE stock_id = NEW.id AND truck_status='loaded' AND loaded_at IS NOT NULL;
+        END
+    """)
+
+    add_version_triggers(cur, "party_statements")
+
+    con.commit()
+    con.close()
+
+upgrade_statements()
+
+def commission_for(values):
+    """Brokerage on each booking value, each slab's band at its own rate."""
+    values = np.asarray(values, dtype=np.float64)
+    slab = np.clip(np.searchsorted(COMMISSION_SLABS, values, side="right") - 1, 0, None)
+    return COMMISSION_BASE[slab] + (values - COMMISSION_SLABS[slab]) * COMMISSION_RATES[slab]
+
+def billable_rows(rows, period, purpose):
+    """Rows ending in (quantity, price) with both read as floats.
+
+    Legacy rows keep quantity/price as TEXT; rows that don't parse are
+    logged and left out.
+    """
+    parsed = []
+    for row in rows:
+        *keys, quantity, price = row
+        try:
+            parsed.append((*keys, float(quantity), float(price)))
+        except (TypeError, ValueError):
+            app.logger.warning(
+                "booking %s left out of %s %s: quantity %r, price %r",
+                keys[0], period, purpose, quantity, price,
+            )
+    return parsed
+
+def period_extract(cur, period):
+    """Columnar arrays of the bookings billed in `period`."""
+    cur.execute("""
+        SELECT mb.id, mb.buyer_id, ms.miller_id, mb.quantity, COALESCE(mb.agreed_price, ms.price)
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.truck_status='loaded'
+          AND strftime('%Y-%m', mb.loaded_at)=?
+    """, (period,))
+
+    rows = billable_rows(cur.fetchall(), period, "statements")
+    ids, buyers, millers = np.array([r[:3] for r in rows], dtype=np.int64).reshape(-1, 3).T
+    qty, price = np.array([r[3:] for r in rows], dtype=np.float64).reshape(-1, 2).T
+    return ids, buyers, millers, qty, qty * price
+
+def party_totals(parties, qty, gross, commission):
+    """(party, bookings, quantity, gross, commission) per distinct party."""
+    keys, inverse = np.unique(parties, return_inverse=True)
+    return zip(
+        keys.tolist(),
+        np.bincount(inverse, minlength=len(keys)).tolist(),
+        np.bincount(inverse, weights=qty, minlength=len(keys)).astype(np.int64).tolist(),
+        np.bincount(inverse, weights=gross, minlength=len(keys)).astype(np.int64).tolist(),
+        np.round(np.bincount(inverse, weights=commission, minlength=len(keys)), 2).tolist(),
+    )
+
+def period_statement_rows(cur, period):
+    """(role, party_id, period, bookings, quantity, gross, commission) rows for one month."""
+    _, buyers, millers, qty, gross = period_extract(cur, period)
+    commission = commission_for(gross)
+    rows = []
+    for role, parties, share in (
+        ("buyer", buyers, BUYER_COMMISSION_SHARE),
+        ("miller", millers, 1 - BUYER_COMMISSION_SHARE),
+    ):
+        rows.extend(
+            (role, party, period, count, q, g, c)
+            for party, count, q, g, c in party_totals(parties, qty, gross, commission * share)
+        )
+    return rows
+
+def statements_stale(cur, period):
+    """Whether `period` changed since party_statements was last refreshed."""
+    cur.execute("SELECT 1 FROM statement_dirty_periods WHERE period=?", (period,))
+    return cur.fetchone() is not None
+
+def refresh_statements_job():
+    con = get_db()
+    refresh_statements(con)
+    con.close()
+
+def refresh_statements(con):
+    """Recompute party_statements for the periods marked dirty."""
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT period FROM statement_dirty_periods")
+        periods = [row[0] for row in cur.fetchall()]
+
+        for period in periods:
+            rows = period_statement_rows(cur, period)
+            cur.execute("DELETE FROM party_statements WHERE period=?", (period,))
+            cur.executemany("""
+                INSERT INTO party_statements
+                (role, party_id, period, bookings, quantity, gross, commission)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+
+        cur.execute("DELETE FROM statement_dirty_periods")
+        con.commit()
+        return periods
+    except Exception:
+        con.rollback()
+        raise
+
+@app.cli.command("rebuild-statements")
+def rebuild_statements():
+    """Recompute every period's party statements."""
+    con = get_db()
+    con.execute("""
+        INSERT OR IGNORE INTO statement_dirty_periods (period)
+        SELECT DISTINCT strftime('%Y-%m', loaded_at)
+        FROM miller_bookings
+        WHERE truck_status='loaded' AND loaded_at IS NOT NULL
+    """)
+    con.commit()
+    start = time.perf_counter()
+    periods = refresh_statements(con)
+    con.close()
+    click.echo(f"{len(periods)} periods rebuilt in {time.perf_counter() - start:.2f}s")
+
+# ---------------- LEDGER ----------------
+# Double-entry journal in paise (debit positive, credit negative). Approving
+# a booking commits its value (committed_receivable for the buyer,
+# committed_payable for the miller); declining it after approval reverses
+# what is still committed. Goods become money owed as they are loaded:
+# every loading event moves its value out of the commitment, debits the
+# buyer's receivable, credits the miller's payable and credits the broker's
+# commission, using the statement slab rates. journal_entries is
+# append-only; a trigger keeps party_balances current, so a balance is a
+# primary key lookup however long the journal gets. Snapshots of
+# party_balances let the verifier replay only entries written since.
+LEDGER_SNAPSHOT_INTERVAL = 24 * 3600
+BROKER_PARTY = 0
+
+def upgrade_ledger():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS journal_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            txn_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            booking_id INTEGER,
+            account TEXT NOT NULL,
+            party_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            posted_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_journal_party
+        ON journal_entries (account, party_id, id)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_journal_txn
+        ON journal_entries (txn_id)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_journal_booking
+        ON journal_entries (booking_id, account)
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS party_balances (
+            account TEXT NOT NULL,
+            party_id INTEGER NOT NULL,
+            balance INTEGER NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            last_entry_id INTEGER,
+            PRIMARY KEY (account, party_id)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            upto_entry_id INTEGER NOT NULL,
+            taken_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_snapshot_balances (
+            snapshot_id INTEGER NOT NULL,
+            account TEXT NOT NULL,
+            party_id INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            PRIMARY KEY (snapshot_id, account, party_id)
+        )
+    """)
+
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS journal_entries_balance
+        AFTER INSERT ON journal_entries
+        BEGIN
+            INSERT INTO party_balances (account, party_id, balance, entries, last_entry_id)
+            VALUES (NEW.account, NEW.party_id, NEW.amount, 1, NEW.id)
+            ON CONFLICT(account, party_id) DO UPDATE SET
+                balance = balance + NEW.amount,
+                entries = entries + 1,
+                last_entry_id = NEW.id;
+        END
+    """)
+    for event in ("UPDATE", "DELETE"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS journal_entries_no_{event.lower()}
+            BEFORE {event} ON journal_entries
+            BEGIN
+                SELECT RAISE(ABORT, 'journal entries are append-only; post a reversal');
+            END
+        """)
+
+    add_version_triggers(cur, "party_balances")
+
+    con.commit()
+    con.close()
+
+upgrade_ledger()
+
+def post_journal(cur, event, booking_id, lines):
+    """Post one balanced transaction of (account, party_id, amount) lines."""
+    lines = [line for line in lines if line[2]]
+    if sum(line[2] for line in lines) != 0:
+        raise ValueError(f"unbalanced journal transaction for {event}: {lines}")
+    if not lines:
+        return None
+
+    txn_id = f"{event}:{booking_id}:{time.time_ns()}"
+    cur.executemany("""
+        INSERT INTO journal_entries (txn_id, event, booking_id, account, party_id, amount)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(txn_id, event, booking_id, account, party, amount) for account, party, amount in lines])
+    return txn_id
+
+def booking_terms(cur, booking_id):
+    """(buyer_id, miller_id, booked quantity, price) of a booking as numbers.
+
+    Raises ValueError when legacy TEXT quantity/price don't parse.
+    """
+    cur.execute("""
+        SELECT mb.buyer_id, ms.miller_id, mb.quantity, COALESCE(mb.agreed_price, ms.price)
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.id=?
+    """, (booking_id,))
+    buyer_id, miller_id, booked, price = cur.fetchone()
+    try:
+        return buyer_id, miller_id, float(booked), float(price)
+    except (TypeError, ValueError):
+        raise ValueError(f"booking {booking_id} has a non-numeric quantity {booked!r} or price {price!r}")
+
+def committed_value(cur, booking_id):
+    """Paise of a booking's value still committed and not yet loaded."""
+    cur.execute("""
+        SELECT COALESCE(SUM(amount), 0) FROM journal_entries
+        WHERE booking_id=? AND account='committed_receivable'
+    """, (booking_id,))
+    return cur.fetchone()[0]
+
+def post_approval_journal(cur, booking_id):
+    """Commit the value of a booking just approved."""
+    buyer_id, miller_id, booked, price = booking_terms(cur, booking_id)
+    value = round(booked * price * 100)
+    return post_journal(cur, "approve", booking_id, [
+        ("committed_receivable", buyer_id, value),
+        ("committed_payable", miller_id, -value),
+    ])
+
+def post_decline_journal(cur, booking_id):
+    """Reverse whatever is still committed for a booking being declined."""
+    buyer_id, miller_id, _, _ = booking_terms(cur, booking_id)
+    value = committed_value(cur, booking_id)
+    return post_journal(cur, "decline", booking_id, [
+        ("committed_receivable", buyer_id, -value),
+        ("committed_payable", miller_id, value),
+    ])
+
+def post_loading_journal(cur, booking_id, event_id, quantity):
+    """Receivable, payable and commission for `quantity` just loaded."""
+    buyer_id, miller_id, booked, price = booking_terms(cur, booking_id)
+
+    value = round(quantity * price * 100)
+    # slab rate follows the whole booking, as in the monthly statement
+    rate = float(commission_for([booked * price])[0]) / (booked * price) if booked * price else 0
+    buyer_fee = round(value * rate * BUYER_COMMISSION_SHARE)
+    miller_fee = round(value * rate * (1 - BUYER_COMMISSION_SHARE))
+    # bookings loaded before commitments were posted have none to release
+    released = min(value, committed_value(cur, booking_id))
+
+    return post_journal(cur, f"loading-{event_id}", booking_id, [
+        ("committed_receivable", buyer_id, -released),
+        ("committed_payable", miller_id, released),
+        ("receivable", buyer_id, value + buyer_fee),
+        ("payable", miller_id, -(value - miller_fee)),
+        ("commission", BROKER_PARTY, -(buyer_fee + miller_fee)),
+    ])
+
+def backfill_ledger():
+    """Post loads recorded before the ledger existed, and the unloaded
+    value of approved bookings as commitments, once each."""
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("SELECT 1 FROM journal_entries LIMIT 1")
+    if cur.fetchone() is None:
+        cur.execute("SELECT id, booking_id, quantity FROM loading_events ORDER BY id")
+        for event_id, booking_id, quantity in cur.fetchall():
+            try:
+                post_loading_journal(cur, booking_id, event_id, quantity)
+            except ValueError as e:
+                app.logger.warning("ledger backfill skipped loading event %s: %s", event_id, e)
+
+    cur.execute("SELECT 1 FROM journal_entries WHERE account='committed_receivable' LIMIT 1")
+    if cur.fetchone() is None:
+        cur.execute("""
+            SELECT id, COALESCE(loaded_qty, 0) FROM miller_bookings
+            WHERE status='approved' AND quantity > COALESCE(loaded_qty, 0)
+        """)
+        for booking_id, loaded in cur.fetchall():
+            try:
+                buyer_id, miller_id, booked, price = booking_terms(cur, booking_id)
+            except ValueError as e:
+                app.logger.warning("ledger backfill skipped booking %s: %s", booking_id, e)
+                continue
+            value = round((booked - float(loaded)) * price * 100)
+            post_journal(cur, "approve", booking_id, [
+                ("committed_receivable", buyer_id, value),
+                ("committed_payable", miller_id, -value),
+            ])
+
+    con.commit()
+    con.close()
+
+backfill_ledger()
+
+def take_ledger_snapshot(con):
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM journal_entries")
+        upto = cur.fetchone()[0]
+        cur.execute("INSERT INTO ledger_snapshots (upto_entry_id) VALUES (?)", (upto,))
+        snapshot_id = cur.lastrowid
+        cur.execute("""
+            INSERT INTO ledger_snapshot_balances (snapshot_id, account, party_id, balance)
+            SELECT ?, account, party_id, balance FROM party_balances
+        """, (snapshot_id,))
+        con.commit()
+        return snapshot_id, upto
+    except Exception:
+        con.rollback()
+        raise
+
+def verify_ledger(con, full=False):
+    """Replay the journal from the latest snapshot (or from the start) and
+    compare against party_balances. Returns a list of problems."""
+    cur = con.cursor()
+    # one read transaction so new postings can't race the comparison
+    cur.execute("BEGIN")
+    try:
+        snapshot_id, upto = None, 0
+        if not full:
+            cur.execute("SELECT id, upto_entry_id FROM ledger_snapshots ORDER BY id DESC LIMIT 1")
+            snapshot_id, upto = cur.fetchone() or (None, 0)
+
+        expected = {}
+        if snapshot_id:
+            cur.execute("""
+                SELECT account, party_id, balance FROM ledger_snapshot_balances
+                WHERE snapshot_id=?
+            """, (snapshot_id,))
+            expected = {(a, p): b for a, p, b in cur.fetchall()}
+
+        cur.execute("""
+            SELECT account, party_id, SUM(amount) FROM journal_entries
+            WHERE id > ? GROUP BY account, party_id
+        """, (upto,))
+        for account, party, amount in cur.fetchall():
+            expected[(account, party)] = expected.get((account, party), 0) + amount
+
+        cur.execute("SELECT account, party_id, balance FROM party_balances")
+        actual = {(a, p): b for a, p, b in cur.fetchall()}
+
+        cur.execute("""
+            SELECT txn_id, SUM(amount) FROM journal_entries
+            WHERE id > ? GROUP BY txn_id HAVING SUM(amount) != 0
+        """, (upto,))
+        unbalanced = cur.fetchall()
+    finally:
+        con.rollback()
+
+    problems = [f"transaction {txn} is off by {amount}" for txn, amount in unbalanced]
+    for key in sorted(set(expected) | set(actual), key=str):
+        if expected.get(key, 0) != actual.get(key, 0):
+            problems.append(
+                f"{key[0]}/{key[1]}: balance {actual.get(key, 0)}, replay gives {expected.get(key, 0)}"
+            )
+    return problems
+
+def ledger_snapshotter():
+    while True:
+        time.sleep(LEDGER_SNAPSHOT_INTERVAL)
+        try:
+            con = get_db()
+            for problem in verify_ledger(con):
+                app.logger.error("Ledger mismatch: %s", problem)
+            take_ledger_snapshot(con)
+            con.close()
+        except Exception:
+            app.logger.exception("Ledger snapshot failed")
+
+threading.Thread(target=ledger_snapshotter, daemon=True).start()
+
+@app.cli.command("ledger-snapshot")
+def ledger_snapshot_command():
+    """Snapshot party balances for the verifier."""
+    con = get_db()
+    snapshot_id, upto = take_ledger_snapshot(con)
+    con.close()
+    click.echo(f"snapshot {snapshot_id} covers journal entries up to {upto}")
+
+@app.cli.command("verify-ledger")
+@click.option("--full", is_flag=True, help="Replay the whole journal, not just since the last snapshot.")
+def verify_ledger_command(full):
+    """Check party_balances against a replay of the journal."""
+    con = get_db()
+    start = time.perf_counter()
+    problems = verify_ledger(con, full=full)
+    con.close()
+
+    for problem in problems:
+        click.echo(problem)
+    click.echo(f"{len(problems)} problems, checked in {time.perf_counter() - start:.2f}s")
+    if problems:
+        raise SystemExit(1)
+
+# ---------------- GST ----------------
+# Every loaded booking is a supply by the miller at quantity * lot price,
+# taxed at the rate configured for the crop's HSN code; the broker's
+# commission is a service taxed at BROKERAGE_GST_RATE. Supplier and
+# recipient in the same state split the tax into CGST + SGST, otherwise
+# it is IGST; a party without a resolvable address counts as same-state.
+# Lines are computed with NumPy a month at a time into gst_lines, and
+# triggers mark the months a write touched so only those are recomputed.
+BROKERAGE_SAC = "996211"
+BROKERAGE_GST_RATE = 18.0
+
+DEFAULT_GST_RATES = [
+    # crop, HSN, rate (%)
+    ("wheat", "1001", 0.0),
+    ("paddy", "1006", 0.0),
+    ("rice", "1006", 0.0),
+    ("chawal", "1006", 0.0),
+    ("maize", "1005", 0.0),
+    ("chana", "0713", 0.0),
+    ("sarso", "1207", 5.0),
+    ("mustard", "1207", 5.0),
+    ("soybean", "1201", 5.0),
+    ("mustard oil cake", "2306", 5.0),
+]
+
+# gazetteer state prefix -> GST state code
+GST_STATE_CODES = {
+    "AP": "37", "BR": "10", "CG": "22", "DL": "07", "GJ": "24",
+    "HR": "06", "JH": "20", "MH": "27", "MP": "23", "OD": "21",
+    "PB": "03", "TN": "33", "TS": "36", "UP": "09", "WB": "19",
+}
+
+def upgrade_gst():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS crop_gst_rates (
+            crop TEXT PRIMARY KEY,
+            hsn TEXT NOT NULL,
+            rate REAL NOT NULL
+        )
+    """)
+    cur.executemany(
+        "INSERT OR IGNORE INTO crop_gst_rates (crop, hsn, rate) VALUES (?, ?, ?)",
+        DEFAULT_GST_RATES
+    )
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS gst_lines (
+            booking_id INTEGER PRIMARY KEY,
+            period TEXT NOT NULL,
+            loaded_at DATETIME,
+            buyer_id INTEGER,
+            miller_id INTEGER,
+            crop TEXT,
+            hsn TEXT,
+            quantity INTEGER,
+            taxable INTEGER,
+            rate REAL,
+            cgst INTEGER,
+            sgst INTEGER,
+            igst INTEGER,
+            commission INTEGER,
+            commission_gst INTEGER,
+            supplier_state TEXT,
+            place_of_supply TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_gst_lines_period
+        ON gst_lines (period, loaded_at)
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS gst_dirty_periods (
+            period TEXT PRIMARY KEY
+        )
+    """)
+
+    cur.execute("SELECT COUNT(*) FROM gst_lines")
+    empty = not cur.fetchone()[0]
+    if commission_scheme_changed(cur, "gst_lines") or empty:
+        cur.execute("""
+            INSERT OR IGNORE INTO gst_dirty_periods (period)
+            SELECT DISTINCT strftime('%Y-%m', loaded_at)
+            FROM miller_bookings
+            WHERE truck_status='loaded' AND loaded_at IS NOT NULL
+        """)
+
+    mark = """
+        INSERT OR IGNORE INTO gst_dirty_periods (period)
+        SELECT DISTINCT strftime('%Y-%m', mb.loaded_at)
+        FROM miller_bookings mb
+        {join}
+        WHERE mb.truck_status='loaded' AND mb.loaded_at IS NOT NULL AND {where};
+    """
+    stock = "JOIN miller_stock ms ON mb.stock_id = ms.id"
+    triggers = {
+        "booking_insert": ("AFTER INSERT ON miller_bookings", mark.format(join="", where="mb.id = NEW.id")),
+        "booking_update": (
+            "AFTER UPDATE OF quantity, stock_id, buyer_id, truck_status, loaded_at ON miller_bookings",
+            "INSERT OR IGNORE INTO gst_dirty_periods (period) "
+            "SELECT strftime('%Y-%m', OLD.loaded_at) WHERE OLD.loaded_at IS NOT NULL;"
+            + mark.format(join="", where="mb.id = NEW.id"),
+        ),
+        "booking_delete": (
+            "AFTER DELETE ON miller_bookings",
+            "INSERT OR IGNORE INTO gst_dirty_periods (period) "
+            "SELECT strftime('%Y-%m', OLD.loaded_at) WHERE OLD.loaded_at IS NOT NULL;",
+        ),
+        "stock_update": (
+            "AFTER UPDATE OF price, crop, miller_id ON miller_stock",
+            mark.format(join="", where="mb.stock_id = NEW.id"),
+        ),
+        "rate_change": (
+            "AFTER UPDATE ON crop_gst_rates",
+            mark.format(join=stock, where="lower(trim(ms.crop)) IN (lower(trim(OLD.crop)), lower(trim(NEW.crop)))"),
+        ),
+        "rate_insert": (
+            "AFTER INSERT ON crop_gst_rates",
+            mark.format(join=stock, where="lower(trim(ms.crop)) = lower(trim(NEW.crop))"),
+        ),
+        "miller_address": (
+            "AFTER UPDATE OF district_code ON miller_profiles",
+            mark.format(join=stock, where="ms.miller_id = NEW.miller_id"),
+        ),
+        "buyer_address": (
+            "AFTER UPDATE OF address ON buyer_profiles",
+            mark.format(join="", where="mb.buyer_id = NEW.buyer_id"),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        # recreated every start so older databases pick up changed bodies
+        cur.execute(f"DROP TRIGGER IF EXISTS gst_{name}")
+        cur.execute(f"""
+            CREATE TRIGGER gst_{name}
+            {event}
+            BEGIN {body} END
+        """)
+
+    add_version_triggers(cur, "crop_gst_rates")
+    add_version_triggers(cur, "gst_lines")
+
+    con.commit()
+    con.close()
+
+upgrade_gst()
+
+def party_states(cur, miller_ids, buyer_ids):
+    """Gazetteer state prefix ('' if unknown) for millers and buyers."""
+    states = {}
+    for table, column, key, ids in (
+        ("miller_profiles", "district_code", "miller_id", miller_ids),
+        ("buyer_profiles", "address", "buyer_id", buyer_ids),
+    ):
+        ids = list(ids)
+        found = {}
+        for i in range(0, len(ids), SQL_BATCH):
+            chunk = ids[i:i + SQL_BATCH]
+            cur.execute(f"""
+                SELECT {key}, {column} FROM {table}
+                WHERE {key} IN ({",".join("?" * len(chunk))})
+            """, chunk)
+            found.update(cur.fetchall())
+        for party_id in ids:
+            code = found.get(party_id) or ""
+            if table == "buyer_profiles":
+                code = location_columns(code)[0]
+            states[(key, party_id)] = code.split("-")[0]
+    return states
+
+def compute_gst_lines(cur, period):
+    """gst_lines rows for one month, computed column-wise."""
+    cur.execute("""
+        SELECT mb.id, mb.loaded_at, mb.buyer_id, ms.miller_id, ms.crop,
+               mb.quantity, COALESCE(mb.agreed_price, ms.price)
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.truck_status='loaded'
+          AND strftime('%Y-%m', mb.loaded_at)=?
+    """, (period,))
+    rows = billable_rows(cur.fetchall(), period, "GST lines")
+    if not rows:
+        return []
+
+    ids, loaded_at, buyers, millers, crops, qty, price = zip(*rows)
+    qty = np.array(qty, dtype=np.float64)
+    # taxable value in whole paise
+    taxable = np.rint(qty * np.array(price, dtype=np.float64) * 100).astype(np.int64)
+
+    # crop names are matched case- and whitespace-insensitively
+    cur.execute("SELECT crop, hsn, rate FROM crop_gst_rates")
+    rates = {crop.strip().lower(): (hsn, rate) for crop, hsn, rate in cur.fetchall()}
+    crop_keys, crop_idx = np.unique(
+        np.array([(c or "").strip().lower() for c in crops], dtype=object), return_inverse=True
+    )
+    unmatched = [c for c in crop_keys if c not in rates]
+    if unmatched:
+        app.logger.warning("no GST rate for crops %s in %s; billed at 0%% without HSN", unmatched, period)
+    hsn_of = np.array([rates.get(c, ("", 0.0))[0] for c in crop_keys], dtype=object)[crop_idx]
+    rate = np.array([rates.get(c, ("", 0.0))[1] for c in crop_keys])[crop_idx]
+
+    states = party_states(cur, set(millers), set(buyers))
+    supplier = np.array([states[("miller_id", m)] for m in millers], dtype=object)
+    recipient = np.array([states[("buyer_id", b)] for b in buyers], dtype=object)
+    intra = (supplier == recipient) | (supplier == "") | (recipient == "")
+
+    tax = np.rint(taxable * rate / 100).astype(np.int64)
+    cgst = np.where(intra, tax // 2, 0)
+    sgst = np.where(intra, tax - tax // 2, 0)
+    igst = np.where(intra, 0, tax)
+
+    # statement rate per booking, whole commission (both shares)
+    commission = np.rint(commission_for(taxable / 100) * 100).astype(np.int64)
+    commission_gst = np.rint(commission * BROKERAGE_GST_RATE / 100).astype(np.int64)
+
+    return list(zip(
+        ids, [period] * len(ids), loaded_at, buyers, millers, crops, hsn_of.tolist(),
+        qty.tolist(), taxable.tolist(), rate.tolist(), cgst.tolist(), sgst.tolist(),
+        igst.tolist(), commission.tolist(), commission_gst.tolist(),
+        supplier.tolist(), np.where(recipient == "", supplier, recipient).tolist(),
+    ))
+
+def refresh_gst(con):
+    """Recompute gst_lines for the months marked dirty."""
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT period FROM gst_dirty_periods")
+        periods = [row[0] for row in cur.fetchall()]
+
+        for period in periods:
+            lines = compute_gst_lines(cur, period)
+            cur.execute("DELETE FROM gst_lines WHERE period=?", (period,))
+            cur.executemany(f"""
+                INSERT OR REPLACE INTO gst_lines VALUES ({",".join("?" * 17)})
+            """, lines)
+
+        cur.execute("DELETE FROM gst_dirty_periods")
+        con.commit()
+        return periods
+    except Exception:
+        con.rollback()
+        raise
+
+GST_EXPORT_COLUMNS = [
+    "invoice_no", "invoice_date", "order_id", "supplier", "supplier_state",
+    "recipient", "place_of_supply", "hsn", "description", "quantity_qtl",
+    "taxable_value", "rate", "igst", "cgst", "sgst", "brokerage",
+    "brokerage_sac", "brokerage_gst",
+]
+
+def state_label(prefix):
+    code = GST_STATE_CODES.get(prefix)
+    return f"{code}-{prefix}" if code else prefix
+
+def stream_gst_csv(period):
+    """One month's return lines as CSV, written a batch of rows at a time."""
+    con = get_db()
+    refresh_gst(con)
+    cur = con.cursor()
+    cur.execute("""
+        SELECT inv.invoice_no, g.loaded_at, mb.order_id, miller.name, g.supplier_state,
+               buyer.name, g.place_of_supply, g.hsn, g.crop, g.quantity,
+               g.taxable, g.rate, g.igst, g.cgst, g.sgst, g.commission, g.commission_gst
+        FROM gst_lines g
+        JOIN miller_bookings mb ON g.booking_id = mb.id
+        LEFT JOIN invoices inv ON inv.booking_id = g.booking_id
+        LEFT JOIN users miller ON g.miller_id = miller.id
+        LEFT JOIN users buyer ON g.buyer_id = buyer.id
+        WHERE g.period=?
+        ORDER BY g.loaded_at, g.booking_id
+    """, (period,))
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(GST_EXPORT_COLUMNS)
+    try:
+        while True:
+            rows = cur.fetchmany(1000)
+            if not rows:
+                break
+            for (invoice_no, date, order_id, supplier, s_state, recipient, pos, hsn, crop, qty,
+                 taxable, rate, igst, cgst, sgst, commission, commission_gst) in rows:
+                writer.writerow([
+                    invoice_no or "", (date or "")[:10], order_id or "", supplier, state_label(s_state),
+                    recipient, state_label(pos), hsn, crop, qty,
+                    f"{taxable / 100:.2f}", f"{rate:g}", f"{igst / 100:.2f}", f"{cgst / 100:.2f}",
+                    f"{sgst / 100:.2f}", f"{commission / 100:.2f}", BROKERAGE_SAC,
+                    f"{commission_gst / 100:.2f}",
+                ])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    finally:
+        con.close()
+
+# ---------------- ROLLUPS ----------------
+# daily_rollups keeps one row per (day, crop, miller) with what happened
+# that day: bookings placed, bookings approved (by decision day) and stock
+# posted. Triggers add each write's delta, so charts read a few hundred
+# small rows instead of grouping the booking table; weeks and months are
+# grouped from the daily rows.
+ROLLUP_GRAINS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+ROLLUP_MAX_DAYS = 366
+
+def upgrade_rollups():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_rollups'")
+    first_run = cur.fetchone() is None
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            day TEXT NOT NULL,
+            crop TEXT NOT NULL,
+            miller_id INTEGER NOT NULL,
+            bookings INTEGER NOT NULL DEFAULT 0,
+            booked_qty INTEGER NOT NULL DEFAULT 0,
+            booked_value INTEGER NOT NULL DEFAULT 0,
+            approved INTEGER NOT NULL DEFAULT 0,
+            revenue INTEGER NOT NULL DEFAULT 0,
+            stock_posted INTEGER NOT NULL DEFAULT 0,
+            stock_lots INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, crop, miller_id)
+        )
+    """)
+
+    if first_run:
+        cur.execute("""
+            INSERT INTO daily_rollups (day, crop, miller_id, bookings, booked_qty, booked_value)
+            SELECT date(mb.created_at), ms.crop, ms.miller_id,
+                   COUNT(*), SUM(mb.quantity), SUM(mb.quantity * ms.price)
+            FROM miller_bookings mb
+            JOIN miller_stock ms ON mb.stock_id = ms.id
+            WHERE mb.created_at IS NOT NULL
+            GROUP BY 1, 2, 3
+        """)
+        cur.execute("""
+            INSERT INTO daily_rollups (day, crop, miller_id, approved, revenue)
+            SELECT date(mb.decision_at), ms.crop, ms.miller_id,
+                   COUNT(*), SUM(mb.quantity * ms.price)
+            FROM miller_bookings mb
+            JOIN miller_stock ms ON mb.stock_id = ms.id
+            WHERE mb.status='approved' AND mb.decision_at IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT(day, crop, miller_id) DO UPDATE SET
+                approved = excluded.approved, revenue = excluded.revenue
+        """)
+        cur.execute("""
+            INSERT INTO daily_rollups (day, crop, miller_id, stock_posted, stock_lots)
+            SELECT date(created_at), crop, miller_id, SUM(quantity), COUNT(*)
+            FROM miller_stock
+            WHERE created_at IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT(day, crop, miller_id) DO UPDATE SET
+                stock_posted = excluded.stock_posted, stock_lots = excluded.stock_lots
+        """)
+
+    def add(columns, select):
+        sets = ", ".join(f"{c} = {c} + excluded.{c}" for c in columns)
+        return f"""
+            INSERT INTO daily_rollups (day, crop, miller_id, {", ".join(columns)})
+            {select}
+            ON CONFLICT(day, crop, miller_id) DO UPDATE SET {sets};
+        """
+
+    booked = ("bookings", "booked_qty", "booked_value")
+    approved = ("approved", "revenue")
+    triggers = {
+        "booking_insert": ("AFTER INSERT ON miller_bookings", add(booked, """
+            SELECT date(NEW.created_at), crop, miller_id, 1, NEW.quantity, NEW.quantity * price
+            FROM miller_stock WHERE id = NEW.stock_id
+        """)),
+        "booking_delete": ("AFTER DELETE ON miller_bookings", add(booked, """
+            SELECT date(OLD.created_at), crop, miller_id, -1, -OLD.quantity, -OLD.quantity * price
+            FROM miller_stock WHERE id = OLD.stock_id
+        """)),
+        "booking_approved": (
+            "AFTER UPDATE OF status ON miller_bookings "
+            "WHEN NEW.status = 'approved' AND OLD.status IS NOT 'approved'",
+            add(approved, """
+                SELECT date(COALESCE(NEW.decision_at, CURRENT_TIMESTAMP)), crop, miller_id,
+                       1, NEW.quantity * price
+                FROM miller_stock WHERE id = NEW.stock_id
+            """),
+        ),
+        "booking_unapproved": (
+            "AFTER UPDATE OF status ON miller_bookings "
+            "WHEN OLD.status = 'approved' AND NEW.status IS NOT 'approved'",
+            # taken back on the day it was counted
+            add(approved, """
+                SELECT date(COALESCE(OLD.decision_at, CURRENT_TIMESTAMP)), crop, miller_id,
+                       -1, -OLD.quantity * price
+                FROM miller_stock WHERE id = OLD.stock_id
+            """),
+        ),
+        "stock_insert": ("AFTER INSERT ON miller_stock", add(("stock_posted", "stock_lots"), """
+            SELECT date(COALESCE(NEW.created_at, CURRENT_TIMESTAMP)), NEW.crop, NEW.miller_id,
+                   NEW.quantity, 1
+        """)),
+        "stock_restock": (
+            "AFTER INSERT ON miller_stock_history "
+            "WHEN NEW.new_quantity > NEW.old_quantity",
+            add(("stock_posted",), """
+                SELECT date(NEW.updated_at), crop, miller_id, NEW.new_quantity - NEW.old_quantity
+                FROM miller_stock WHERE id = NEW.stock_id
+            """),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS rollup_{name}
+            {event}
+            BEGIN {body} END
+        """)
+
+    add_version_triggers(cur, "daily_rollups")
+
+    con.commit()
+    con.close()
+
+upgrade_rollups()
+
+def rollup_series(cur, days, grain="day", crop=None, miller_id=None):
+    """Totals per period for the last `days` days, oldest first."""
+    where = ["day >= date('now', ?)"]
+    params = [f"-{days - 1} days"]
+    if crop:
+        where.append("crop = ?")
+        params.append(crop)
+    if miller_id:
+        where.append("miller_id = ?")
+        params.append(miller_id)
+
+    cur.execute(f"""
+        SELECT strftime('{ROLLUP_GRAINS[grain]}', day) AS period,
+               SUM(bookings), SUM(booked_qty), SUM(booked_value),
+               SUM(approved), SUM(revenue), SUM(stock_posted), SUM(stock_lots)
+        FROM daily_rollups
+        WHERE {" AND ".join(where)}
+        GROUP BY period
+        ORDER BY period
+    """, params)
+    return cur.fetchall()
+
+def chart_days():
+    return max(1, min(request.args.get("days", 7, type=int), ROLLUP_MAX_DAYS))
+
+# ---------------- PRICE CANDLES ----------------
+# Every lot posted (miller_stock insert) and every price/quantity update
+# (miller_stock_history insert) is a tick at that price, weighted by the
+# quantity on offer. Triggers fold ticks into one open/high/low/close row
+# per crop and day; vwap_num / volume gives the volume-weighted average.
+# Daily candles older than CANDLE_DAILY_DAYS are merged into weekly ones by
+# `flask compact-candles`. The (crop, grain, start) primary key makes any
+# crop's history a single range read.
+CANDLE_DAILY_DAYS = 400
+CANDLE_MAX_DAYS = 3660
+
+def candle_upsert(crop, day, price, qty):
+    return f"""
+        INSERT INTO price_candles
+        (crop, grain, start, open, high, low, close, vwap_num, volume, ticks)
+        VALUES (lower(trim({crop})), 'day', {day}, {price}, {price}, {price}, {price},
+                {price} * {qty}, {qty}, 1)
+        ON CONFLICT(crop, grain, start) DO UPDATE SET
+            high = MAX(high, excluded.high),
+            low = MIN(low, excluded.low),
+            close = excluded.close,
+            vwap_num = vwap_num + excluded.vwap_num,
+            volume = volume + excluded.volume,
+            ticks = ticks + 1;
+    """
+
+def upgrade_price_candles():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='price_candles'")
+    first_run = cur.fetchone() is None
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS price_candles (
+            crop TEXT NOT NULL,
+            grain TEXT NOT NULL,
+            start TEXT NOT NULL,
+            open INTEGER NOT NULL,
+            high INTEGER NOT NULL,
+            low INTEGER NOT NULL,
+            close INTEGER NOT NULL,
+            vwap_num INTEGER NOT NULL,
+            volume INTEGER NOT NULL,
+            ticks INTEGER NOT NULL,
+            PRIMARY KEY (crop, grain, start)
+        ) WITHOUT ROWID
+    """)
+
+    if first_run:
+        # replay the existing posts and updates in time order
+        cur.execute("""
+            SELECT crop, date(created_at), price, quantity, created_at, 0
+            FROM miller_stock
+            WHERE price > 0 AND created_at IS NOT NULL
+            UNION ALL
+            SELECT ms.crop, date(h.updated_at), h.new_price, COALESCE(h.new_quantity, 0), h.updated_at, h.id
+            FROM miller_stock_history h
+            JOIN miller_stock ms ON h.stock_id = ms.id
+            WHERE h.new_price > 0 AND h.updated_at IS NOT NULL
+            ORDER BY 5, 6
+        """)
+        cur.executemany(
+            candle_upsert(":crop", ":day", ":price", ":qty"),
+            [dict(zip(("crop", "day", "price", "qty"), row)) for row in cur.fetchall()]
+        )
+
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS candles_stock_insert
+        AFTER INSERT ON miller_stock
+        WHEN NEW.price > 0
+        BEGIN
+            {candle_upsert("NEW.crop", "date(COALESCE(NEW.created_at, CURRENT_TIMESTAMP))",
+                           "NEW.price", "COALESCE(NEW.quantity, 0)")}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS candles_stock_update
+        AFTER INSERT ON miller_stock_history
+        WHEN NEW.new_price > 0
+        BEGIN
+            {candle_upsert("(SELECT crop FROM miller_stock WHERE id = NEW.stock_id)",
+                           "date(COALESCE(NEW.updated_at, CURRENT_TIMESTAMP))",
+                           "NEW.new_price", "COALESCE(NEW.new_quantity, 0)")}
+        END
+    """)
+
+    add_version_triggers(cur, "price_candles")
+
+    con.commit()
+    con.close()
+
+upgrade_price_candles()
+
+def merge_candles(rows):
+    """One candle from consecutive (start, open, high, low, close, vwap_num, volume, ticks) rows."""
+    return (
+        rows[0][0],
+        rows[0][1],
+        max(r[2] for r in rows),
+        min(r[3] for r in rows),
+        rows[-1][4],
+        sum(r[5] for r in rows),
+        sum(r[6] for r in rows),
+        sum(r[7] for r in rows),
+    )
+
+def candle_range(cur, crop, grain, since):
+    """One grain of a crop's candles from `since` on: a primary key range read."""
+    cur.execute("""
+        SELECT start, open, high, low, close, vwap_num, volume, ticks
+        FROM price_candles
+        WHERE crop=? AND grain=? AND start >= ?
+        ORDER BY start
+    """, (crop, grain, since))
+    return cur.fetchall()
+
+def week_start(day):
+    d = datetime.strptime(day, "%Y-%m-%d")
+    return (d - timedelta(days=d.weekday())).strftime("%Y-%m-%d")
+
+def compact_candles(con, keep_days=CANDLE_DAILY_DAYS):
+    """Merge daily candles older than `keep_days` into weekly candles."""
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=keep_days)).strftime("%Y-%m-%d")
+        # whole weeks only, so a week is never half daily, half weekly
+        cutoff = week_start(cutoff)
+        cur.execute("""
+            SELECT crop, start, open, high, low, close, vwap_num, volume, ticks
+            FROM price_candles
+            WHERE grain='day' AND start < ?
+            ORDER BY crop, start
+        """, (cutoff,))
+        days = cur.fetchall()
+
+        weeks = []
+        for (crop, week), rows in itertools.groupby(days, key=lambda r: (r[0], week_start(r[1]))):
+            cur.execute("""
+                SELECT start, open, high, low, close, vwap_num, volume, ticks
+                FROM price_candles
+                WHERE crop=? AND grain='week' AND start=?
+            """, (crop, week))
+            existing = cur.fetchall()
+            merged = merge_candles(existing + [r[1:] for r in rows])
+            weeks.append((crop, week) + merged[1:])
+
+        cur.executemany("""
+            INSERT OR REPLACE INTO price_candles
+            (crop, grain, start, open, high, low, close, vwap_num, volume, ticks)
+            VALUES (?, 'week', ?, ?, ?, ?, ?, ?, ?, ?)
+        """, weeks)
+        cur.execute("DELETE FROM price_candles WHERE grain='day' AND start < ?", (cutoff,))
+        con.commit()
+        return len(days), len(weeks)
+    except Exception:
+        con.rollback()
+        raise
+
+@app.cli.command("compact-candles")
+@click.option("--keep-days", default=CANDLE_DAILY_DAYS, help="Daily candles to keep before merging into weeks.")
+def compact_candles_command(keep_days):
+    """Downsample old daily price candles to weekly."""
+    con = get_db()
+    days, weeks = compact_candles(con, keep_days)
+    con.close()
+    click.echo(f"{days} daily candles merged into {weeks} weekly candles")
+
+# ---------------- PRICE ANALYTICS ----------------
+# Price ticks for a crop (lot posts and updates) become a millers x days
+# matrix of each miller's standing price, forward-filled between ticks.
+# The market price is the daily median across millers; moving averages,
+# volatility of daily log returns, each miller's spread to the market and
+# their percentile rank are all whole-array operations on that matrix.
+# Results are cached per crop and dropped when the crop's candle tick count
+# (bumped by every post/update) changes.
+ANALYTICS_WINDOWS = (7, 30)
+ANALYTICS_MAX_DAYS = 3660
+
+analytics_cache = {}
+analytics_lock = threading.Lock()
+
+def forward_fill(matrix):
+    """Carry each row's last non-NaN value forward along axis 1."""
+    idx = np.where(np.isnan(matrix), 0, np.arange(matrix.shape[1]))
+    np.maximum.accumulate(idx, axis=1, out=idx)
+    return matrix[np.arange(matrix.shape[0])[:, None], idx]
+
+def rolling_mean(series, window):
+    """Trailing mean over `window` points, ignoring NaN; NaN until the first value."""
+    valid = ~np.isnan(series)
+    sums = np.cumsum(np.where(valid, series, 0.0))
+    counts = np.cumsum(valid)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def rolling_std(series, window):
+    mean = rolling_mean(series, window)
+    mean_sq = rolling_mean(series * series, window)
+    return np.sqrt(np.clip(mean_sq - mean * mean, 0, None))
+
+def percentile_ranks(values):
+    """Percentile (0-100) of each value within `values`, ties sharing the midpoint."""
+    ordered = np.sort(values)
+    below = np.searchsorted(ordered, values, side="left")
+    at_or_below = np.searchsorted(ordered, values, side="right")
+    return (below + at_or_below) / 2 / len(values) * 100
+
+def price_analytics(miller_idx, day_idx, prices, n_millers, n_days):
+    """Market and per-miller statistics from ticks given as index arrays.
+
+    Ticks must be in time order; the last tick of a day sets that day's price.
+    """
+    matrix = np.full((n_millers, n_days), np.nan)
+    matrix[miller_idx, day_idx] = prices
+    matrix = forward_fill(matrix)
+
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN days before the first post
+        market = np.nanmedian(matrix, axis=0)
+        returns = np.diff(np.log(market), prepend=np.nan)
+        spread = (matrix - market) / market
+
+    stats = {"market": market}
+    for window in ANALYTICS_WINDOWS:
+        stats[f"ma{window}"] = rolling_mean(market, window)
+    stats["volatility30"] = rolling_std(returns, 30)
+
+    current = matrix[:, -1]
+    listed = ~np.isnan(current)
+    ranks = np.full(n_millers, np.nan)
+    if listed.any():
+        ranks[listed] = percentile_ranks(current[listed])
+
+    recent = spread[:, -30:]
+    has_recent = (~np.isnan(recent)).any(axis=1)
+    avg_spread = np.full(n_millers, np.nan)
+    avg_spread[has_recent] = np.nanmean(recent[has_recent], axis=1)
+
+    stats["millers"] = {
+        "price": current,
+        "spread": spread[:, -1],
+        "spread30": avg_spread,
+        "percentile": ranks,
+    }
+    return stats
+
+def load_price_ticks(cur, crop):
+    """(miller ids, first day, ticks [(miller, day offset, price)]) for a crop."""
+    cur.execute("""
+        SELECT miller_id, date(created_at), price, created_at, 0
+        FROM miller_stock
+        WHERE lower(trim(crop))=? AND price > 0 AND created_at IS NOT NULL
+        UNION ALL
+        SELECT h.miller_id, date(h.updated_at), h.new_price, h.updated_at, h.id
+        FROM miller_stock_history h
+        JOIN miller_stock ms ON h.stock_id = ms.id
+        WHERE lower(trim(ms.crop))=? AND h.new_price > 0 AND h.updated_at IS NOT NULL
+        ORDER BY 4, 5
+    """, (crop, crop))
+    return cur.fetchall()
+
+def crop_analytics(crop, days=365):
+    """Cached analytics for one crop over the last `days` days."""
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        SELECT COALESCE(SUM(ticks), 0), MAX(start)
+        FROM price_candles WHERE crop=?
+    """, (crop,))
+    # a new day re-anchors the window even without new ticks
+    version = cur.fetchone() + (datetime.now(timezone.utc).date().isoformat(), days)
+
+    with analytics_lock:
+        cached = analytics_cache.get(crop)
+    if cached and cached[0] == version:
+        con.close()
+        return cached[1]
+
+    ticks = load_price_ticks(cur, crop)
+    names = {}
+    if ticks:
+        miller_ids = sorted({t[0] for t in ticks})
+        cur.execute(f"""
+            SELECT id, name FROM users WHERE id IN ({",".join("?" * len(miller_ids))})
+        """, miller_ids)
+        names = dict(cur.fetchall())
+    con.close()
+
+    today = datetime.now(timezone.utc).date()
+    start = today - timedelta(days=days - 1)
+    result = {"crop": crop, "start": start.isoformat(), "days": days, "series": {}, "millers": []}
+    if ticks:
+        miller_ids = sorted({t[0] for t in ticks})
+        position = {m: i for i, m in enumerate(miller_ids)}
+        first = min(datetime.strptime(t[1], "%Y-%m-%d").date() for t in ticks)
+        origin = min(first, start)
+        n_days = (today - origin).days + 1
+
+        m_idx = np.array([position[t[0]] for t in ticks])
+        d_idx = np.array([(datetime.strptime(t[1], "%Y-%m-%d").date() - origin).days for t in ticks])
+        keep = d_idx < n_days
+        stats = price_analytics(
+            m_idx[keep], d_idx[keep], np.array([t[2] for t in ticks], dtype=np.float64)[keep],
+            len(miller_ids), n_days
+        )
+
+        def clean(values):
+            return [None if np.isnan(v) else round(float(v), 4) for v in values]
+
+        tail = slice(n_days - days, None)
+        result["series"] = {
+            key: clean(stats[key][tail])
+            for key in ("market", *(f"ma{w}" for w in ANALYTICS_WINDOWS), "volatility30")
+        }
+        per_miller = {key: clean(values) for key, values in stats["millers"].items()}
+        result["millers"] = [
+            {"miller_id": m, "name": names.get(m), **{key: per_miller[key][i] for key in per_miller}}
+            for i, m in enumerate(miller_ids)
+        ]
+
+    with analytics_lock:
+        analytics_cache[crop] = (version, result)
+    return result
+
+@app.cli.command("bench-analytics")
+@click.option("--millers", default=500, help="Millers quoting the crop.")
+@click.option("--years", default=10, help="Years of daily history.")
+@click.option("--update-every", default=3, help="Average days between a miller's price updates.")
+def bench_analytics(millers, years, update_every):
+    """Time price_analytics on synthetic random-walk price histories."""
+    rng = np.random.default_rng(7)
+    n_days = years * 365
+
+    base = 2000 * np.exp(np.cumsum(rng.normal(0, 0.01, n_days)))
+    quotes = base * (1 + rng.normal(0, 0.03, (millers, n_days)))
+    updated = rng.random((millers, n_days)) < 1 / update_every
+    updated[:, 0] = True
+    m_idx, d_idx = np.nonzero(updated)
+    prices = np.round(quotes[m_idx, d_idx])
+    click.echo(f"{len(prices):,} ticks, {millers} millers x {n_days} days")
+
+    runs = []
+    for _ in range(5):
+        start = time.perf_counter()
+        stats = price_analytics(m_idx, d_idx, prices, millers, n_days)
+        runs.append(time.perf_counter() - start)
+
+    click.echo(f"price_analytics: best {min(runs) * 1000:.0f} ms, median {sorted(runs)[2] * 1000:.0f} ms")
+    click.echo(f"last market {stats['market'][-1]:.0f}, ma30 {stats['ma30'][-1]:.0f}, "
+               f"volatility30 {stats['volatility30'][-1]:.4f}")
+
+# ---------------- PRICE MONITOR ----------------
+# Per-crop exponentially weighted mean and variance of log price and log
+# quantity, kept in memory and updated in O(1) per accepted write (West's
+# incremental EWMA). A stock update is held for the miller to confirm when
+# its price is many deviations off the crop's recent level, or when price or
+# quantity jumps by the kind of factor an extra or missing zero produces.
+# Held updates wait in pending_stock_updates and never reach the lot,
+# /market or miller_stock_history until confirmed.
+MONITOR_ALPHA = 0.05         # ~ the last 40 updates per crop
+MONITOR_MIN_OBS = 5
+MONITOR_Z_HOLD = 4.0
+MONITOR_MIN_STD = {"price": 0.05, "quantity": 0.5}  # in log units
+PRICE_JUMP_RATIO = 5
+QUANTITY_JUMP_RATIO = 10
+
+STOCK_UPDATE_FIELDS = ("price", "quantity", "condition", "bag_type", "deduction")
+
+def upgrade_pending_stock_updates():
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pending_stock_updates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stock_id INTEGER NOT NULL,
+            miller_id INTEGER NOT NULL,
+            price INTEGER,
+            quantity INTEGER,
+            condition TEXT,
+            bag_type TEXT,
+            deduction INTEGER,
+            reasons TEXT,
+            status TEXT DEFAULT 'held',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            resolved_at DATETIME
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pending_stock_updates_miller
+        ON pending_stock_updates (miller_id, status)
+    """)
+
+    add_version_triggers(cur, "pending_stock_updates")
+
+    con.commit()
+    con.close()
+
+upgrade_pending_stock_updates()
+
+class PriceMonitor:
+    """Rolling per-crop statistics and the hold decision for stock updates."""
+
+    def __init__(self):
+        self.stats = {}  # crop -> {"price": [n, mean, var], "quantity": [...]}
+        self.lock = threading.Lock()
+
+    def _observe(self, crop_stats, field, value):
+        if value is None or value <= 0:
+            return
+        x = math.log(value)
+        n, mean, var = crop_stats[field]
+        if n == 0:
+            crop_stats[field] = [1, x, 0.0]
+            return
+        diff = x - mean
+        incr = MONITOR_ALPHA * diff
+        crop_stats[field] = [n + 1, mean + incr, (1 - MONITOR_ALPHA) * (var + diff * incr)]
+
+    def _crop(self, crop):
+        """Stats for `crop`, replaying its history the first time it's seen."""
+        key = (crop or "").strip().lower()
+        with self.lock:
+            crop_stats = self.stats.get(key)
+        if crop_stats is not None:
+            return key, crop_stats
+
+        con = get_db()
+        cur = con.cursor()
+        cur.execute("""
+            SELECT price, quantity, created_at, 0
+            FROM miller_stock
+            WHERE lower(trim(crop))=? AND created_at IS NOT NULL
+            UNION ALL
+            SELECT h.new_price, h.new_quantity, h.updated_at, h.id
+            FROM miller_stock_history h
+            JOIN miller_stock ms ON h.stock_id = ms.id
+            WHERE lower(trim(ms.crop))=? AND h.updated_at IS NOT NULL
+            ORDER BY 3, 4
+        """, (key, key))
+        ticks = cur.fetchall()
+        con.close()
+
+        crop_stats = {"price": [0, 0.0, 0.0], "quantity": [0, 0.0, 0.0]}
+        for price, qty, _, _ in ticks:
+            self._observe(crop_stats, "price", price)
+            self._observe(crop_stats, "quantity", qty)
+
+        with self.lock:
+            return key, self.stats.setdefault(key, crop_stats)
+
+    def observe(self, crop, price, quantity):
+        key, crop_stats = self._crop(crop)
+        with self.lock:
+            self._observe(crop_stats, "price", price)
+            self._observe(crop_stats, "quantity", quantity)
+
+    def zscore(self, crop_stats, field, value):
+        n, mean, var = crop_stats[field]
+        if n < MONITOR_MIN_OBS or value <= 0:
+            return None
+        std = max(math.sqrt(var), MONITOR_MIN_STD[field])
+        return abs(math.log(value) - mean) / std
+
+    def check(self, crop, old_price, old_qty, price, quantity):
+        """Reasons to hold an update from old to new values; empty means apply.
+
+        Expects a validated update: a positive price and a quantity of zero
+        or more (zero marks the lot sold out). The stats are not touched
+        here, only on apply.
+        """
+        _, crop_stats = self._crop(crop)
+        with self.lock:
+            price_z = self.zscore(crop_stats, "price", price)
+            qty_z = self.zscore(crop_stats, "quantity", quantity)
+
+        reasons = []
+        if old_price and not 1 / PRICE_JUMP_RATIO < price / old_price < PRICE_JUMP_RATIO:
+            reasons.append(f"price changes {old_price} -> {price}")
+        elif price_z is not None and price_z > MONITOR_Z_HOLD:
+            reasons.append(f"price {price} is {price_z:.1f} deviations from the recent {crop} level")
+
+        if old_qty and quantity / old_qty >= QUANTITY_JUMP_RATIO:
+            reasons.append(f"quantity jumps {old_qty} -> {quantity}")
+        elif qty_z is not None and qty_z > MONITOR_Z_HOLD and quantity > old_qty:
+            reasons.append(f"quantity {quantity} is {qty_z:.1f} deviations from usual {crop} lots")
+        return reasons
+
+    def seed_all(self):
+        con = get_db()
+        crops = [row[0] for row in con.execute("SELECT DISTINCT lower(trim(crop)) FROM miller_stock")]
+        con.close()
+        for crop in crops:
+            self._crop(crop)
+
+price_monitor = PriceMonitor()
+run_in_background(price_monitor.seed_all)
+
+def apply_stock_update(cur, stock_id, miller_id, values, old_price, old_qty):
+    """Write a (checked or confirmed) update to the lot and its history."""
+    cur.execute("""
+    UPDATE miller_stock
+    SET price=?, quantity=?, condition=?, bag_type=?, deduction=?
+    WHERE id=? AND miller_id=?
+    """, (
+        values["price"],
+        values["quantity"],
+        values["condition"],
+        values["bag_type"],
+        values["deduction"],
+        stock_id,
+        miller_id
+    ))
+
+    cur.execute("""
+    INSERT INTO miller_stock_history
+    (stock_id,miller_id,old_price,new_price,old_quantity,new_quantity)
+    VALUES (?,?,?,?,?,?)
+    """, (
+        stock_id,
+        miller_id,
+        old_price,
+        values["price"],
+        old_qty,
+        values["quantity"]
+    ))
+
+    # superseded by what was just written
+    cur.execute("""
+        UPDATE pending_stock_updates
+        SET status='superseded', resolved_at=CURRENT_TIMESTAMP
+        WHERE stock_id=? AND status='held'
+    """, (stock_id,))
+
+    # added quantity goes to buyers already waiting on this lot
+    if allocate_waitlist(cur, stock_id):
+        run_in_background(process_waitlist, stock_id)
+
+# ---------------- FILE SERVING ----------------
+# Static files and uploads are served with a content-hash ETag and URLs that
+# carry ?v=<hash>, so versioned URLs can be cached forever. Set
+# USE_X_SENDFILE (Apache/lighttpd) or X_ACCEL_REDIRECT_PREFIX (nginx internal
+# location mapped to the static folder) to let the front proxy send the bytes.
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+app.config["X_ACCEL_REDIRECT_PREFIX"] = os.environ.get("X_ACCEL_REDIRECT_PREFIX")
+
+file_digests = {}
+
+def file_digest(path):
+    """Content hash of a file, cached until its size or mtime changes."""
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = file_digests.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    digest = h.hexdigest()[:16]
+
+    file_digests[path] = (key, digest)
+    return digest
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint != "static" or "v" in values or "filename" not in values:
+        return
+    path = safe_join(app.static_folder, values["filename"])
+    if path and os.path.isfile(path):
+        values["v"] = file_digest(path)
+
+def precompressed_variant(path):
+    """Pick the .br/.gz file written by `flask build-assets`, if still fresh."""
+    for encoding, ext in (("br", ".br"), ("gzip", ".gz")):
+        variant = path + ext
+        if (
+            request.accept_encodings[encoding]
+            and os.path.isfile(variant)
+            and os.path.getmtime(variant) >= os.path.getmtime(path)
+        ):
+            return variant, ext, encoding
+    return path, "", None
+
+def send_static_path(path, filename):
+    immutable = request.args.get("v") == file_digest(path)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    served, ext, encoding = precompressed_variant(path)
+    etag = file_digest(served)
+
+    prefix = app.config["X_ACCEL_REDIRECT_PREFIX"]
+    if prefix:
+        # nginx serves the bytes (and Range requests) from its internal location
+        response = app.response_class(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + filename + ext
+        response.set_etag(etag)
+        response.make_conditional(request)
+    else:
+        # conditional=True gives If-None-Match/304 and Range/206 support;
+        # USE_X_SENDFILE is honoured by send_file itself
+        response = send_file(served, mimetype=mimetype, conditional=True, etag=etag, max_age=0)
+
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if os.path.isfile(path + ".gz") or os.path.isfile(path + ".br"):
+        response.vary.add("Accept-Encoding")
+
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def serve_static(filename):
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return send_static_path(path, filename)
+
+app.view_functions["static"] = serve_static
+
+# ---------------- COMPRESSION ----------------
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = {
+    "text/html",
+    "text/css",
+    "text/plain",
+    "text/csv",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+}
+COMPRESS_LEVEL_GZIP = 6
+COMPRESS_LEVEL_BROTLI = 5
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli dynamic responses; files are left to the precompressed variants."""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code != 200
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESS_MIMETYPES
+        or "no-transform" in response.headers.get("Cache-Control", "")
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding == "br":
+        data = brotli.compress(data, quality=COMPRESS_LEVEL_BROTLI)
+    elif encoding == "gzip":
+        data = gzip.compress(data, COMPRESS_LEVEL_GZIP)
+    else:
+        return response
+
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+
+    # the bytes differ per encoding, so only a weak validator still holds
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+PRECOMPRESS_EXTENSIONS = {".css", ".js", ".svg", ".html", ".json", ".txt"}
+
+def minify_css(text):
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    # only inside declaration blocks: in a selector "div :hover" differs
+    # from "div:hover"
+    text = re.sub(r"\{[^{}]*\}", lambda m: re.sub(r"\s*:\s*", ":", m.group()), text)
+    return text.replace(";}", "}").strip()
+
+def build_asset(path):
+    """Write minified .gz/.br variants of a static asset next to it."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".css"):
+        data = minify_css(data.decode("utf-8")).encode("utf-8")
+
+    variants = {".gz": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=11)
+
+    for ext, compressed in variants.items():
+        with open(path + ext + ".tmp", "wb") as f:
+            f.write(compressed)
+        os.replace(path + ext + ".tmp", path + ext)
+    return variants
+
+@app.cli.command("build-assets")
+def build_assets():
+    """Precompress static assets so requests never compress them on the fly."""
+    for root, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [d for d in dirs if d != "uploads"]
+        for name in files:
+            if os.path.splitext(name)[1] not in PRECOMPRESS_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            variants = build_asset(path)
+            sizes = ", ".join(f"{ext} {len(v)}" for ext, v in variants.items())
+            click.echo(f"{os.path.relpath(path, app.static_folder)}: {os.path.getsize(path)} -> {sizes}")
+
+# ---------------- FRAGMENT CACHE ----------------
+FRAGMENT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+class FragmentCache:
+    """LRU of rendered template fragments.
+
+    Entries are stored per (name, key) together with the version they were
+    rendered from, so a changed row replaces its old HTML instead of piling
+    up next to it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_or_render(self, name, key, version, render):
+        cache_key = (name, key)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        html = str(render())
+
+        with self.lock:
+            old = self.entries.pop(cache_key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[cache_key] = (version, html)
+            self.size += len(html)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return html
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_MAX_BYTES)
+
+@app.template_global()
+def cached_fragment(name, key, version, caller):
+    """Cache the body of a call block, e.g. one table row per stock:
+
+        {% call cached_fragment("market_row", s[0], s) %} <tr>...</tr> {% endcall %}
+
+    The version can be any comparable value; the row tuple itself works
+    since a changed row compares unequal. Anything else the body depends
+    on (role, staff flag) belongs in the name.
+    """
+    return Markup(fragment_cache.get_or_render(name, key, version, caller))
+
+# ---------------- AUTH ----------------
+@app.route("/", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+
+        email = request.form.get("email")
+        password = request.form.get("password")
+
+        if not email or not password:
+            return render_template(
+                "login.html",
+                error="Please enter email and password"
+            )
+
+        con = get_db()
+        cur = con.cursor()
+        cur.execute(
+            "SELECT id, name, email, password, role, status, is_staff, parent_miller_id FROM users WHERE email=? AND password=?",
+            (email, password)
+        )
+        user = cur.fetchone()
+        con.close()
+
+        if not user:
+            return render_template(
+                "login.html",
+                error="Invalid credentials"
+            )
+
+        if user[5] != "approved":
+            return render_template(
+                "login.html",
+                error="⛔ Your account is not approved by admin yet"
+            )
+
+        session["user_id"] = user[0] 
+        session["role"] = user[4]
+        session["is_staff"] = user[6] if user[6] else 0
+        session["parent_miller_id"] = user[7] if user[7] else None
+
+        if user[4] == "farmer":
+            return redirect("/my_commodity")
+        elif user[4] == "buyer":
+            return redirect("/market")
+        elif user[4] == "miller":
+            return redirect("/miller")
+        else:
+            return redirect("/admin")
+
+    return render_template("login.html")
+
+@app.route("/register", methods=["GET","POST"])
+def register():
+    if request.method == "POST":
+        con = get_db()
+        cur = con.cursor()
+        cur.execute("""
+        INSERT INTO users (name,email,password,role)
+        VALUES (?,?,?,?)
+        """, (
+            request.form["name"],
+            request.form["email"],
+            request.form["password"],
+            request.form["role"]
+        ))
+        con.commit()
+        con.close()
+        autocomplete.add("party", request.form["name"])
+        return redirect("/")
+    return render_template("register.html")
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    return redirect("/")
+
+# ---------------- FARMER ----------------
+@app.route("/post_crop", methods=["GET","POST"])
+def post_crop():
+    if session.get("role") != "farmer":
+        return redirect("/")
+
+    if request.method == "POST":
+        image = request.files.get("image")
+        filename = None
+        if image and image.filename:
+            filename = secure_filename(image.filename)
+            image.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+
+        crop = autocomplete.canonical("crop", request.form["crop"])
+        variety = autocomplete.canonical("variety", request.form["variety"])
+        district_code, lat, lon = location_columns(request.form["location"])
+
+        con = get_db()
+        cur = con.cursor()
+        cur.execute("""
+        INSERT INTO crops (farmer_id,crop,variety,price,quantity,location,image,district_code,lat,lon)
+        VALUES (?,?,?,?,?,?,?,?,?,?)
+        """, (
+           get_effective_user_id(),
+            crop,
+            variety,
+            request.form["price"],
+            request.form["quantity"],
+            request.form["location"],
+            filename,
+            district_code,
+            lat,
+            lon
+        ))
+        con.commit()
+        con.close()
+        autocomplete.add("crop", crop)
+        autocomplete.add("variety", variety)
+        return redirect("/my_commodity")
+
+    return render_template("post_crop.html")
+
+@app.route("/my_commodity")
+@conditional_get("crops")
+def my_commodity():
+    if session.get("role") != "farmer":
+        return redirect("/")
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("SELECT * FROM crops WHERE farmer_id=?", (get_effective_user_id(),))
+    crops = cur.fetchall()
+    con.close()
+    return render_template("my_commodity.html", crops=crops)
+
+# ---------------- MILLER ----------------
+@app.route("/miller", methods=["GET", "POST"])
+@conditional_get("miller_stock", "miller_bookings", "users", "bill_files")
+def miller_dashboard():    
+
+    if session.get("role") != "miller":
+        return redirect("/")
+
+    miller_id = get_effective_user_id()
+
+    con = get_db()
+    cur = con.cursor()
+
+    # ❌ STAFF CANNOT POST STOCK
+    if request.method == "POST":
+        if session.get("is_staff"):
+            return redirect("/miller")   # 🔒 block staff
+
+        crop = autocomplete.canonical("crop", request.form["crop"])
+        cur.execute("""
+            INSERT INTO miller_stock
+            (miller_id, crop, quantity, price, condition, bag_type, deduction)
+            VALUES (?,?,?,?,?,?,?)
+        """, (
+            miller_id,
+            crop,
+            request.form["quantity"],
+            request.form["price"],
+            request.form["condition"],
+            request.form["bag_type"],
+            request.form["deduction"]
+        ))
+        if allocate_waitlist(cur, cur.lastrowid):
+            run_in_background(process_waitlist, cur.lastrowid)
+        con.commit()
+        price_monitor.observe(crop, request.form.get("price", type=int), request.form.get("quantity", type=int))
+        autocomplete.add("crop", crop)
+        exchange.match_crop(crop)
+
+
+# ✅ LIVE STOCKS
+    cur.execute("""
+    SELECT *
+    FROM miller_stock
+    WHERE miller_id=?
+    ORDER BY created_at DESC
+""", (miller_id,))
+    stocks = cur.fetchall()
+
+# ✅ BUYER BOOKINGS
+    cur.execute("""
+    SELECT
+        mb.id,
+        u.name,
+        ms.crop,
+        mb.quantity,
+        mb.status,
+        mb.reason,
+        mb.decision_at,
+        mb.loaded_qty,
+        mb.loading_status,
+        mb.bill_document,
+        mb.order_id
+    FROM miller_bookings mb
+    JOIN users u ON mb.buyer_id = u.id
+    JOIN miller_stock ms ON mb.stock_id = ms.id
+    WHERE ms.miller_id=?
+    ORDER BY mb.created_at DESC
+""", (miller_id,))
+    bookings = cur.fetchall()
+
+    con.close()
+
+    return render_template(
+        "miller.html",
+        stocks=stocks,
+        bookings=bookings,
+        bill_previews=bill_previews_for(bookings, 9)
+    )
+@app.route("/miller/api/procurement")
+@conditional_get("crops")
+def procurement_feed():
+    """Unsold farmer crops, cheapest first, with keyset pagination"""
+    if session.get("role") != "miller":
+        return {"error": "Unauthorized"}, 403
+
+    args = request.args
+    where = ["c.sold = 0"]
+    params = []
+    origin = None
+
+    if args.get("crop"):
+        where.append("c.crop = ?")
+        params.append(autocomplete.canonical("crop", args["crop"]))
+    if args.get("variety"):
+        where.append("c.variety = ?")
+        params.append(autocomplete.canonical("variety", args["variety"]))
+
+    for arg, clause in (
+        ("min_price", "c.price >= ?"),
+        ("max_price", "c.price <= ?"),
+        ("min_qty", "c.quantity >= ?"),
+        ("max_qty", "c.quantity <= ?"),
+    ):
+        value = args.get(arg, type=int)
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+
+    if args.get("location"):
+        district = resolve_location(args["location"])
+        if not district:
+            return {"error": "Unknown location"}, 400
+        km = args.get("km", type=float)
+        if km:
+            km = min(km, NEAR_MAX_KM)
+            origin = (district["lat"], district["lon"])
+            # R*Tree box prefilter, then the exact great-circle distance
+            box = bounding_box(*origin, km)
+            where.append("""c.id IN (
+                SELECT id FROM crops_geo
+                WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?
+            )""")
+            params.extend(box)
+            where.append("haversine_km(?, ?, c.lat, c.lon) <= ?")
+            params.extend([*origin, km])
+        else:
+            where.append("c.district_code = ?")
+            params.append(district["code"])
+
+    # radius searches are nearest first, otherwise cheapest first
+    if origin:
+        sort_key, sort_arg, sort_type = "haversine_km(?, ?, c.lat, c.lon)", "after_distance", float
+        sort_params = list(origin)
+    else:
+        sort_key, sort_arg, sort_type = "c.price", "after_price", int
+        sort_params = []
+
+    # keyset cursor: rows strictly after the last (sort key, id) already seen
+    after = args.get(sort_arg, type=sort_type)
+    after_id = args.get("after_id", type=int)
+    if after is not None and after_id is not None:
+        where.append(f"({sort_key}, c.id) > (?, ?)")
+        params.extend([*sort_params, after, after_id])
+
+    limit = min(max(args.get("limit", PROCUREMENT_PAGE_SIZE, type=int), 1), 200)
+
+    con = get_db()
+    con.create_function("haversine_km", 4, haversine_km, deterministic=True)
+    cur = con.cursor()
+    cur.execute(f"""
+        SELECT c.id, c.crop, c.variety, c.price, c.quantity, c.location,
+               c.district_code, c.image, u.name, {sort_key}
+        FROM crops c
+        JOIN users u ON c.farmer_id = u.id
+        WHERE {" AND ".join(where)}
+        ORDER BY {sort_key}, c.id
+        LIMIT ?
+    """, (*sort_params, *params, *sort_params, limit + 1))
+    rows = cur.fetchall()
+    con.close()
+
+    fields = ["id", "crop", "variety", "price", "quantity", "location", "district_code", "image", "farmer"]
+    lots = []
+    for row in rows[:limit]:
+        lot = dict(zip(fields, row))
+        if origin:
+            lot["distance_km"] = round(row[-1], 1)
+        lots.append(lot)
+
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = {sort_arg: rows[limit - 1][-1], "after_id": lots[-1]["id"]}
+
+    return {"lots": lots, "next": next_cursor}
+
+@app.route("/miller/purchase_crop/<int:crop_id>", methods=["POST"])
+def purchase_crop(crop_id):
+    if session.get("role") != "miller" or session.get("is_staff"):
+        return redirect("/")
+
+    con = get_db()
+    cur = con.cursor()
+
+    # the write lock is taken up front, and sold=0 in the UPDATE means only
+    # one of two racing millers can flip the lot
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("UPDATE crops SET sold=1 WHERE id=? AND sold=0", (crop_id,))
+    if cur.rowcount != 1:
+        con.rollback()
+        con.close()
+        return redirect("/miller")
+
+    cur.execute("""
+        INSERT INTO crop_purchases
+        (crop_id, farmer_id, miller_id, crop, variety, price, quantity)
+        SELECT id, farmer_id, ?, crop, variety, price, quantity
+        FROM crops
+        WHERE id=?
+    """, (get_effective_user_id(), crop_id))
+
+    con.commit()
+    con.close()
+    return redirect("/miller")
+
+@app.route("/miller/update_loading/<int:id>", methods=["POST"])
+def update_loading(id):
+    if session.get("role") != "miller":
+        return redirect("/")
+
+    load_qty = int(request.form["load_qty"])
+    if load_qty <= 0:
+        return redirect("/miller")
+
+    con = get_db()
+    cur = con.cursor()
+
+    # loaded_qty / loading_status follow from the event via trigger
+    try:
+        loaded = record_loading(
+            cur,
+            id,
+            get_effective_user_id(),
+            load_qty,
+            truck_number=request.form.get("truck_number", "").strip() or None,
+            staff_id=session.get("user_id"),
+        )
+    except ValueError:
+        # the load can't be posted to the ledger until the price is fixed
+        con.rollback()
+        con.close()
+        return "❌ This booking's price isn't a number; correct the lot before loading.", 409
+    if not loaded:
+        con.rollback()
+        con.close()
+        return "❌ Only approved bookings can be loaded, up to the quantity left to load.", 409
+    schedule_miller(cur, get_effective_user_id())
+
+    con.commit()
+    con.close()
+    return redirect("/miller")
+
+@app.route("/miller/gate_capacity", methods=["POST"])
+def update_gate_capacity():
+    if session.get("role") != "miller" or session.get("is_staff"):
+        return redirect("/")
+
+    qty_per_hour = request.form.get("qty_per_hour", type=int)
+    open_hour = request.form.get("open_hour", DEFAULT_GATE_CAPACITY[1], type=int)
+    close_hour = request.form.get("close_hour", DEFAULT_GATE_CAPACITY[2], type=int)
+    if not qty_per_hour or qty_per_hour <= 0 or not 0 <= open_hour < close_hour <= 24:
+        return redirect("/miller")
+
+    miller_id = get_effective_user_id()
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        INSERT INTO gate_capacity (miller_id, qty_per_hour, open_hour, close_hour)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(miller_id) DO UPDATE SET
+            qty_per_hour=excluded.qty_per_hour,
+            open_hour=excluded.open_hour,
+            close_hour=excluded.close_hour
+    """, (miller_id, qty_per_hour, open_hour, close_hour))
+    schedule_miller(cur, miller_id)
+    con.commit()
+    con.close()
+    return redirect("/miller")
+
+@app.route("/miller/api/loading_slots")
+@conditional_get("loading_slots", "gate_capacity")
+def miller_loading_slots():
+    """Today's gate plan: approved bookings in loading order"""
+    if session.get("role") != "miller":
+        return {"error": "Unauthorized"}, 403
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        SELECT ls.booking_id, mb.order_id, u.name, ms.crop, ls.quantity,
+               ls.slot_start, ls.slot_end, ls.planned_at
+        FROM loading_slots ls
+        JOIN miller_bookings mb ON ls.booking_id = mb.id
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        JOIN users u ON mb.buyer_id = u.id
+        WHERE ls.miller_id=?
+        ORDER BY ls.position
+    """, (get_effective_user_id(),))
+    rows = cur.fetchall()
+    con.close()
+
+    return {
+        "slots": [
+            {
+                "booking_id": booking_id,
+                "order_id": order_id,
+                "buyer": buyer,
+                "crop": crop,
+                "quantity": qty,
+                "slot_start": start,
+                "slot_end": end,
+                "planned_at": planned_at,
+            }
+            for booking_id, order_id, buyer, crop, qty, start, end, planned_at in rows
+        ]
+    }
+
+@app.route("/api/statements/<period>")
+def party_statement(period):
+    """The logged-in buyer's or miller's statement for one month"""
+    role = session.get("role")
+    if role not in ("buyer", "miller"):
+        return {"error": "Unauthorized"}, 403
+    if not re.fullmatch(r"\d{4}-\d{2}", period):
+        return {"error": "period must be YYYY-MM"}, 400
+
+    party_id = get_effective_user_id()
+    con = get_db()
+    cur = con.cursor()
+
+    # read-only: a month that changed is summed on the fly while the
+    # worker thread rewrites its stored rows
+    if statements_stale(cur, period):
+        run_in_background(refresh_statements_job)
+        summary = next(
+            (tuple(r[3:]) + (None,) for r in period_statement_rows(cur, period)
+             if r[0] == role and r[1] == party_id),
+            (0, 0, 0, 0.0, None),
+        )
+    else:
+        cur.execute("""
+            SELECT bookings, quantity, gross, commission, updated_at
+            FROM party_statements
+            WHERE role=? AND party_id=? AND period=?
+        """, (role, party_id, period))
+        summary = cur.fetchone() or (0, 0, 0, 0.0, None)
+
+    ids, buyers, millers, qty, gross = period_extract(cur, period)
+    con.close()
+
+    mine = (buyers if role == "buyer" else millers) == party_id
+    share = BUYER_COMMISSION_SHARE if role == "buyer" else 1 - BUYER_COMMISSION_SHARE
+    commission = np.round(commission_for(gross[mine]) * share, 2)
+
+    return {
+        "period": period,
+        "role": role,
+        "bookings": summary[0],
+        "quantity": summary[1],
+        "gross": summary[2],
+        "commission": summary[3],
+        "net": round(summary[2] - summary[3], 2) if role == "miller" else round(summary[2] + summary[3], 2),
+        "updated_at": summary[4],
+        "lines": [
+            {"booking_id": b, "quantity": q, "amount": round(g, 2), "commission": c}
+            for b, q, g, c in zip(
+                ids[mine].tolist(), qty[mine].tolist(), gross[mine].tolist(), commission.tolist()
+            )
+        ],
+    }
+
+@app.route("/api/ledger/balance")
+@conditional_get("party_balances")
+def ledger_balance():
+    """What the logged-in buyer owes, or what is owed to the miller"""
+    role = session.get("role")
+    if role not in ("buyer", "miller"):
+        return {"error": "Unauthorized"}, 403
+
+    account = "receivable" if role == "buyer" else "payable"
+    party_id = get_effective_user_id()
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        SELECT balance, entries FROM party_balances
+        WHERE account=? AND party_id=?
+    """, (account, party_id))
+    balance, entries = cur.fetchone() or (0, 0)
+
+    cur.execute("""
+        SELECT id, event, booking_id, amount, posted_at
+        FROM journal_entries
+        WHERE account=? AND party_id=?
+        ORDER BY id DESC
+        LIMIT 20
+    """, (account, party_id))
+    recent = cur.fetchall()
+    con.close()
+
+    # receivables are debits, payables credits; report both as positive dues
+    sign = 1 if account == "receivable" else -1
+    return {
+        "account": account,
+        "balance": sign * balance / 100,
+        "entries": entries,
+        "recent": [
+            {"id": entry_id, "event": event, "booking_id": booking_id,
+             "amount": sign * amount / 100, "posted_at": posted_at}
+            for entry_id, event, booking_id, amount, posted_at in recent
+        ],
+    }
+
+@app.route("/api/candles/<crop>")
+@conditional_get("price_candles")
+def price_candles_api(crop):
+    """OHLC + VWAP per day (or ?grain=week) for the last ?days= (default 365)"""
+    if not session.get("role"):
+        return {"error": "Unauthorized"}, 403
+
+    grain = request.args.get("grain", "day")
+    if grain not in ("day", "week"):
+        return {"error": "grain must be day or week"}, 400
+    days = max(1, min(request.args.get("days", 365, type=int), CANDLE_MAX_DAYS))
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    crop = autocomplete.canonical("crop", crop).lower()
+
+    con = get_db()
+    cur = con.cursor()
+    if grain == "day":
+        candles = candle_range(cur, crop, "day", since)
+    else:
+        # compacted weeks, then the daily candles still kept, rolled up per week
+        since = week_start(since)
+        rows = candle_range(cur, crop, "week", since) + [
+            (week_start(r[0]),) + r[1:] for r in candle_range(cur, crop, "day", since)
+        ]
+        candles = [
+            merge_candles(list(group))
+            for _, group in itertools.groupby(sorted(rows, key=lambda r: r[0]), key=lambda r: r[0])
+        ]
+    con.close()
+
+    return {
+        "crop": crop,
+        "grain": grain,
+        "candles": [
+            {"start": start, "open": o, "high": h, "low": l, "close": c,
+             "vwap": round(vwap_num / volume, 2) if volume else c,
+             "volume": volume, "ticks": ticks}
+            for start, o, h, l, c, vwap_num, volume, ticks in candles
+        ],
+    }
+
+@app.route("/api/bookings/<int:booking_id>/dispatch")
+@conditional_get("loading_events", "miller_bookings")
+def dispatch_timeline(booking_id):
+    """Trucks loaded against a booking, oldest first"""
+    role = session.get("role")
+    if role not in ("miller", "buyer", "admin"):
+        return {"error": "Unauthorized"}, 403
+
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        SELECT mb.quantity, COALESCE(mb.loaded_qty, 0), mb.loading_status,
+               mb.truck_status, mb.loaded_at, mb.buyer_id, ms.miller_id
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.id=?
+    """, (booking_id,))
+    booking = cur.fetchone()
+
+    if not booking or (
+        (role == "miller" and booking[6] != get_effective_user_id())
+        or (role == "buyer" and booking[5] != get_effective_user_id())
+    ):
+        con.close()
+        return {"error": "Booking not found"}, 404
+
+    cur.execute("""
+        SELECT le.id, le.truck_number, le.quantity, le.loaded_at, u.name
+        FROM loading_events le
+        LEFT JOIN users u ON le.staff_id = u.id
+        WHERE le.booking_id=?
+        ORDER BY le.id
+    """, (booking_id,))
+    events = cur.fetchall()
+    con.close()
+
+    loaded = 0
+    timeline = []
+    for event_id, truck, qty, at, staff in events:
+        loaded += qty
+        timeline.append({
+            "id": event_id,
+            "truck_number": truck,
+            "quantity": qty,
+            "loaded_at": at,
+            "staff": staff,
+            "cumulative": loaded,
+        })
+
+    return {
+        "booking_id": booking_id,
+        "quantity": booking[0],
+        "loaded_qty": booking[1],
+        "remaining": booking[0] - booking[1],
+        "loading_status": booking[2],
+        "truck_status": booking[3],
+        "loaded_at": booking[4],
+        "events": timeline,
+    }
+    
+@app.route("/miller/upload_bill/<int:booking_id>", methods=["POST"])
+def upload_booking_bill(booking_id):
+    if session.get("role") != "miller":
+        return redirect("/")
+
+    # Verify the booking belongs to this miller
+    miller_id = get_effective_user_id()
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute("""
+        SELECT mb.id
+        FROM miller_bookings mb
+        JOIN miller_stock ms ON mb.stock_id = ms.id
+        WHERE mb.id=? AND ms.miller_id=? AND mb.loading_status='completed'
+    """, (booking_id, miller_id))
+    
+    booking = cur.fetchone()
+    if not booking:
+        con.close()
+        return redirect("/miller")
+
     # Handle file upload
     bill_file = request.files.get("bill_document")
     filename = None
@@ -670,6 +5035,7 @@ def upload_booking_bill(booking_id):
         name, ext = os.path.splitext(filename)
         filename = f"booking_{booking_id}_{name}{ext}"
         bill_file.save(os.path.join(app.config["BILL_FOLDER"], filename))
+        run_in_background(process_bill, filename)
 
     # Update booking with bill document
     if filename:
@@ -711,6 +5077,7 @@ def miller_profile():
         accountant_phone = request.form.get("accountant_phone", "")
         staff_phone = request.form.get("staff_phone", "")
         address = request.form["address"]
+        district_code, lat, lon = location_columns(address)
 
         # Handle multiple document uploads
         gst_doc = request.files.get("gst_doc")
@@ -750,21 +5117,25 @@ def miller_profile():
             cur.execute("""
                 UPDATE miller_profiles
                 SET mill_name=?, owner_phone=?, accountant_phone=?, staff_phone=?, 
-                    address=?, gst_doc=?, mandi_doc=?, other_doc=?
+                    address=?, gst_doc=?, mandi_doc=?, other_doc=?,
+                    district_code=?, lat=?, lon=?
                 WHERE miller_id=?
             """, (mill_name, owner_phone, accountant_phone, staff_phone, address, 
-                  gst_filename, mandi_filename, other_filename, miller_id))
+                  gst_filename, mandi_filename, other_filename,
+                  district_code, lat, lon, miller_id))
         else:
             cur.execute("""
                 INSERT INTO miller_profiles
                 (miller_id, mill_name, owner_phone, accountant_phone, staff_phone, 
-                 address, gst_doc, mandi_doc, other_doc)
-                VALUES (?,?,?,?,?,?,?,?,?)
+                 address, gst_doc, mandi_doc, other_doc, district_code, lat, lon)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
             """, (miller_id, mill_name, owner_phone, accountant_phone, staff_phone, 
-                  address, gst_filename, mandi_filename, other_filename))
+                  address, gst_filename, mandi_filename, other_filename,
+                  district_code, lat, lon))
 
         con.commit()
         con.close()
+        autocomplete.add("party", mill_name)
         return redirect("/miller/profile")
 
     con.close()
@@ -798,6 +5169,7 @@ def create_miller_staff():
 
     con.commit()
     con.close()
+    autocomplete.add("party", name)
 
     return redirect("/miller")
 
@@ -848,6 +5220,7 @@ def buyer_profile():
 
         con.commit()
         con.close()
+        autocomplete.add("party", shop_name)
         return redirect("/buyer/profile")
 
     con.close()
@@ -858,21 +5231,9 @@ def miller_approve_booking(id):
     if session.get("role") != "miller":
         return redirect("/")
 
-    con = get_db()
-    cur = con.cursor()
-
-    cur.execute("""
-    UPDATE miller_bookings
-    SET status='approved', decision_at=CURRENT_TIMESTAMP
-    WHERE id=?
-    """, (id,))
-
-    con.commit()
-    con.close()
+    transition_booking(id, "approve", "miller", get_effective_user_id())
     return redirect("/miller")
 
-    return redirect("/admin")
-
 @app.route("/miller/decline_booking/<int:id>", methods=["POST"])
 def miller_decline_booking(id):
     if session.get("role") != "miller":
@@ -880,76 +5241,139 @@ def miller_decline_booking(id):
 
     reason = request.form.get("reason", "Not specified")
 
+    # declining returns the stock to inventory
+    transition_booking(id, "decline", "miller", get_effective_user_id(), reason)
+    return redirect("/miller")
+
+# ---------------- UPDATE MILLER STOCK ----------------
+@app.route("/update_miller_stock/<int:id>", methods=["POST"])
+def update_miller_stock(id):
+    if session.get("role") != "miller":
+        return redirect("/")
+
+    miller_id = get_effective_user_id()
+    values = {field: request.form[field] for field in STOCK_UPDATE_FIELDS}
+    try:
+        price, qty = int(values["price"]), int(values["quantity"])
+    except ValueError:
+        price, qty = 0, -1
+    if price <= 0 or qty < 0:
+        return "❌ Price must be a positive whole number and quantity zero or more.", 400
+
     con = get_db()
     cur = con.cursor()
 
-    # return stock to inventory
-    cur.execute("""
-    SELECT stock_id, quantity FROM miller_bookings WHERE id=?
-    """, (id,))
+    cur.execute("SELECT price,quantity,crop FROM miller_stock WHERE id=? AND miller_id=?", (id, miller_id))
     row = cur.fetchone()
+    if not row:
+        con.close()
+        return redirect("/miller")
+    old_price, old_qty, crop = row
 
-    if row:
-        stock_id, qty = row
-        cur.execute("UPDATE miller_stock SET quantity=quantity+? WHERE id=?", (qty, stock_id))
+    # suspicious edits wait for the miller to confirm them
+    reasons = price_monitor.check(crop, old_price, old_qty, price, qty)
+    if reasons:
+        cur.execute("""
+            UPDATE pending_stock_updates
+            SET status='superseded', resolved_at=CURRENT_TIMESTAMP
+            WHERE stock_id=? AND status='held'
+        """, (id,))
+        cur.execute("""
+            INSERT INTO pending_stock_updates
+            (stock_id, miller_id, price, quantity, condition, bag_type, deduction, reasons)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (id, miller_id, price, qty, values["condition"], values["bag_type"],
+              values["deduction"], "; ".join(reasons)))
+        held_id = cur.lastrowid
+        con.commit()
+        con.close()
+        return redirect(f"/miller?held={held_id}")
 
-    cur.execute("""
-    UPDATE miller_bookings
-    SET status='declined', reason=?, decision_at=CURRENT_TIMESTAMP
-    WHERE id=?
-    """, (reason, id))
+    apply_stock_update(cur, id, miller_id, values, old_price, old_qty)
 
     con.commit()
     con.close()
+    price_monitor.observe(crop, price, qty)
+    exchange.match_crop(crop)
     return redirect("/miller")
 
-# ---------------- UPDATE MILLER STOCK ----------------
-@app.route("/update_miller_stock/<int:id>", methods=["POST"])
-def update_miller_stock(id):
+@app.route("/miller/api/held_updates")
+@conditional_get("pending_stock_updates")
+def held_stock_updates():
+    """Stock updates waiting for the miller to confirm or discard"""
     if session.get("role") != "miller":
-        return redirect("/")
+        return {"error": "Unauthorized"}, 403
 
     con = get_db()
     cur = con.cursor()
-
-    cur.execute("SELECT price,quantity FROM miller_stock WHERE id=?", (id,))
-    old_price, old_qty = cur.fetchone()
-
     cur.execute("""
-    UPDATE miller_stock
-    SET price=?, quantity=?, condition=?, bag_type=?, deduction=?
-    WHERE id=? AND miller_id=?
-    """, (
-        request.form["price"],
-        request.form["quantity"],
-        request.form["condition"],
-        request.form["bag_type"],
-        request.form["deduction"],
-        id,
-        get_effective_user_id()
+        SELECT p.id, p.stock_id, ms.crop, ms.price, ms.quantity,
+               p.price, p.quantity, p.reasons, p.created_at
+        FROM pending_stock_updates p
+        JOIN miller_stock ms ON p.stock_id = ms.id
+        WHERE p.miller_id=? AND p.status='held'
+        ORDER BY p.id DESC
+    """, (get_effective_user_id(),))
+    rows = cur.fetchall()
+    con.close()
 
+    return {
+        "held": [
+            {"id": held_id, "stock_id": stock_id, "crop": crop,
+             "current": {"price": cur_price, "quantity": cur_qty},
+             "proposed": {"price": price, "quantity": qty},
+             "reasons": reasons.split("; "), "created_at": created_at}
+            for held_id, stock_id, crop, cur_price, cur_qty, price, qty, reasons, created_at in rows
+        ]
+    }
 
-    ))
+@app.route("/miller/stock_updates/<int:held_id>/<action>", methods=["POST"])
+def resolve_stock_update(held_id, action):
+    """Confirm (apply) or discard a held stock update"""
+    if session.get("role") != "miller":
+        return redirect("/")
+    if action not in ("confirm", "discard"):
+        abort(404)
 
+    miller_id = get_effective_user_id()
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
     cur.execute("""
-    INSERT INTO miller_stock_history
-    (stock_id,miller_id,old_price,new_price,old_quantity,new_quantity)
-    VALUES (?,?,?,?,?,?)
-    """, (
-        id,
-        get_effective_user_id(),
-        old_price,
-        request.form["price"],
-        old_qty,
-        request.form["quantity"]
-    ))
+        SELECT p.stock_id, p.price, p.quantity, p.condition, p.bag_type, p.deduction,
+               ms.price, ms.quantity, ms.crop
+        FROM pending_stock_updates p
+        JOIN miller_stock ms ON p.stock_id = ms.id
+        WHERE p.id=? AND p.miller_id=? AND p.status='held'
+    """, (held_id, miller_id))
+    row = cur.fetchone()
+    if not row:
+        con.rollback()
+        con.close()
+        return redirect("/miller")
 
+    stock_id, price, qty, condition, bag_type, deduction, old_price, old_qty, crop = row
+    if action == "confirm":
+        values = {"price": price, "quantity": qty, "condition": condition,
+                  "bag_type": bag_type, "deduction": deduction}
+        apply_stock_update(cur, stock_id, miller_id, values, old_price, old_qty)
+
+    cur.execute("""
+        UPDATE pending_stock_updates
+        SET status=?, resolved_at=CURRENT_TIMESTAMP
+        WHERE id=?
+    """, ("confirmed" if action == "confirm" else "discarded", held_id))
     con.commit()
     con.close()
+
+    if action == "confirm":
+        price_monitor.observe(crop, price, qty)
+        exchange.match_crop(crop)
     return redirect("/miller")
 
 # ---------------- BUYER ----------------
 @app.route("/market")
+@conditional_get("miller_stock", "miller_bookings", "users", "bill_files")
 def market():
     con = get_db()
     cur = con.cursor()
@@ -963,133 +5387,324 @@ def market():
     """)
     miller_stocks = cur.fetchall()
 
-    cur.execute("""
-SELECT
-    mb.id,                 -- 0
-    ms.crop,               -- 1
-    mb.quantity,           -- 2 Booked
-    mb.loaded_qty,         -- 3 Loaded
-    (mb.quantity - mb.loaded_qty) AS remaining, -- 4 Remaining
-    mb.truck_status,       -- 5 Status
-    mb.loaded_at,          -- 6 Last updated
-    mb.bill_document,      -- 7 Bill document
-    mb.loading_status,      -- 8 Loading status
-    mb.order_id            -- 9 Order ID
-FROM miller_bookings mb
-JOIN miller_stock ms ON mb.stock_id = ms.id
-WHERE mb.buyer_id=?
-ORDER BY mb.created_at DESC
-""", (session.get("user_id"),))
+    cur.execute("""
+SELECT
+    mb.id,                 -- 0
+    ms.crop,               -- 1
+    mb.quantity,           -- 2 Booked
+    mb.loaded_qty,         -- 3 Loaded
+    (mb.quantity - mb.loaded_qty) AS remaining, -- 4 Remaining
+    mb.truck_status,       -- 5 Status
+    mb.loaded_at,          -- 6 Last updated
+    mb.bill_document,      -- 7 Bill document
+    mb.loading_status,      -- 8 Loading status
+    mb.order_id            -- 9 Order ID
+FROM miller_bookings mb
+JOIN miller_stock ms ON mb.stock_id = ms.id
+WHERE mb.buyer_id=?
+ORDER BY mb.created_at DESC
+""", (session.get("user_id"),))
+
+    my_bookings = cur.fetchall()
+
+
+    con.close()
+    return render_template(
+        "market.html",
+        miller_stocks=miller_stocks,
+        my_bookings=my_bookings,
+        bill_previews=bill_previews_for(my_bookings, 7)
+    )
+
+@app.route("/book_miller_stock/<int:stock_id>", methods=["POST"])
+def book_miller_stock(stock_id):
+    if session.get("role") != "buyer":
+        return redirect("/market")
+
+    qty = request.form.get("quantity", type=int)
+    if not qty or qty <= 0:
+        return "❌ Quantity must be a positive whole number.", 400
+    # booking what is left and waitlisting the rest is opt-in
+    allow_partial = request.form.get("allow_partial") == "1"
+
+    con = get_db()
+    cur = con.cursor()
+    # the write lock is taken before reading, so two buyers can't both
+    # book the same remaining quantity
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT quantity, crop, price FROM miller_stock WHERE id=?", (stock_id,))
+        row = cur.fetchone()
+        if not row:
+            con.rollback()
+            return redirect("/market")
+
+        available, crop, price = row
+        booked = min(max(available, 0), qty)
+        if booked < qty and not allow_partial:
+            con.rollback()
+            return f"❌ Only {max(available, 0)} left in this lot.", 409
+
+        if booked:
+            cur.execute("""
+                UPDATE miller_stock SET quantity=quantity-?
+                WHERE id=? AND quantity>=?
+            """, (booked, stock_id, booked))
+            if cur.rowcount != 1:
+                raise RuntimeError("lot quantity changed during booking")
+            cur.execute("""
+            INSERT INTO miller_bookings (stock_id,buyer_id,quantity,status,order_id,expires_at)
+            VALUES (?,?,?, 'pending', ?, datetime('now', ?))
+            """, (stock_id, get_effective_user_id(), booked, generate_next_order_id(cur), reservation_ttl()))
+
+        if booked < qty:
+            # queue the shortfall for this lot at its price
+            cur.execute("""
+            INSERT INTO booking_waitlist (buyer_id, stock_id, crop, quantity, remaining, max_price)
+            VALUES (?,?,?,?,?,?)
+            """, (get_effective_user_id(), stock_id, crop, qty - booked, qty - booked, price))
+
+        con.commit()   # ✅ VERY IMPORTANT
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+    if booked < qty:
+        return redirect(f"/market?booked={booked}&waitlisted={qty - booked}")
+    return redirect("/market")
+
+@app.route("/cancel_booking/<int:id>")
+def cancel_booking(id):
+    if session.get("role") != "buyer":
+        return redirect("/market")
+
+    transition_booking(id, "cancel", "buyer", get_effective_user_id())
+    return redirect("/market")
+
+@app.route("/invoice/<int:booking_id>")
+@conditional_get("miller_bookings", "miller_stock", "users")
+def invoice(booking_id):
+    if session.get("role") != "buyer":
+        return redirect("/")
+
+    con = get_db()
+    cur = con.cursor()
+
+    cur.execute(INVOICE_SQL + " AND mb.id=? AND mb.buyer_id=?", (booking_id, get_effective_user_id()))
+
+    invoice = cur.fetchone()
+    con.close()
+
+    if not invoice:
+        return "❌ Invoice available only after full loading.", 403
+
+    return render_template("invoice.html", invoice=invoice)
+
+@app.route("/invoice/<int:booking_id>/pdf")
+def invoice_pdf(booking_id):
+    if session.get("role") not in ("buyer", "admin"):
+        return redirect("/")
+
+    buyer_id = get_effective_user_id() if session.get("role") == "buyer" else None
+    found = invoice_pdf_path(booking_id, buyer_id)
+    if not found:
+        return "❌ Invoice available only after full loading.", 403
 
-    my_bookings = cur.fetchall()
+    _, number, path = found
+    return send_file(
+        os.path.abspath(path),
+        mimetype="application/pdf",
+        download_name=f"{number}.pdf",
+        conditional=True,
+    )
 
+@app.route("/invoices/<month>.zip")
+def invoice_month_zip(month):
+    """All of a month's invoices in one ZIP; buyers get only their own"""
+    role = session.get("role")
+    if role not in ("buyer", "admin"):
+        return redirect("/")
+    if not re.fullmatch(r"\d{4}-\d{2}", month):
+        abort(404)
+
+    where, params = " AND strftime('%Y-%m', mb.loaded_at)=?", [month]
+    if role == "buyer":
+        where += " AND mb.buyer_id=?"
+        params.append(get_effective_user_id())
 
+    con = get_db()
+    invoices, jobs = prepare_invoices(con, where, params)
     con.close()
-    return render_template(
-        "market.html",
-        miller_stocks=miller_stocks,
-        my_bookings=my_bookings
+    if not invoices:
+        return "❌ No invoices for this month.", 404
+
+    # stale PDFs are rendered while the ZIP streams, not before it starts
+    return Response(
+        stream_with_context(stream_invoice_zip(invoices, jobs)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=invoices-{month}.zip"},
     )
 
-@app.route("/book_miller_stock/<int:stock_id>", methods=["POST"])
-def book_miller_stock(stock_id):
+@app.route("/api/fill_order", methods=["POST"])
+def fill_order_api():
+    """Book a target quantity across the cheapest lots under one order ID"""
     if session.get("role") != "buyer":
-        return redirect("/market")
+        return {"error": "Unauthorized"}, 403
+
+    qty = request.form.get("quantity", type=int)
+    crop = autocomplete.canonical("crop", request.form.get("crop"))
+    if not crop or not qty or qty <= 0:
+        return {"error": "crop and quantity are required"}, 400
 
-    qty = int(request.form["quantity"])
     con = get_db()
-    cur = con.cursor()
+    order_id, picks = fill_order(
+        con,
+        get_effective_user_id(),
+        crop,
+        qty,
+        max_price=request.form.get("max_price", type=int),
+        allow_partial=request.form.get("allow_partial") == "1",
+    )
+    con.close()
 
-    cur.execute("SELECT quantity FROM miller_stock WHERE id=?", (stock_id,))
-    row = cur.fetchone()
+    filled = sum(p[1] for p in picks)
+    if not order_id:
+        return {"error": "Not enough stock", "crop": crop, "available": filled}, 409
 
-    if row and row[0] >= qty:
-        cur.execute(
-            "UPDATE miller_stock SET quantity=quantity-? WHERE id=?",
-            (qty, stock_id)
-        )
-        order_id = generate_next_order_id()
+    return {
+        "order_id": order_id,
+        "crop": crop,
+        "filled": filled,
+        "average_price": round(sum(p[1] * p[2] for p in picks) / filled, 2),
+        "lots": [
+            {"stock_id": stock_id, "quantity": take, "effective_price": effective}
+            for stock_id, take, effective in picks
+        ],
+    }
+
+@app.route("/api/waitlist", methods=["GET", "POST"])
+def waitlist_api():
+    """List my waitlist entries, or queue for any lot of a crop"""
+    if session.get("role") != "buyer":
+        return {"error": "Unauthorized"}, 403
+
+    buyer_id = get_effective_user_id()
+    con = get_db()
+    cur = con.cursor()
+
+    if request.method == "POST":
+        qty = request.form.get("quantity", type=int)
+        max_price = request.form.get("max_price", type=int)
+        crop = autocomplete.canonical("crop", request.form.get("crop"))
+        if not crop or not qty or qty <= 0 or not max_price or max_price <= 0:
+            con.close()
+            return {"error": "crop, quantity and max_price are required"}, 400
+
+        cur.execute("BEGIN IMMEDIATE")
         cur.execute("""
-        INSERT INTO miller_bookings (stock_id,buyer_id,quantity,status,order_id)
-        VALUES (?,?,?, 'pending', ?)
-        """, (stock_id, get_effective_user_id(), qty, order_id))
+            INSERT INTO booking_waitlist (buyer_id, crop, quantity, remaining, max_price)
+            VALUES (?,?,?,?,?)
+        """, (buyer_id, crop, qty, qty, max_price))
+        entry_id = cur.lastrowid
 
-        con.commit()   # ✅ VERY IMPORTANT
+        # serve it straight away from lots already in stock, cheapest first
+        cur.execute("""
+            SELECT id FROM miller_stock
+            WHERE crop=? AND quantity > 0 AND price <= ?
+            ORDER BY price, id
+        """, (crop, max_price))
+        for (stock_id,) in cur.fetchall():
+            if allocate_waitlist(cur, stock_id):
+                run_in_background(process_waitlist, stock_id)
+            cur.execute("SELECT remaining FROM booking_waitlist WHERE id=?", (entry_id,))
+            if not cur.fetchone()[0]:
+                break
+        con.commit()
 
+    cur.execute("""
+        SELECT id, stock_id, crop, quantity, remaining, max_price, status, created_at
+        FROM booking_waitlist
+        WHERE buyer_id=?
+        ORDER BY id DESC
+    """, (buyer_id,))
+    fields = ["id", "stock_id", "crop", "quantity", "remaining", "max_price", "status", "created_at"]
+    entries = [dict(zip(fields, row)) for row in cur.fetchall()]
     con.close()
-    return redirect("/market")
 
-@app.route("/cancel_booking/<int:id>")
-def cancel_booking(id):
+    return {"entries": entries}
+
+@app.route("/api/waitlist/<int:entry_id>/cancel", methods=["POST"])
+def cancel_waitlist_entry(entry_id):
     if session.get("role") != "buyer":
-        return redirect("/market")
+        return {"error": "Unauthorized"}, 403
 
     con = get_db()
     cur = con.cursor()
-
     cur.execute("""
-    SELECT stock_id, quantity
-    FROM miller_bookings
-    WHERE id=? AND buyer_id=? AND status='pending'
-    """, (id, get_effective_user_id()
+        UPDATE booking_waitlist SET status='cancelled'
+        WHERE id=? AND buyer_id=? AND status='waiting'
+    """, (entry_id, get_effective_user_id()))
+    con.commit()
+    cancelled = cur.rowcount == 1
+    con.close()
 
-))
-    row = cur.fetchone()
+    if not cancelled:
+        return {"error": "Entry not waiting"}, 409
+    return {"id": entry_id, "status": "cancelled"}
 
-    if row:
-        stock_id, qty = row
-        cur.execute(
-            "UPDATE miller_stock SET quantity=quantity+? WHERE id=?",
-            (qty, stock_id)
-        )
-        cur.execute(
-            "UPDATE miller_bookings SET status='cancelled' WHERE id=?",
-            (id,)
-        )
-        con.commit()
+@app.route("/api/exchange/bids", methods=["POST"])
+def exchange_submit_bid():
+    """Post a bid; it fills against the cheapest, oldest lots at once"""
+    if session.get("role") != "buyer":
+        return {"error": "Unauthorized"}, 403
 
-    con.close()
-    return redirect("/market")
+    qty = request.form.get("quantity", type=int)
+    max_price = request.form.get("max_price", type=int)
+    crop = autocomplete.canonical("crop", request.form.get("crop"))
+    if not crop or not qty or qty <= 0 or not max_price or max_price <= 0:
+        return {"error": "crop, quantity and max_price are required"}, 400
 
-@app.route("/invoice/<int:booking_id>")
-def invoice(booking_id):
-    if session.get("role") != "buyer":
-        return redirect("/")
+    bid_id, fills = exchange.submit_bid(get_effective_user_id(), crop, qty, max_price)
+    # the same match may also fill older bids; report only this one
+    fills = [f for f in fills if f[0] == bid_id]
 
     con = get_db()
     cur = con.cursor()
+    cur.execute("SELECT remaining FROM buyer_bids WHERE id=?", (bid_id,))
+    remaining = cur.fetchone()[0]
+    con.close()
 
-    cur.execute("""
-        SELECT
-            mb.id,                 -- invoice id
-            buyer.name,            -- buyer
-            miller.name,           -- miller
-            ms.crop,               -- crop
-            mb.quantity,           -- quantity
-            ms.price,              -- price
-            mb.loaded_at           -- date
-        FROM miller_bookings mb
-        JOIN miller_stock ms ON mb.stock_id = ms.id
-        JOIN users buyer ON mb.buyer_id = buyer.id
-        JOIN users miller ON ms.miller_id = miller.id
-        WHERE mb.id=?
-          AND mb.buyer_id=?
-          AND mb.truck_status='loaded'
-    """, (booking_id, get_effective_user_id()
+    return {
+        "bid_id": bid_id,
+        "crop": crop,
+        "filled": sum(f[2] for f in fills),
+        "remaining": remaining,
+        "fills": [{"stock_id": f[1], "quantity": f[2], "price": f[3]} for f in fills],
+    }
 
-))
+@app.route("/api/exchange/bids/<int:bid_id>/cancel", methods=["POST"])
+def exchange_cancel_bid(bid_id):
+    if session.get("role") != "buyer":
+        return {"error": "Unauthorized"}, 403
 
-    invoice = cur.fetchone()
-    con.close()
+    if not exchange.cancel_bid(get_effective_user_id(), bid_id):
+        return {"error": "Bid not open"}, 409
+    return {"bid_id": bid_id, "status": "cancelled"}
 
-    if not invoice:
-        return "❌ Invoice available only after full loading.", 403
+@app.route("/api/exchange/book/<crop>")
+def exchange_book(crop):
+    if not session.get("role"):
+        return {"error": "Unauthorized"}, 403
 
-    return render_template("invoice.html", invoice=invoice)
+    crop = autocomplete.canonical("crop", crop)
+    return {"crop": crop, **exchange.depth(crop)}
 
 
 # ---------------- ADMIN ----------------
 @app.route("/admin")
+@conditional_get("users", "miller_stock", "miller_stock_history", "miller_bookings", "miller_profiles", "buyer_profiles")
 def admin():
     if session.get("role") != "admin":
         return redirect("/")
@@ -1218,15 +5833,9 @@ def admin():
         crop_stats[crop]['quantity'] += stock[3] or 0
         crop_stats[crop]['count'] += 1
     
-    # Recent bookings (last 7 days)
-    cur.execute("""
-        SELECT DATE(created_at) as date, COUNT(*) as count
-        FROM miller_bookings
-        WHERE created_at >= datetime('now', '-7 days')
-        GROUP BY DATE(created_at)
-        ORDER BY date ASC
-    """)
-    recent_data = cur.fetchall()
+    # Recent bookings (last ?days=, default 7) from the daily rollups
+    chart_range = chart_days()
+    recent_data = [row for row in rollup_series(cur, chart_range) if row[1]]
     recent_bookings_dates = [row[0] or '' for row in recent_data]
     recent_bookings_counts = [row[1] or 0 for row in recent_data]
     
@@ -1265,6 +5874,7 @@ def admin():
     crop_stats=crop_stats,
     recent_bookings_dates=recent_bookings_dates,
     recent_bookings_counts=recent_bookings_counts,
+    chart_range=chart_range,
     approved_users=approved_users,
     pending_users=pending_users,
     blocked_users=blocked_users,
@@ -1273,6 +5883,7 @@ def admin():
     )
     
 @app.route("/admin/api/miller_stock/<int:miller_id>")
+@conditional_get("users", "miller_stock")
 def get_miller_stock_api(miller_id):
     """API endpoint to get miller stock data for comparison"""
     if session.get("role") != "admin":
@@ -1319,7 +5930,349 @@ def get_miller_stock_api(miller_id):
         "stocks": stock_data
     }
 
+@app.route("/api/search")
+def search_api():
+    """Ranked full-text search over crops, stock, users, mills and shops"""
+    kinds = SEARCH_KINDS_BY_ROLE.get(session.get("role"))
+    if not kinds:
+        return {"error": "Unauthorized"}, 403
+
+    requested = request.args.get("kind")
+    if requested:
+        kinds = [k for k in kinds if k in requested.split(",")]
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", 20, type=int), 1), 100)
+
+    query = fts_query(request.args.get("q", ""))
+    if not query or not kinds:
+        return {"query": request.args.get("q", ""), "page": page, "results": [], "has_more": False}
+
+    con = get_db()
+    cur = con.cursor()
+
+    # title matches weigh more than location/address/email matches
+    cur.execute(f"""
+        SELECT kind, ref_id, title, body
+        FROM search_index
+        WHERE search_index MATCH ?
+          AND kind IN ({",".join("?" * len(kinds))})
+        ORDER BY bm25(search_index, 0, 0, 10.0, 1.0)
+        LIMIT ? OFFSET ?
+    """, (query, *kinds, per_page + 1, (page - 1) * per_page))
+    rows = cur.fetchall()
+    con.close()
+
+    return {
+        "query": request.args.get("q", ""),
+        "page": page,
+        "results": [
+            {"kind": r[0], "id": r[1], "title": " ".join(r[2].split()), "detail": " ".join(r[3].split())}
+            for r in rows[:per_page]
+        ],
+        "has_more": len(rows) > per_page,
+    }
+
+@app.route("/api/near")
+def near_api():
+    """Unsold farmer crops or in-stock miller lots within a radius"""
+    role = session.get("role")
+    kind = request.args.get("kind", "stock")
+    allowed = {"admin": ("crops", "stock"), "miller": ("crops", "stock"), "buyer": ("stock",)}
+    if kind not in allowed.get(role, ()):
+        return {"error": "Unauthorized"}, 403
+
+    km = min(max(request.args.get("km", NEAR_DEFAULT_KM, type=float), 0.1), NEAR_MAX_KM)
+    lat = request.args.get("lat", type=float)
+    lon = request.args.get("lon", type=float)
+    if lat is None or lon is None:
+        district = resolve_location(request.args.get("place"))
+        if not district:
+            return {"error": "Unknown location"}, 400
+        lat, lon = district["lat"], district["lon"]
+
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, km)
+
+    con = get_db()
+    cur = con.cursor()
+
+    if kind == "crops":
+        cur.execute("""
+            SELECT c.id, c.crop, c.variety, c.price, c.quantity, c.location,
+                   c.district_code, c.lat, c.lon
+            FROM crops_geo g
+            JOIN crops c ON c.id = g.id
+            WHERE g.max_lat >= ? AND g.min_lat <= ?
+              AND g.max_lon >= ? AND g.min_lon <= ?
+              AND c.sold = 0
+        """, (min_lat, max_lat, min_lon, max_lon))
+        fields = ["id", "crop", "variety", "price", "quantity", "location", "district_code"]
+    else:
+        cur.execute("""
+            SELECT ms.id, ms.crop, ms.price, ms.quantity, ms.deduction, mp.mill_name,
+                   mp.district_code, mp.lat, mp.lon
+            FROM mills_geo g
+            JOIN miller_profiles mp ON mp.miller_id = g.id
+            JOIN miller_stock ms ON ms.miller_id = g.id
+            WHERE g.max_lat >= ? AND g.min_lat <= ?
+              AND g.max_lon >= ? AND g.min_lon <= ?
+              AND ms.quantity > 0
+        """, (min_lat, max_lat, min_lon, max_lon))
+        fields = ["id", "crop", "price", "quantity", "deduction", "mill_name", "district_code"]
+    rows = cur.fetchall()
+    con.close()
+
+    # the box is a superset of the circle; trim its corners exactly
+    results = []
+    for row in rows:
+        distance = haversine_km(lat, lon, row[-2], row[-1])
+        if distance <= km:
+            item = dict(zip(fields, row))
+            item["distance_km"] = round(distance, 1)
+            results.append(item)
+    results.sort(key=lambda item: item["distance_km"])
+
+    return {"lat": lat, "lon": lon, "km": km, "kind": kind, "results": results}
+
+@app.route("/api/autocomplete")
+def autocomplete_api():
+    """Keystroke suggestions for crop, variety and party names"""
+    role = session.get("role")
+    if not role:
+        return {"error": "Unauthorized"}, 403
+
+    field = request.args.get("field", "crop")
+    if field not in AUTOCOMPLETE_SOURCES or (field == "party" and role != "admin"):
+        return {"error": "Unknown field"}, 400
+
+    return {
+        "field": field,
+        "suggestions": autocomplete.complete(field, request.args.get("q", "")),
+    }
+
+@app.route("/admin/crop_aliases", methods=["POST"])
+def add_crop_alias():
+    """Map a local spelling (e.g. Dhaan) onto the canonical crop name"""
+    if session.get("role") != "admin":
+        return redirect("/")
+
+    alias = normalize_name(request.form["alias"])
+    canonical = autocomplete.canonical("crop", request.form["canonical"])
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        INSERT INTO crop_aliases (alias, canonical)
+        VALUES (?, ?)
+        ON CONFLICT(alias) DO UPDATE SET canonical=excluded.canonical
+    """, (alias, canonical))
+    con.commit()
+    con.close()
+
+    autocomplete.add_alias(alias, canonical)
+    return redirect("/admin/compare")
+
+@app.route("/admin/api/reservation_metrics")
+def reservation_metrics_api():
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        SELECT COUNT(*) FROM miller_bookings
+        WHERE status='pending' AND expires_at <= datetime('now')
+    """)
+    backlog = cur.fetchone()[0]
+    con.close()
+
+    return {**reservation_metrics, "backlog": backlog, "ttl_hours": app.config["RESERVATION_TTL_HOURS"]}
+
+@app.route("/admin/api/statements/<period>")
+def admin_statements(period):
+    """Every party's statement and the broker's commission for one month"""
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    con = get_db()
+    cur = con.cursor()
+    if statements_stale(cur, period):
+        # summed on the fly; the worker thread rewrites the stored rows
+        run_in_background(refresh_statements_job)
+        live = period_statement_rows(cur, period)
+        cur.execute("SELECT id, name FROM users")
+        names = dict(cur.fetchall())
+        rows = sorted(
+            ((role, party_id, names.get(party_id), *totals)
+             for role, party_id, _, *totals in live),
+            key=lambda r: (r[0], -r[5]),
+        )
+    else:
+        cur.execute("""
+            SELECT ps.role, ps.party_id, u.name, ps.bookings, ps.quantity, ps.gross, ps.commission
+            FROM party_statements ps
+            LEFT JOIN users u ON ps.party_id = u.id
+            WHERE ps.period=?
+            ORDER BY ps.role, ps.gross DESC
+        """, (period,))
+        rows = cur.fetchall()
+    con.close()
+
+    parties = [
+        {"role": role, "party_id": party_id, "name": name, "bookings": bookings,
+         "quantity": qty, "gross": gross, "commission": commission}
+        for role, party_id, name, bookings, qty, gross, commission in rows
+    ]
+    buyers = [p for p in parties if p["role"] == "buyer"]
+    return {
+        "period": period,
+        "bookings": sum(p["bookings"] for p in buyers),
+        "quantity": sum(p["quantity"] for p in buyers),
+        "gross": sum(p["gross"] for p in buyers),
+        "commission": round(sum(p["commission"] for p in parties), 2),
+        "parties": parties,
+    }
+
+@app.route("/admin/api/ledger")
+@conditional_get("party_balances", "users")
+def admin_ledger_balances():
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    con = get_db()
+    cur = con.cursor()
+    cur.execute("""
+        SELECT pb.account, pb.party_id, u.name, pb.balance, pb.entries
+        FROM party_balances pb
+        LEFT JOIN users u ON pb.party_id = u.id
+        ORDER BY pb.account, pb.balance DESC
+    """)
+    rows = cur.fetchall()
+    con.close()
+
+    return {
+        "balances": [
+            {"account": account, "party_id": party_id, "name": name,
+             "balance": balance / 100, "entries": entries}
+            for account, party_id, name, balance, entries in rows
+        ],
+        "trial_balance": sum(row[3] for row in rows) / 100,
+    }
+
+@app.route("/admin/gst/<period>.csv")
+def admin_gst_export(period):
+    if session.get("role") != "admin":
+        return redirect("/")
+    if not re.fullmatch(r"\d{4}-\d{2}", period):
+        abort(404)
+
+    return Response(
+        stream_with_context(stream_gst_csv(period)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=gst-{period}.csv"},
+    )
+
+@app.route("/admin/api/gst/<period>")
+def admin_gst_summary(period):
+    """HSN-wise totals for one month plus GST on brokerage"""
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    con = get_db()
+    refresh_gst(con)
+    cur = con.cursor()
+    cur.execute("""
+        SELECT hsn, rate, COUNT(*), SUM(quantity), SUM(taxable),
+               SUM(igst), SUM(cgst), SUM(sgst)
+        FROM gst_lines
+        WHERE period=?
+        GROUP BY hsn, rate
+        ORDER BY hsn
+    """, (period,))
+    hsn_rows = cur.fetchall()
+    cur.execute("""
+        SELECT COALESCE(SUM(commission), 0), COALESCE(SUM(commission_gst), 0)
+        FROM gst_lines WHERE period=?
+    """, (period,))
+    commission, commission_gst = cur.fetchone()
+    con.close()
+
+    return {
+        "period": period,
+        "hsn": [
+            {"hsn": hsn, "rate": rate, "bookings": n, "quantity": qty,
+             "taxable": taxable / 100, "igst": igst / 100, "cgst": cgst / 100, "sgst": sgst / 100}
+            for hsn, rate, n, qty, taxable, igst, cgst, sgst in hsn_rows
+        ],
+        "brokerage": {"sac": BROKERAGE_SAC, "rate": BROKERAGE_GST_RATE,
+                      "value": commission / 100, "gst": commission_gst / 100},
+    }
+
+@app.route("/admin/gst_rates", methods=["POST"])
+def admin_gst_rates():
+    if session.get("role") != "admin":
+        return redirect("/")
+
+    crop = (autocomplete.canonical("crop", request.form["crop"]) or "").strip().lower()
+    hsn = request.form["hsn"].strip()
+    rate = request.form.get("rate", type=float)
+    if not crop or not re.fullmatch(r"\d{4,8}", hsn) or rate is None or not 0 <= rate <= 28:
+        return {"error": "crop, a 4-8 digit HSN and a rate between 0 and 28 are required"}, 400
+
+    con = get_db()
+    con.execute("""
+        INSERT INTO crop_gst_rates (crop, hsn, rate) VALUES (?, ?, ?)
+        ON CONFLICT(crop) DO UPDATE SET hsn=excluded.hsn, rate=excluded.rate
+    """, (crop, hsn, rate))
+    con.commit()
+    con.close()
+    return redirect("/admin")
+
+@app.route("/admin/api/rollups")
+@conditional_get("daily_rollups")
+def admin_rollups():
+    """Chart series from daily_rollups: ?days=, ?grain=day|week|month, ?crop=, ?miller_id="""
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    grain = request.args.get("grain", "day")
+    if grain not in ROLLUP_GRAINS:
+        return {"error": "grain must be day, week or month"}, 400
+
+    con = get_db()
+    cur = con.cursor()
+    rows = rollup_series(
+        cur,
+        chart_days(),
+        grain,
+        crop=autocomplete.canonical("crop", request.args.get("crop")),
+        miller_id=request.args.get("miller_id", type=int),
+    )
+    con.close()
+
+    fields = ["period", "bookings", "booked_qty", "booked_value",
+              "approved", "revenue", "stock_posted", "stock_lots"]
+    return {"grain": grain, "days": chart_days(), "series": [dict(zip(fields, row)) for row in rows]}
+
+@app.route("/admin/api/analytics/<crop>")
+def admin_price_analytics(crop):
+    """Market trend and each miller's rate against it, for /admin/compare"""
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    days = max(1, min(request.args.get("days", 365, type=int), ANALYTICS_MAX_DAYS))
+    crop = autocomplete.canonical("crop", crop).lower()
+    return crop_analytics(crop, days)
+
+@app.route("/admin/api/fragment_cache")
+def fragment_cache_stats():
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    return fragment_cache.stats()
+
 @app.route("/admin/compare")
+@conditional_get("users")
 def admin_compare():
     """Miller Rate Comparison Page"""
     if session.get("role") != "admin":
@@ -1342,6 +6295,7 @@ def admin_compare():
     return render_template("admin_compare.html", millers=millers)
 
 @app.route("/admin/users")
+@conditional_get("users")
 def admin_users():
     """User Access Control Page"""
     if session.get("role") != "admin":
@@ -1371,6 +6325,7 @@ def admin_users():
     return render_template("admin_users.html", all_users=all_users)
 
 @app.route("/admin/stock")
+@conditional_get("miller_stock", "users")
 def admin_stock():
     """Miller Stock (Latest) Page"""
     if session.get("role") != "admin":
@@ -1391,6 +6346,7 @@ def admin_stock():
     return render_template("admin_stock.html", stocks=stocks)
 
 @app.route("/admin/stock-history")
+@conditional_get("miller_stock_history", "users")
 def admin_stock_history():
     """Miller Stock Update History Page"""
     if session.get("role") != "admin":
@@ -1411,6 +6367,7 @@ def admin_stock_history():
     return render_template("admin_stock_history.html", history=history)
 
 @app.route("/admin/bookings")
+@conditional_get("miller_bookings", "miller_stock", "users", "bill_files")
 def admin_bookings():
     """Miller Bookings (Admin Control) Page"""
     if session.get("role") != "admin":
@@ -1445,9 +6402,14 @@ def admin_bookings():
     bookings = cur.fetchall()
     con.close()
     
-    return render_template("admin_bookings.html", bookings=bookings)
+    return render_template(
+        "admin_bookings.html",
+        bookings=bookings,
+        bill_previews=bill_previews_for(bookings, 13)
+    )
 
 @app.route("/admin/miller-profiles")
+@conditional_get("miller_profiles", "users")
 def admin_miller_profiles():
     """Miller Profiles Page"""
     if session.get("role") != "admin":
@@ -1477,6 +6439,7 @@ def admin_miller_profiles():
     return render_template("admin_miller_profiles.html", miller_profiles=miller_profiles)
 
 @app.route("/admin/buyer-profiles")
+@conditional_get("buyer_profiles", "users")
 def admin_buyer_profiles():
     """Buyer/Trader Profiles Page"""
     if session.get("role") != "admin":
@@ -1530,9 +6493,7 @@ def approve_user(id):
         return redirect("/")
 
     con = get_db()
-    cur = con.cursor()
-    cur.execute("UPDATE users SET status='approved' WHERE id=?", (id,))
-    con.commit()
+    transition_users(con, [id], "approve")
     con.close()
     return redirect("/admin/users")
 @app.route("/admin/block_user/<int:id>")
@@ -1541,9 +6502,7 @@ def block_user(id):
         return redirect("/")
 
     con = get_db()
-    cur = con.cursor()
-    cur.execute("UPDATE users SET status='blocked' WHERE id=?", (id,))
-    con.commit()
+    transition_users(con, [id], "block")
     con.close()
     return redirect("/admin/users")
 @app.route("/admin/reject_user/<int:id>")
@@ -1552,13 +6511,12 @@ def reject_user(id):
         return redirect("/")
 
     con = get_db()
-    cur = con.cursor()
-    cur.execute("UPDATE users SET status='rejected' WHERE id=?", (id,))
-    con.commit()
+    transition_users(con, [id], "reject")
     con.close()
     return redirect("/admin/users")
     
 @app.route("/admin/miller/<int:miller_id>")
+@conditional_get("miller_profiles", "users")
 def admin_view_miller(miller_id):
     if session.get("role") != "admin":
         return redirect("/")
@@ -1582,39 +6540,91 @@ def admin_approve_booking(id):
     if session.get("role") != "admin":
         return redirect("/")
 
-    con = get_db()
-    cur = con.cursor()
-
-    cur.execute("""
-        UPDATE miller_bookings
-        SET status='approved',
-            decision_at=CURRENT_TIMESTAMP
-        WHERE id=?
-    """, (id,))
-
-    con.commit()
-    con.close()
+    transition_booking(id, "approve", "admin")
     return redirect("/admin/bookings")
 @app.route("/admin/decline_booking/<int:id>")
 def admin_decline_booking(id):
     if session.get("role") != "admin":
         return redirect("/")
 
+    transition_booking(id, "decline", "admin", reason="Declined by admin")
+    return redirect("/admin/bookings")
+
+def bulk_request():
+    """Read (action, ids) from a JSON body or a form with repeated ids.
+
+    ids is None when the body is malformed: not a JSON object, or ids
+    that aren't a list of integers.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return None, None
+        ids = data.get("ids")
+        if not isinstance(ids, list) or not all(
+            isinstance(i, int) and not isinstance(i, bool) for i in ids
+        ):
+            return data.get("action"), None
+        return data.get("action"), ids
+
+    try:
+        ids = [int(raw) for raw in request.form.getlist("ids")]
+    except ValueError:
+        return request.form.get("action"), None
+    return request.form.get("action"), ids
+
+@app.route("/admin/bookings/bulk", methods=["POST"])
+def admin_bulk_bookings():
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    action, ids = bulk_request()
+    if ids is None:
+        return {"error": "Expected an object with ids as a list of integers"}, 400
+    if action not in ("approve", "decline"):
+        return {"error": "action must be approve or decline"}, 400
+    if not ids:
+        return {"error": "No booking ids given"}, 400
+
+    reason = "Declined by admin" if action == "decline" else None
     con = get_db()
-    cur = con.cursor()
+    results = transition_bookings(con, ids, action, "admin", reason=reason)
+    con.close()
 
-    cur.execute("""
-        UPDATE miller_bookings
-        SET status='declined',
-            decision_at=CURRENT_TIMESTAMP,
-            reason='Declined by admin'
-        WHERE id=?
-    """, (id,))
+    return {
+        "action": action,
+        "updated": sum(1 for status in results.values() if status == BOOKING_TRANSITIONS[action][1]),
+        "results": {str(booking_id): status for booking_id, status in results.items()},
+    }
 
-    con.commit()
+@app.route("/admin/users/bulk", methods=["POST"])
+def admin_bulk_users():
+    if session.get("role") != "admin":
+        return {"error": "Unauthorized"}, 403
+
+    action, ids = bulk_request()
+    if ids is None:
+        return {"error": "Expected an object with ids as a list of integers"}, 400
+    if action not in USER_TRANSITIONS:
+        return {"error": "action must be approve, block or reject"}, 400
+    if not ids:
+        return {"error": "No user ids given"}, 400
+
+    con = get_db()
+    results = transition_users(con, ids, action)
     con.close()
-    return redirect("/admin/bookings")
+
+    return {
+        "action": action,
+        "updated": sum(1 for status in results.values() if status == USER_TRANSITIONS[action]),
+        "results": {str(user_id): status for user_id, status in results.items()},
+    }
     
+# ---------------- BACKGROUND THREADS ----------------
+# Started once the whole module is defined: the sweeper's first pass calls
+# transition_bookings and the ledger/exchange code further down.
+threading.Thread(target=reservation_sweeper, daemon=True).start()
+
 # ---------------- RUN ----------------
 if __name__ == "__main__":
     app.run(debug=True)